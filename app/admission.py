@@ -0,0 +1,193 @@
+import asyncio
+from collections import OrderedDict, deque
+from fastapi.responses import StreamingResponse
+from config import (
+    ADMISSION_MAX_ACTIVE, ADMISSION_MAX_PLAIN, ADMISSION_MAX_SEARCH, ADMISSION_MAX_AGENT,
+    ADMISSION_QUEUE_SIZE, ADMISSION_RETRY_AFTER
+)
+
+# 请求模式，各自有独立的并发上限
+PLAIN = "plain"
+SEARCH = "search"
+AGENT = "agent"
+
+class AdmissionRejected(Exception):
+    """
+    等待队列已满，请求被拒绝。retry_after 为建议客户端重试前等待的秒数。
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__("服务繁忙，等待队列已满")
+        self.retry_after = retry_after
+
+class Ticket:
+    """
+    一个请求的准入凭证。被准入后占用一个并发名额，请求结束时必须调用 `release` 归还。
+    """
+
+    def __init__(self, controller: "AdmissionController", mode: str, key: str):
+        self._controller = controller
+        self.mode = mode
+        self.key = key
+        self.admitted = False
+        self.released = False
+
+    async def wait_turn(self, timeout: float):
+        """
+        排队等待准入，每当排队位置 (从 1 开始) 变化时产出新的位置；被准入后结束。
+        等待超过 timeout 秒时抛出 `asyncio.TimeoutError`。
+        """
+        loop = asyncio.get_running_loop()
+        expires_at = loop.time() + timeout
+        last = None
+        while not self.admitted:
+            position = self._controller.position(self)
+            if position != last:
+                last = position
+                yield position
+                continue
+            changed = self._controller.changed
+            await asyncio.wait_for(changed.wait(), max(expires_at - loop.time(), 0))
+
+    def release(self):
+        """
+        归还名额；仍在排队时退出队列。可以重复调用。
+        """
+        if not self.released:
+            self.released = True
+            self._controller.release(self)
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    持有准入凭证的流式响应，响应结束时归还名额。
+
+    名额与响应的生命周期绑定，而不是与响应体生成器绑定：客户端在第一帧发出之前就断开时，
+    Starlette 不会启动生成器，生成器的 finally 也就不会执行。
+    """
+
+    def __init__(self, content, ticket: Ticket, **kwargs):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.ticket.release()
+
+class AdmissionController:
+    """
+    /api/stream 的准入控制器。
+
+    同时处理的请求数受全局上限和各模式 (普通对话、联网搜索、Agent) 上限的双重限制，
+    超出上限的请求进入有界的等待队列，队列满时拒绝新请求，避免请求无限堆积后集中失败。
+
+    队列按公平键 (会话ID，新会话为客户端 IP) 分组：每组内部先进先出，组与组之间轮流调度，
+    因此同一个用户连续发出的大量请求不会让其他用户一直排在后面。
+    """
+
+    def __init__(self, max_active: int = ADMISSION_MAX_ACTIVE, mode_limits: dict = None,
+                 queue_size: int = ADMISSION_QUEUE_SIZE, retry_after: int = ADMISSION_RETRY_AFTER):
+        self.max_active = max_active
+        self.mode_limits = mode_limits or {PLAIN: ADMISSION_MAX_PLAIN, SEARCH: ADMISSION_MAX_SEARCH, AGENT: ADMISSION_MAX_AGENT}
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.active = 0
+        self.active_by_mode = {mode: 0 for mode in self.mode_limits}
+        # 公平键 -> 该组排队中的凭证；字典顺序即轮转顺序，第一组最先被调度
+        self._queues = OrderedDict()
+        self.queued = 0
+        # 队列或名额变化时置位并替换，唤醒所有等待中的请求
+        self.changed = asyncio.Event()
+        self.admitted_immediately = 0
+        self.admitted_after_wait = 0
+        self.rejected = 0
+
+    def _has_room(self, mode: str) -> bool:
+        return self.active < self.max_active and self.active_by_mode[mode] < self.mode_limits[mode]
+
+    def _admit(self, ticket: Ticket):
+        self.active += 1
+        self.active_by_mode[ticket.mode] += 1
+        ticket.admitted = True
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def enter(self, mode: str, key: str) -> Ticket:
+        """
+        为一个请求申请准入。有空闲名额时立即准入，否则进入等待队列。
+
+        Raises:
+            AdmissionRejected: 等待队列已满。
+        """
+        ticket = Ticket(self, mode, key)
+        # 排队中的请求如果能使用空闲名额，早已在名额释放时被调度，因此这里直接准入不会插队
+        if self._has_room(mode):
+            self._admit(ticket)
+            self.admitted_immediately += 1
+            return ticket
+        if self.queued >= self.queue_size:
+            self.rejected += 1
+            raise AdmissionRejected(self.retry_after)
+        self._queues.setdefault(key, deque()).append(ticket)
+        self.queued += 1
+        return ticket
+
+    def _dequeue(self, ticket: Ticket):
+        queue = self._queues[ticket.key]
+        queue.remove(ticket)
+        self.queued -= 1
+        if not queue:
+            del self._queues[ticket.key]
+
+    def _dispatch(self):
+        # 按轮转顺序查看每组的队首，准入第一个有名额的请求，并把该组移到队尾
+        while self.active < self.max_active:
+            ticket = next((queue[0] for queue in self._queues.values() if self._has_room(queue[0].mode)), None)
+            if ticket is None:
+                break
+            self._dequeue(ticket)
+            if ticket.key in self._queues:
+                self._queues.move_to_end(ticket.key)
+            self._admit(ticket)
+            self.admitted_after_wait += 1
+
+    def release(self, ticket: Ticket):
+        if ticket.admitted:
+            self.active -= 1
+            self.active_by_mode[ticket.mode] -= 1
+        else:
+            self._dequeue(ticket)
+        self._dispatch()
+        self._notify()
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        估算排队中的请求在轮转调度下的位置 (从 1 开始)：
+        位于它所在组之前的每组最多排在它前面 index + 1 个请求，之后的每组最多 index 个。
+        """
+        queue = self._queues[ticket.key]
+        index = queue.index(ticket)
+        position = 1
+        before = True
+        for key, other in self._queues.items():
+            if key == ticket.key:
+                before = False
+                position += index
+                continue
+            position += min(len(other), index + 1 if before else index)
+        return position
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "active_by_mode": dict(self.active_by_mode),
+            "queued": self.queued,
+            "admitted_immediately": self.admitted_immediately,
+            "admitted_after_wait": self.admitted_after_wait,
+            "rejected": self.rejected,
+        }
+
+admission_controller = AdmissionController()
@@ -0,0 +1,77 @@
+# Agent 决策的两种结果：调用工具 (输出为 JSON)，或直接回答用户 (输出为普通文本)
+TOOL_CALL = "tool_call"
+ANSWER = "answer"
+
+def classify_decision(text: str):
+    """
+    根据决策输出的开头判断它是工具调用还是直接回答，信息不足时返回 None。
+
+    以 `{` 或 `[` 开头，或者是内容以 `{` / `[` 开头的 ``` 代码块，视为工具调用；
+    其他任何开头都视为直接回答。
+    """
+    stripped = text.lstrip()
+    if not stripped:
+        return None
+    if stripped[0] in "{[":
+        return TOOL_CALL
+    if not "```".startswith(stripped[:3]):
+        return ANSWER
+    if len(stripped) < 3:
+        return None
+    # 代码块：根据第一行 (语言标记) 之后的第一个非空字符判断
+    newline = stripped.find("\n")
+    if newline < 0:
+        return None
+    body = stripped[newline + 1:].lstrip()
+    if not body:
+        return None
+    return TOOL_CALL if body[0] in "{[" else ANSWER
+
+class StreamedDecision:
+    """
+    一次流式 Agent 决策。
+
+    工具调用的输出会被完整读入 `text`；直接回答只读取到足以判断类型的前缀，
+    剩余部分保留在上游流中，通过 `deltas` 继续逐个转发给客户端。
+    """
+
+    def __init__(self, kind: str, text: str, rest=None):
+        self.kind = kind
+        self.text = text
+        self._rest = rest
+
+    async def deltas(self):
+        """
+        产出完整的回答增量：先是已读取的前缀，然后是上游剩余的增量。
+        """
+        if self.text:
+            yield self.text
+        if self._rest is not None:
+            async for delta in self._rest:
+                yield delta
+
+    async def aclose(self):
+        """
+        关闭尚未读完的上游流。
+        """
+        if self._rest is not None:
+            await self._rest.aclose()
+
+async def read_decision(deltas) -> StreamedDecision:
+    """
+    读取流式决策输出，直到能判断其类型为止。
+
+    直接回答会在判断出类型后立即返回，不等待完整输出；工具调用则读完全部输出后返回，
+    以便解析 JSON。输出结束时仍无法判断的，按直接回答处理。
+    """
+    parts = []
+    async for delta in deltas:
+        parts.append(delta)
+        kind = classify_decision("".join(parts))
+        if kind == ANSWER:
+            return StreamedDecision(ANSWER, "".join(parts), deltas)
+        if kind == TOOL_CALL:
+            async for delta in deltas:
+                parts.append(delta)
+            return StreamedDecision(TOOL_CALL, "".join(parts))
+    return StreamedDecision(ANSWER, "".join(parts))
@@ -0,0 +1,207 @@
+import asyncio
+import math
+import re
+import zlib
+from collections import Counter
+from cache import ExpiringCache
+from search import normalize_query
+from tool_retrieval import lexical_terms
+from config import (
+    ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_BYTES, ANSWER_CACHE_SEMANTIC,
+    ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_VECTOR_DIM, ANSWER_CACHE_REPLAY_CHUNK, ANSWER_CACHE_REPLAY_INTERVAL_MS
+)
+
+# 语义层依赖可选的 NumPy，未安装时只使用精确匹配
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 与中文字符相邻的空白，例如 "什么是 Python" 中的空格
+_CJK_SPACE_PATTERN = re.compile(r"(?<=[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff])\s+|\s+(?=[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff])")
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    规范化问题文本作为缓存键：在搜索查询规范化的基础上，去掉中文字符两侧可有可无的空白。
+    """
+    return _CJK_SPACE_PATTERN.sub("", normalize_query(prompt))
+
+def hashed_vector(text: str, dim: int = ANSWER_CACHE_VECTOR_DIM):
+    """
+    把文本转换为 L2 归一化的哈希 n-gram 向量 (feature hashing)，不依赖外部模型。
+
+    词项与工具检索相同 (中文字符 bigram、英文单词)，每个词项按 crc32 哈希到一个维度，
+    哈希的最高位决定符号以抵消冲突，权重为 1 + log(词频)。没有任何词项时返回 None。
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for term, count in Counter(lexical_terms(text)).items():
+        digest = zlib.crc32(term.encode("utf-8"))
+        vector[digest % dim] += (1 + math.log(count)) * (1 if digest & 0x80000000 else -1)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+class SemanticIndex:
+    """
+    一个模型下已缓存问题的向量索引，按余弦相似度查找最接近的问题。
+
+    向量按行存放在预分配的矩阵中，一次矩阵乘法即可算出与所有问题的相似度；
+    矩阵按需倍增，最多 `capacity` 行。被删除的行清零后放回空闲列表复用。
+    """
+
+    def __init__(self, dim: int, capacity: int, initial: int = 64):
+        self.capacity = capacity
+        self._matrix = np.zeros((min(initial, capacity), dim), dtype=np.float32)
+        self._keys = [None] * len(self._matrix)
+        self._slots = {}  # 缓存键 -> 行号
+        self._free = list(range(len(self._matrix) - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _grow(self) -> bool:
+        size = len(self._matrix)
+        if size >= self.capacity:
+            return False
+        new_size = min(size * 2, self.capacity)
+        self._matrix = np.vstack([self._matrix, np.zeros((new_size - size, self._matrix.shape[1]), dtype=np.float32)])
+        self._keys.extend([None] * (new_size - size))
+        self._free.extend(range(new_size - 1, size - 1, -1))
+        return True
+
+    def add(self, key, vector, alive):
+        """
+        添加或替换一个问题的向量。索引已满时，先移除 alive(key) 为假 (已被缓存淘汰) 的条目。
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            if not self._free and not self._grow():
+                for stale in [k for k in self._slots if not alive(k)]:
+                    self.remove(stale)
+            if not self._free:
+                return
+            slot = self._free.pop()
+            self._slots[key] = slot
+            self._keys[slot] = key
+        self._matrix[slot] = vector
+
+    def remove(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._matrix[slot] = 0
+            self._keys[slot] = None
+            self._free.append(slot)
+
+    def matches(self, vector, threshold: float) -> list:
+        """
+        返回余弦相似度不低于 threshold 的 (缓存键, 余弦相似度) 列表，按相似度从高到低排列。
+        """
+        if not self._slots:
+            return []
+        scores = self._matrix @ vector
+        slots = np.flatnonzero(scores >= threshold)
+        slots = slots[np.argsort(-scores[slots], kind="stable")]
+        return [(self._keys[slot], float(scores[slot])) for slot in slots if self._keys[slot] is not None]
+
+class AnswerCache:
+    """
+    无状态问答 (新会话的第一轮、不联网、非 Agent 模式) 的回答缓存，位于大模型之前。
+
+    - 精确层：键为 (模型, 规范化后的问题)，只在大小写、全半角、空白或结尾标点上不同的问题共享条目；
+    - 语义层 (默认关闭，需要 ANSWER_CACHE_SEMANTIC=true 和 NumPy)：精确层未命中时，用哈希 n-gram 向量查找同一模型下余弦相似度不低于
+      `similarity` 的已缓存问题，复用其中最相似、且回答仍在缓存中的一个。
+
+    回答在 `ttl` 秒后过期，条目数和总字节数超过上限时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, ttl: float = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_bytes: int = ANSWER_CACHE_MAX_BYTES, semantic: bool = ANSWER_CACHE_SEMANTIC,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, dim: int = ANSWER_CACHE_VECTOR_DIM):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.dim = dim
+        self._answers = ExpiringCache(max_entries, max_bytes, sizeof=lambda answer: len(answer.encode("utf-8")))
+        if semantic and np is None:
+            print("ANSWER_CACHE_SEMANTIC 已开启，但未安装 NumPy，回答缓存的语义匹配不可用，只使用精确匹配。"
+                  "请执行 pip install -r requirements.txt 安装依赖。")
+        # 模型 -> SemanticIndex；为 None 时不启用语义层
+        self._indexes = {} if semantic and np is not None else None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def lookup(self, model: str, prompt: str):
+        """
+        查找一个问题的缓存回答，未命中时返回 None。
+        """
+        normalized = normalize_prompt(prompt)
+        answer = self._answers.get((model, normalized))
+        if answer is not None:
+            self.exact_hits += 1
+            return answer
+        index = self._indexes.get(model) if self._indexes is not None else None
+        if index is not None:
+            vector = hashed_vector(normalized, self.dim)
+            matches = index.matches(vector, self.similarity) if vector is not None else []
+            for key, score in matches:
+                answer = self._answers.get(key)
+                if answer is not None:
+                    self.semantic_hits += 1
+                    print(f"回答缓存语义命中 (相似度 {score:.3f}): {key[1]}")
+                    return answer
+                # 对应的回答已过期或被淘汰：移除向量，继续尝试次相似的问题
+                index.remove(key)
+        self.misses += 1
+        return None
+
+    def store(self, model: str, prompt: str, answer: str):
+        """
+        缓存一个完整生成的回答。
+        """
+        if not self.enabled or not answer:
+            return
+        normalized = normalize_prompt(prompt)
+        key = (model, normalized)
+        self._answers.set(key, answer, self.ttl)
+        if self._indexes is not None:
+            vector = hashed_vector(normalized, self.dim)
+            if vector is not None:
+                index = self._indexes.get(model)
+                if index is None:
+                    index = self._indexes[model] = SemanticIndex(self.dim, self.max_entries)
+                index.add(key, vector, alive=lambda k: k in self._answers)
+
+    def clear(self):
+        self._answers.clear()
+        if self._indexes is not None:
+            self._indexes.clear()
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        cache_stats = self._answers.stats()
+        return {
+            "entries": cache_stats["entries"],
+            "bytes": cache_stats["bytes"],
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+            "semantic": self._indexes is not None,
+        }
+
+answer_cache = AnswerCache()
+
+async def replay_answer(answer: str, chunk: int = ANSWER_CACHE_REPLAY_CHUNK,
+                        interval_ms: int = ANSWER_CACHE_REPLAY_INTERVAL_MS):
+    """
+    把缓存的回答按固定节奏切分为文本增量，模拟大模型的流式输出。
+    """
+    chunk = max(chunk, 1)
+    for start in range(0, len(answer), chunk):
+        if start and interval_ms > 0:
+            await asyncio.sleep(interval_ms / 1000)
+        yield answer[start:start + chunk]
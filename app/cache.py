@@ -0,0 +1,175 @@
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    一个按条目数和总字节数双重限制的 LRU 缓存。
+
+    Args:
+        max_entries (int): 最多缓存的条目数。
+        max_bytes (int): 所有条目的总大小上限，为 None 时不限制。
+        sizeof (callable): 计算单个值大小 (字节) 的函数，默认每个值按 0 字节计算。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int = None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()  # key -> (value, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        读取一个条目并将其标记为最近使用，同时更新命中/未命中计数。
+        """
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def peek(self, key, default=None):
+        """
+        读取一个条目，但不改变其 LRU 顺序，也不计入命中统计。
+        """
+        item = self._data.get(key)
+        return default if item is None else item[0]
+
+    def set(self, key, value):
+        """
+        写入或更新一个条目。对已缓存的可变对象做了原地修改后，
+        也应再次调用此方法以重新计算其大小。
+        """
+        self.pop(key)
+        size = self.sizeof(value)
+        self._data[key] = (value, size)
+        self.total_bytes += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        """
+        删除并返回一个条目。
+        """
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.total_bytes -= item[1]
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+        self.total_bytes = 0
+
+    def _evict(self):
+        # 淘汰最久未使用的条目，直到满足条目数和字节数限制 (至少保留最新写入的一条)
+        while len(self._data) > 1 and (
+            len(self._data) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self.total_bytes -= size
+
+    def stats(self) -> dict:
+        """
+        返回缓存的统计信息，供 metrics 接口使用。
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class TTLCache(LRUCache):
+    """
+    带过期时间的 LRU 缓存，支持 stale-while-revalidate。
+
+    条目写入后 `ttl` 秒内为新鲜状态；之后的 `stale_ttl` 秒内仍可返回，但会被标记为过期 (stale)，
+    由调用方决定是否在后台刷新；超过 ttl + stale_ttl 的条目视为不存在。
+    时间使用 time.time()，因此持久化到磁盘的条目在重启后依然可以正确判断新旧。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, stale_ttl: float = 0, max_bytes: int = None, sizeof=None):
+        value_sizeof = sizeof or (lambda value: 0)
+        super().__init__(max_entries, max_bytes, sizeof=lambda item: value_sizeof(item[0]))
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stale_hits = 0
+
+    def lookup(self, key):
+        """
+        查找一个条目。
+
+        Returns:
+            tuple: (值, 是否已过期)；条目不存在或已彻底失效时返回 None。
+        """
+        item = self.peek(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, stored_at = item
+        age = time.time() - stored_at
+        if age >= self.ttl + self.stale_ttl:
+            self.pop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        stale = age >= self.ttl
+        if stale:
+            self.stale_hits += 1
+        return value, stale
+
+    def set(self, key, value, stored_at: float = None):
+        super().set(key, (value, stored_at if stored_at is not None else time.time()))
+
+    def items(self) -> list:
+        """
+        返回所有条目的 (键, 值, 写入时间) 列表，按从旧到新排列，用于持久化。
+        """
+        return [(key, value, stored_at) for key, ((value, stored_at), _) in self._data.items()]
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["stale_hits"] = self.stale_hits
+        return stats
+
+class ExpiringCache(LRUCache):
+    """
+    每个条目拥有独立过期时间的 LRU 缓存，过期的条目在读取时被删除。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int = None, sizeof=None):
+        value_sizeof = sizeof or (lambda value: 0)
+        super().__init__(max_entries, max_bytes, sizeof=lambda item: value_sizeof(item[0]))
+
+    def get(self, key, default=None):
+        item = self.peek(key)
+        if item is not None and time.time() >= item[1]:
+            self.pop(key)
+        item = super().get(key)
+        return default if item is None else item[0]
+
+    def set(self, key, value, ttl: float):
+        super().set(key, (value, time.time() + ttl))
+
+    def purge(self, predicate=None) -> int:
+        """
+        删除所有满足 predicate(key) 的条目 (不传时清空缓存)，返回删除的条目数。
+        """
+        keys = [key for key in self._data if predicate is None or predicate(key)]
+        for key in keys:
+            self.pop(key)
+        return len(keys)
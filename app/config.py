@@ -0,0 +1,156 @@
+import os
+from dotenv import load_dotenv
+
+# 尝试从 .env 文件加载环境变量。
+# 如果 .env 文件不存在，此函数会静默地跳过，
+# 程序将继续从系统级的环境变量中读取配置。
+# 这使得应用既方便本地开发（使用.env），又能无缝部署。
+# 所有模块统一从这里读取配置，保证 load_dotenv 在任何配置被读取之前执行。
+load_dotenv()
+
+# 大模型配置
+API_KEY = os.getenv("ZHIPUAI_API_KEY")
+BASE_URL = os.getenv("ZHIPUAI_BASE_URL")
+MODEL_NAME = os.getenv("MODEL_NAME")
+
+# 网络搜索配置
+BOCHAAI_SEARCH_API_KEY = os.getenv("BOCHAAI_SEARCH_API_KEY")
+
+# 每个大模型端点同时进行的请求数上限 (LLM_ENDPOINTS 中未指定 max_concurrency 时的默认值)。
+# 所有可用端点都达到上限时，请求会在协程中排队等待，而不会阻塞事件循环。
+LLM_MAX_CONCURRENT_STREAMS = int(os.getenv("LLM_MAX_CONCURRENT_STREAMS", "200"))
+
+# SSE 帧合并参数：在时间窗口 (毫秒) 内或达到字节上限前到达的增量会被合并为一帧发送。
+# 将窗口设置为 0 可关闭合并，每个增量单独成帧。
+SSE_COALESCE_WINDOW_MS = int(os.getenv("SSE_COALESCE_WINDOW_MS", "30"))
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "2048"))
+# 上游增量与 SSE 输出之间的缓冲队列长度；客户端读取变慢时，队列满后暂停读取上游。
+SSE_QUEUE_MAX_SIZE = int(os.getenv("SSE_QUEUE_MAX_SIZE", "256"))
+
+# 检测 SSE 客户端是否断开连接的轮询间隔 (毫秒)
+DISCONNECT_POLL_INTERVAL_MS = int(os.getenv("DISCONNECT_POLL_INTERVAL_MS", "250"))
+
+# 对话历史的 token 预算：超出预算的较早轮次会被折叠进滚动摘要
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# 滚动摘要的目标长度 (token)
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "500"))
+
+# 会话历史内存缓存 (LRU) 的条目数上限和总字节数上限
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "1000"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# SQLite 数据库配置
+DB_PATH = os.getenv("DB_PATH", "chat_history.db")
+# 连接池大小，同时也是执行数据库操作的线程池大小
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# 每个连接的内存映射 I/O 大小 (字节) 和预编译语句缓存条数
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+# 聊天记录批量持久化：攒够 PERSISTENCE_BATCH_SIZE 条或等待 PERSISTENCE_FLUSH_INTERVAL_MS 毫秒后，
+# 在同一个事务中一次性写入。
+PERSISTENCE_BATCH_SIZE = int(os.getenv("PERSISTENCE_BATCH_SIZE", "64"))
+PERSISTENCE_FLUSH_INTERVAL_MS = int(os.getenv("PERSISTENCE_FLUSH_INTERVAL_MS", "50"))
+# 持久化模式:
+# - "batched": 请求等待自己所在的批次提交后才结束 (组提交，默认)
+# - "async":   请求提交记录后立即返回，由后台异步写入，应用关闭时统一刷盘
+PERSISTENCE_MODE = os.getenv("PERSISTENCE_MODE", "batched")
+
+# 网络搜索 HTTP 客户端：长连接池、HTTP/2、超时 (秒) 与带抖动的重试
+SEARCH_HTTP2 = os.getenv("SEARCH_HTTP2", "true").lower() == "true"
+SEARCH_MAX_CONNECTIONS = int(os.getenv("SEARCH_MAX_CONNECTIONS", "100"))
+SEARCH_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("SEARCH_MAX_KEEPALIVE_CONNECTIONS", "20"))
+SEARCH_KEEPALIVE_EXPIRY = float(os.getenv("SEARCH_KEEPALIVE_EXPIRY", "60"))
+SEARCH_CONNECT_TIMEOUT = float(os.getenv("SEARCH_CONNECT_TIMEOUT", "5"))
+SEARCH_READ_TIMEOUT = float(os.getenv("SEARCH_READ_TIMEOUT", "30"))
+SEARCH_MAX_RETRIES = int(os.getenv("SEARCH_MAX_RETRIES", "2"))
+SEARCH_RETRY_BACKOFF_MS = int(os.getenv("SEARCH_RETRY_BACKOFF_MS", "200"))
+
+# 网络搜索结果缓存：新鲜期 (秒)、过期后仍可返回并在后台刷新的时长 (秒)、条目数和字节数上限。
+# SEARCH_CACHE_PATH 非空时，缓存会在关闭时写入该文件并在启动时加载。
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_STALE_TTL = int(os.getenv("SEARCH_CACHE_STALE_TTL", "3000"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2000"))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "")
+
+# 注入提示词的网络搜索结果的 token 预算，以及最多保留的结果条数
+SEARCH_CONTEXT_TOKEN_BUDGET = int(os.getenv("SEARCH_CONTEXT_TOKEN_BUDGET", "1500"))
+SEARCH_CONTEXT_MAX_RESULTS = int(os.getenv("SEARCH_CONTEXT_MAX_RESULTS", "6"))
+
+# MCP 客户端会话池：最多保持的长连接会话数、空闲多久 (秒) 后关闭、
+# 单个服务器上同时进行的调用数上限、空闲超过多久 (秒) 的会话在复用前先 ping 检查，以及建立会话的超时 (秒)
+MCP_POOL_MAX_SESSIONS = int(os.getenv("MCP_POOL_MAX_SESSIONS", "32"))
+MCP_SESSION_IDLE_TIMEOUT = float(os.getenv("MCP_SESSION_IDLE_TIMEOUT", "300"))
+MCP_SERVER_MAX_CONCURRENCY = int(os.getenv("MCP_SERVER_MAX_CONCURRENCY", "8"))
+MCP_HEALTH_CHECK_AFTER = float(os.getenv("MCP_HEALTH_CHECK_AFTER", "30"))
+MCP_CONNECT_TIMEOUT = float(os.getenv("MCP_CONNECT_TIMEOUT", "10"))
+
+# Agent 模式的工具检索：每个请求最多放入提示词的工具数，以及工具被选中所需的最低 BM25 得分。
+# 已注册的工具不超过 TOOL_RETRIEVAL_TOP_K 个时不做检索，全部放入提示词。
+TOOL_RETRIEVAL_TOP_K = int(os.getenv("TOOL_RETRIEVAL_TOP_K", "8"))
+TOOL_RETRIEVAL_MIN_SCORE = float(os.getenv("TOOL_RETRIEVAL_MIN_SCORE", "0"))
+
+# Agent 模式单次决策最多执行的工具调用数，以及每个工具调用的超时 (秒)
+AGENT_MAX_TOOL_CALLS = int(os.getenv("AGENT_MAX_TOOL_CALLS", "5"))
+MCP_TOOL_TIMEOUT = float(os.getenv("MCP_TOOL_TIMEOUT", "30"))
+
+# MCP 工具结果缓存的条目数和总字节数上限。各工具的缓存时间在注册服务器时通过 tool_cache_ttls 配置
+TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "1000"))
+TOOL_CACHE_MAX_BYTES = int(os.getenv("TOOL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# 单个流式请求的端到端时间预算 (毫秒)。客户端可以通过 deadline_ms 查询参数指定，但不能超过上限。
+# 搜索、Agent 决策和工具调用等准备阶段会为最终回答预留 ANSWER_RESERVE_MS 毫秒 (最多预留剩余预算的一半)，
+# 准备阶段超时后会被跳过或降级，而不是让整个请求失败。
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "60000"))
+REQUEST_DEADLINE_MAX_MS = int(os.getenv("REQUEST_DEADLINE_MAX_MS", "300000"))
+ANSWER_RESERVE_MS = int(os.getenv("ANSWER_RESERVE_MS", "15000"))
+
+# 无状态问答 (新会话、不联网、非 Agent 模式) 的回答缓存。ANSWER_CACHE_TTL 为 0 时关闭缓存。
+# 语义层用哈希 n-gram 向量匹配近似问题，默认关闭，需要设置 ANSWER_CACHE_SEMANTIC=true 显式开启；
+# 它依赖 NumPy (已列入 requirements.txt)，开启但缺少 NumPy 时只使用精确匹配。
+# 命中的回答按每帧 ANSWER_CACHE_REPLAY_CHUNK 个字符、间隔 ANSWER_CACHE_REPLAY_INTERVAL_MS 毫秒回放。
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "false").lower() == "true"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.9"))
+ANSWER_CACHE_VECTOR_DIM = int(os.getenv("ANSWER_CACHE_VECTOR_DIM", "1024"))
+ANSWER_CACHE_REPLAY_CHUNK = int(os.getenv("ANSWER_CACHE_REPLAY_CHUNK", "8"))
+ANSWER_CACHE_REPLAY_INTERVAL_MS = int(os.getenv("ANSWER_CACHE_REPLAY_INTERVAL_MS", "10"))
+
+# 多个 OpenAI 兼容的大模型端点，JSON 数组，每项形如
+# {"name": "backup", "base_url": "...", "api_key": "...", "weight": 1, "max_concurrency": 100, "models": ["glm-4-flash"]}
+# 除 base_url 外均可省略：api_key 默认为 ZHIPUAI_API_KEY，max_concurrency 默认为 LLM_MAX_CONCURRENT_STREAMS，
+# models 为空表示该端点可以服务任意模型。未配置时只使用 ZHIPUAI_BASE_URL 一个端点。
+LLM_ENDPOINTS = os.getenv("LLM_ENDPOINTS", "")
+# 端点连续失败 (出错或首 token 慢于 LLM_SLOW_FIRST_TOKEN_MS) 达到次数后，暂停使用一段时间 (秒)
+LLM_EJECT_AFTER_FAILURES = int(os.getenv("LLM_EJECT_AFTER_FAILURES", "3"))
+LLM_EJECT_SECONDS = float(os.getenv("LLM_EJECT_SECONDS", "30"))
+LLM_SLOW_FIRST_TOKEN_MS = int(os.getenv("LLM_SLOW_FIRST_TOKEN_MS", "5000"))
+# 一次调用最多尝试的端点数 (出错后换端点重试)
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "2"))
+# 首 token 超过该时间 (毫秒) 仍未到达时，向另一个端点发出对冲请求，采用先返回的一个。0 表示不对冲
+LLM_HEDGE_AFTER_MS = int(os.getenv("LLM_HEDGE_AFTER_MS", "0"))
+
+# 按调用用途选择模型，未设置时都使用 MODEL_NAME：
+# Agent 工具选择 (DECISION_MODEL)、工具调用后的最终回答 (ANSWER_MODEL)、普通对话 (CHAT_MODEL)、历史摘要 (SUMMARY_MODEL)
+DECISION_MODEL = os.getenv("DECISION_MODEL") or MODEL_NAME
+ANSWER_MODEL = os.getenv("ANSWER_MODEL") or MODEL_NAME
+CHAT_MODEL = os.getenv("CHAT_MODEL") or MODEL_NAME
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL") or MODEL_NAME
+# 设置 FAST_MODEL 后，不超过 SIMPLE_QUESTION_MAX_CHARS 个字符的简单首轮问题改用该模型回答。留空表示不启用
+FAST_MODEL = os.getenv("FAST_MODEL", "")
+SIMPLE_QUESTION_MAX_CHARS = int(os.getenv("SIMPLE_QUESTION_MAX_CHARS", "30"))
+
+# /api/stream 的准入控制：同时处理的请求总数上限，以及普通对话、联网搜索、Agent 模式各自的上限。
+# 超出上限的请求进入容量为 ADMISSION_QUEUE_SIZE 的等待队列，按会话 (或客户端 IP) 轮流调度；
+# 排队超过 ADMISSION_QUEUE_TIMEOUT 秒 (且不超过请求的时间预算) 后放弃。
+# 队列已满时直接返回 429，并通过 Retry-After 建议客户端在 ADMISSION_RETRY_AFTER 秒后重试。
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", "100"))
+ADMISSION_MAX_PLAIN = int(os.getenv("ADMISSION_MAX_PLAIN", "100"))
+ADMISSION_MAX_SEARCH = int(os.getenv("ADMISSION_MAX_SEARCH", "50"))
+ADMISSION_MAX_AGENT = int(os.getenv("ADMISSION_MAX_AGENT", "30"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "200"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
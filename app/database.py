@@ -1,44 +1,168 @@
+import asyncio
 import sqlite3
-import threading
-from fastapi import Request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from config import DB_PATH, DB_POOL_SIZE, DB_MMAP_SIZE, DB_CACHED_STATEMENTS
 
-# 使用线程本地存储来管理数据库连接，确保每个线程都有独立的连接
-thread_local = threading.local()
-
-def get_db_connection():
+def _open_connection() -> sqlite3.Connection:
     """
-    获取当前线程的数据库连接。
-    如果连接不存在，则创建一个新的连接并存储在线程本地存储中。
+    创建一个新连接，并应用所有连接都需要的通用设置。
     """
-    db = getattr(thread_local, '_database', None)
-    if db is None:
-        db = thread_local._database = sqlite3.connect('chat_history.db', check_same_thread=False)
-        db.row_factory = sqlite3.Row  # 设置 row_factory 以便将行作为类似字典的对象访问
+    # check_same_thread=False: 连接会在线程池的不同线程中使用，由 AsyncConnection 保证同一时刻只有一个线程访问
+    # cached_statements: 缓存预编译语句，高频 SQL 无需重复解析
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    db.row_factory = sqlite3.Row  # 设置 row_factory 以便将行作为类似字典的对象访问
+    db.execute("PRAGMA foreign_keys = ON")  # SQLite 默认不启用外键约束，需按连接开启
+    # WAL 模式下 synchronous=NORMAL 仍能保证数据库一致性，只在提交时省去多余的 fsync
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
     return db
 
-def close_db_connection(exception=None):
+class AsyncConnection:
     """
-    关闭当前线程的数据库连接。
+    从连接池借出的一个数据库连接的异步包装。
+
+    所有 SQL 都在连接池的线程池中执行，不会阻塞事件循环。
+    同一个连接上的操作通过锁串行执行，保证 sqlite3 连接不会被多个线程同时使用。
     """
-    db = getattr(thread_local, '_database', None)
-    if db is not None:
-        db.close()
-        thread_local._database = None
 
-def get_db(request: Request) -> sqlite3.Connection:
+    def __init__(self, pool: "ConnectionPool", conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+        self._lock = asyncio.Lock()
+
+    async def run(self, fn, *args):
+        """
+        在数据库线程中执行 fn(*args)。
+        即使调用方被取消，也会等线程中的操作结束后才释放连接，避免连接被并发使用。
+        """
+        async with self._lock:
+            future = asyncio.get_running_loop().run_in_executor(self._pool.executor, fn, *args)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                await asyncio.wait([future])
+                raise
+
+    async def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        """
+        执行一条 SQL，返回的游标可用于读取 rowcount / lastrowid。
+        """
+        return await self.run(self._conn.execute, sql, params)
+
+    async def executemany(self, sql: str, seq_of_params) -> sqlite3.Cursor:
+        return await self.run(self._conn.executemany, sql, seq_of_params)
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        return await self.run(lambda: self._conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.run(lambda: self._conn.execute(sql, params).fetchone())
+
+    async def commit(self):
+        await self.run(self._conn.commit)
+
+    async def rollback(self):
+        await self.run(self._conn.rollback)
+
+class ConnectionPool:
+    """
+    SQLite 连接池。
+
+    连接在第一次需要时创建，用完后放回池中复用；池的大小同时限制了并发的数据库操作数，
+    执行 SQL 的线程池与之等大。
+    """
+
+    def __init__(self, size: int = DB_POOL_SIZE):
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite")
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle = []
+
+    async def acquire(self) -> AsyncConnection:
+        """
+        从池中借出一个连接，池已耗尽时异步等待。
+        """
+        await self._semaphore.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            conn = await asyncio.get_running_loop().run_in_executor(self.executor, _open_connection)
+            return AsyncConnection(self, conn)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def release(self, conn: AsyncConnection):
+        """
+        归还一个连接。未提交的事务会被回滚，避免把脏状态留给下一个使用者。
+        """
+        try:
+            if conn._conn.in_transaction:
+                await conn.rollback()
+            self._idle.append(conn)
+        except sqlite3.Error:
+            conn._conn.close()
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        以上下文管理器的方式借出连接，退出时自动归还。
+        """
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    async def run(self, fn, *args):
+        """
+        借出一个连接，在数据库线程中执行 fn(conn, *args) 并提交；出错时回滚。
+        适合把一组相关的 SQL 放在同一个事务中完成。
+        """
+        def transaction(conn: sqlite3.Connection):
+            try:
+                result = fn(conn, *args)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+
+        async with self.connection() as conn:
+            return await conn.run(transaction, conn._conn)
+
+    def close(self):
+        """
+        关闭所有空闲连接和线程池，在应用关闭时调用。
+        """
+        while self._idle:
+            self._idle.pop()._conn.close()
+        self.executor.shutdown(wait=True)
+
+# 进程内唯一的数据库连接池
+db_pool = ConnectionPool()
+
+async def get_db():
     """
     FastAPI 依赖项，用于在路由处理函数中获取数据库连接。
-    它从请求状态中获取由中间件创建的连接。
+
+    连接是惰性获取的：只有声明了该依赖的路由才会从连接池借出连接，
+    静态文件、页面和健康检查等请求完全不接触数据库。响应完成后连接自动归还连接池。
     """
-    return request.state.db
+    conn = await db_pool.acquire()
+    try:
+        yield conn
+    finally:
+        await db_pool.release(conn)
 
-def init_db():
+def _migration_base_schema(cursor: sqlite3.Cursor):
     """
-    初始化数据库，创建所需的表。
+    迁移 1: 创建基础表结构。
+    使用 IF NOT EXISTS，因此对引入迁移机制之前创建的旧数据库同样安全。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # 创建聊天会话表
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS chat_sessions (
@@ -61,6 +185,18 @@ def init_db():
     )
     ''')
     
+    # 创建会话滚动摘要表
+    # summarized_count 记录该会话中已经被折叠进摘要的最早消息条数
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS session_summaries (
+        session_id TEXT PRIMARY KEY,
+        content TEXT,
+        summarized_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+    )
+    ''')
+    
     # 创建 MCP 服务器表
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS mcp_servers (
@@ -99,16 +235,193 @@ def init_db():
         create_time INTEGER -- 使用 unixepoch 时间戳
     )
     ''')
-    
-    conn.commit()
+
+def _create_indexes(cursor: sqlite3.Cursor):
+    # 重建表会连带删除索引，因此索引的创建单独抽出，供多个迁移复用
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON chat_sessions (updated_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mcp_tools_server_id ON mcp_tools (server_id)")
+
+def _migration_add_indexes(cursor: sqlite3.Cursor):
+    """
+    迁移 2: 为按会话读取消息、按更新时间排序会话等高频查询添加索引。
+    (session_id, id) 复合索引让读取一个会话的消息既不需要全表扫描，也不需要额外排序，
+    并且按自增 id 排序可以保证同一秒内写入的消息顺序稳定。
+    """
+    _create_indexes(cursor)
+
+def _rebuild_table(cursor: sqlite3.Cursor, table: str, create_sql: str, select_sql: str):
+    """
+    SQLite 不支持修改列定义和外键，只能按 "新建表 -> 复制数据 -> 删除旧表 -> 重命名" 的方式重建。
+    create_sql 中的表名应为 {table}，select_sql 负责从旧表中选出与新表列顺序一致的数据。
+    """
+    cursor.execute(create_sql.format(table=f"{table}_new"))
+    cursor.execute(f"INSERT INTO {table}_new {select_sql}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def _migration_cascade_deletes(cursor: sqlite3.Cursor):
+    """
+    迁移 3: 为子表的外键添加 ON DELETE CASCADE，
+    删除会话或 MCP 服务器时，由数据库自动清理其消息、摘要和工具。
+    """
+    _rebuild_table(cursor, "messages", '''
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        role TEXT,
+        content TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE
+    )
+    ''', "SELECT id, session_id, role, content, created_at FROM messages")
+    _rebuild_table(cursor, "session_summaries", '''
+    CREATE TABLE {table} (
+        session_id TEXT PRIMARY KEY,
+        content TEXT,
+        summarized_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE
+    )
+    ''', "SELECT session_id, content, summarized_count, updated_at FROM session_summaries")
+    _rebuild_table(cursor, "mcp_tools", '''
+    CREATE TABLE {table} (
+        id TEXT PRIMARY KEY,
+        server_id TEXT,
+        name TEXT NOT NULL,
+        description TEXT,
+        input_schema TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (server_id) REFERENCES mcp_servers (id) ON DELETE CASCADE
+    )
+    ''', "SELECT id, server_id, name, description, input_schema, created_at FROM mcp_tools")
+    _create_indexes(cursor)
+
+# 将旧的 'YYYY-MM-DD HH:MM:SS' 本地时间文本转换为 UTC 秒级时间戳
+# (无法解析的旧值使用迁移时的当前时间代替)
+_TO_EPOCH = "COALESCE(CAST(strftime('%s', {column}, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))"
+_NOW_EPOCH = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+def _migration_epoch_timestamps(cursor: sqlite3.Cursor):
+    """
+    迁移 4: 将所有 created_at / updated_at 列从秒级精度的文本改为整数 Unix 时间戳，
+    与 orders.create_time 保持一致，比较和排序时无需再解析字符串。
+    """
+    created, updated = _TO_EPOCH.format(column="created_at"), _TO_EPOCH.format(column="updated_at")
+    _rebuild_table(cursor, "chat_sessions", f'''
+    CREATE TABLE {{table}} (
+        id TEXT PRIMARY KEY,
+        summary TEXT,
+        created_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+        updated_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH}
+    )
+    ''', f"SELECT id, summary, {created}, {updated} FROM chat_sessions")
+    _rebuild_table(cursor, "messages", f'''
+    CREATE TABLE {{table}} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        role TEXT,
+        content TEXT,
+        created_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+        FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE
+    )
+    ''', f"SELECT id, session_id, role, content, {created} FROM messages")
+    _rebuild_table(cursor, "session_summaries", f'''
+    CREATE TABLE {{table}} (
+        session_id TEXT PRIMARY KEY,
+        content TEXT,
+        summarized_count INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+        FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE
+    )
+    ''', f"SELECT session_id, content, summarized_count, {updated} FROM session_summaries")
+    _rebuild_table(cursor, "mcp_servers", f'''
+    CREATE TABLE {{table}} (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        url TEXT NOT NULL,
+        description TEXT,
+        auth_type TEXT,
+        auth_value TEXT,
+        created_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+        updated_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH}
+    )
+    ''', f"SELECT id, name, url, description, auth_type, auth_value, {created}, {updated} FROM mcp_servers")
+    _rebuild_table(cursor, "mcp_tools", f'''
+    CREATE TABLE {{table}} (
+        id TEXT PRIMARY KEY,
+        server_id TEXT,
+        name TEXT NOT NULL,
+        description TEXT,
+        input_schema TEXT,
+        created_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+        FOREIGN KEY (server_id) REFERENCES mcp_servers (id) ON DELETE CASCADE
+    )
+    ''', f"SELECT id, server_id, name, description, input_schema, {created} FROM mcp_tools")
+    _create_indexes(cursor)
+
+def _migration_tool_cache_ttls(cursor: sqlite3.Cursor):
+    """
+    迁移 5: 为 MCP 服务器添加工具结果缓存配置，
+    内容为 JSON 对象 {工具名: 缓存秒数}，"*" 表示该服务器其余工具的默认值，缺省表示不缓存。
+    """
+    cursor.execute("ALTER TABLE mcp_servers ADD COLUMN tool_cache_ttls TEXT NOT NULL DEFAULT '{}'")
+
+# 按版本号排列的数据库迁移列表。
+# 数据库当前的版本号保存在 PRAGMA user_version 中，启动时只会执行版本号更高的迁移。
+# 新的表结构变更只能追加到列表末尾，不能修改已经发布的迁移。
+MIGRATIONS = [
+    (1, "创建基础表结构", _migration_base_schema),
+    (2, "为消息和会话添加索引", _migration_add_indexes),
+    (3, "外键级联删除", _migration_cascade_deletes),
+    (4, "时间戳改为整数 Unix 时间", _migration_epoch_timestamps),
+    (5, "MCP 工具结果缓存配置", _migration_tool_cache_ttls),
+]
+
+def run_migrations(conn: sqlite3.Connection):
+    """
+    依次执行所有尚未应用的迁移，每个迁移在独立的事务中完成。
+    """
+    current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    pending = [m for m in MIGRATIONS if m[0] > current_version]
+    if not pending:
+        return
+
+    # 重建表期间必须关闭外键检查，否则删除旧表会触发级联删除。
+    # 该 PRAGMA 在事务内无效，所以要在 BEGIN 之前设置。
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for version, description, migrate in pending:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            try:
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            print(f"已应用数据库迁移 {version}: {description}")
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.isolation_level = isolation_level
+
+def init_db(conn: sqlite3.Connection):
+    """
+    初始化数据库：启用 WAL 模式并执行所有待应用的表结构迁移。
+    """
+    # WAL 模式是持久化在数据库文件中的，设置一次即可；它允许读写并发进行
+    conn.execute("PRAGMA journal_mode = WAL")
+    run_migrations(conn)
     print("数据库初始化完成")
 
-def insert_sample_data():
+def insert_sample_data(conn: sqlite3.Connection):
     """
     向数据库中插入一些示例订单数据，以便于测试。
     只有在订单表为空时才插入数据，防止重复。
     """
-    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查 orders 表是否已有数据
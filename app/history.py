@@ -0,0 +1,219 @@
+import asyncio
+import time
+from cache import LRUCache
+from config import HISTORY_TOKEN_BUDGET, HISTORY_SUMMARY_TOKENS, SESSION_CACHE_MAX_ENTRIES, SESSION_CACHE_MAX_BYTES
+from database import AsyncConnection, db_pool
+from llm import complete_chat
+from model_router import model_for, PURPOSE_SUMMARY
+from tokens import estimate_message_tokens
+
+class SessionHistory:
+    """
+    一个会话在内存中的历史记录：滚动摘要，以及尚未折叠进摘要的消息列表。
+    """
+
+    def __init__(self, summary: str = "", summarized_count: int = 0, messages: list = None):
+        self.summary = summary
+        self.summarized_count = summarized_count
+        self.messages = messages or []
+        self.nbytes = len(summary.encode("utf-8")) + sum(len(m["content"].encode("utf-8")) for m in self.messages)
+
+    def append(self, role: str, content: str):
+        self.messages.append({"role": role, "content": content})
+        self.nbytes += len(content.encode("utf-8"))
+
+    def fold(self, summary: str, count: int):
+        """
+        把最早的 count 条消息替换为新的滚动摘要。
+        """
+        self.nbytes -= len(self.summary.encode("utf-8")) + sum(len(m["content"].encode("utf-8")) for m in self.messages[:count])
+        self.messages = self.messages[count:]
+        self.summarized_count += count
+        self.summary = summary
+        self.nbytes += len(summary.encode("utf-8"))
+
+# 进程内的会话历史缓存，键为 session_id。
+# 由 main.py 中的写入函数同步更新 (write-through)，活跃会话读取历史时无需访问 SQLite。
+session_history_cache = LRUCache(
+    max_entries=SESSION_CACHE_MAX_ENTRIES,
+    max_bytes=SESSION_CACHE_MAX_BYTES,
+    sizeof=lambda entry: entry.nbytes
+)
+
+# 正在后台更新摘要的会话，避免同一会话并发生成摘要
+_summarizing = set()
+# 持有后台任务的引用，防止任务在完成前被垃圾回收
+_background_tasks = set()
+
+async def load_session_summary(db: AsyncConnection, session_id: str) -> tuple:
+    """
+    读取会话的滚动摘要。
+
+    Returns:
+        tuple: (摘要内容, 已折叠进摘要的消息条数)，没有摘要时返回 ("", 0)。
+    """
+    row = await db.fetchone("SELECT content, summarized_count FROM session_summaries WHERE session_id = ?", (session_id,))
+    if not row:
+        return "", 0
+    return row["content"] or "", row["summarized_count"]
+
+async def load_unsummarized_messages(db: AsyncConnection, session_id: str, offset: int) -> list:
+    """
+    按写入顺序读取会话中尚未被折叠进摘要的消息。
+    """
+    rows = await db.fetchall(
+        "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id ASC LIMIT -1 OFFSET ?",
+        (session_id, offset)
+    )
+    return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+def select_window_start(messages: list, budget: int) -> int:
+    """
+    从最新的消息开始向前累加 token，返回预算内能保留的最早消息下标。
+    窗口总是从用户消息开始，避免出现没有提问的孤立回答。
+    """
+    used = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        cost = estimate_message_tokens(messages[i])
+        if used + cost > budget:
+            break
+        used += cost
+        start = i
+    while start < len(messages) and messages[start]["role"] != "user":
+        start += 1
+    return start
+
+def _window_budget(budget: int) -> int:
+    # 为滚动摘要预留固定的空间，保证构建窗口和折叠摘要时使用同一个边界
+    return max(budget - HISTORY_SUMMARY_TOKENS, 0)
+
+async def get_session_history(session_id: str) -> SessionHistory:
+    """
+    获取会话历史，优先从内存缓存读取，未命中时从数据库加载并放入缓存。
+    """
+    entry = session_history_cache.get(session_id)
+    if entry is None:
+        async with db_pool.connection() as db:
+            summary, summarized_count = await load_session_summary(db, session_id)
+            messages = await load_unsummarized_messages(db, session_id, summarized_count)
+        # 加载期间其他请求可能已经写入了更新的条目，此时以缓存中的为准
+        entry = session_history_cache.peek(session_id)
+        if entry is None:
+            entry = SessionHistory(summary, summarized_count, messages)
+            session_history_cache.set(session_id, entry)
+    return entry
+
+def start_cached_session(session_id: str):
+    """
+    为刚创建的新会话放入一个空的缓存条目，后续写入的消息会直接追加到其中。
+    """
+    session_history_cache.set(session_id, SessionHistory())
+
+def append_cached_message(session_id: str, role: str, content: str):
+    """
+    消息写入数据库后同步更新缓存 (write-through)。会话不在缓存中时无需处理，
+    下次读取时会从数据库完整加载。
+    """
+    entry = session_history_cache.peek(session_id)
+    if entry is not None:
+        entry.append(role, content)
+        session_history_cache.set(session_id, entry)
+
+def invalidate_cached_session(session_id: str):
+    """
+    会话被删除后，从缓存中移除。
+    """
+    session_history_cache.pop(session_id)
+
+async def build_history(session_id: str, budget: int = HISTORY_TOKEN_BUDGET) -> list:
+    """
+    为一个已有会话构建发送给大模型的历史消息。
+
+    只使用尚未折叠进摘要的消息，在预算内保留最近的若干轮对话；
+    更早的内容以一条系统消息的形式由滚动摘要代替。
+    """
+    entry = await get_session_history(session_id)
+    start = select_window_start(entry.messages, _window_budget(budget))
+
+    history = []
+    if entry.summary:
+        history.append({"role": "system", "content": f"此前对话的摘要: {entry.summary}"})
+    history.extend(entry.messages[start:])
+    return history
+
+async def _summarize(previous_summary: str, messages: list) -> str:
+    """
+    把新滑出窗口的对话增量合并进已有摘要。
+    """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = (
+        f"请将以下新增对话合并进已有摘要，生成一份不超过 {HISTORY_SUMMARY_TOKENS} 字的新摘要。"
+        "保留关键事实、用户的偏好与约束以及尚未解决的问题，只输出摘要本身。\n\n"
+        f"已有摘要:\n{previous_summary or '无'}\n\n"
+        f"新增对话:\n{transcript}"
+    )
+    return (await complete_chat([{"role": "user", "content": prompt}], model_for(PURPOSE_SUMMARY))).strip()
+
+async def update_rolling_summary(session_id: str, budget: int = HISTORY_TOKEN_BUDGET):
+    """
+    如果会话中有消息已经滑出 token 窗口，把它们增量地折叠进滚动摘要。
+    每次只处理新滑出的消息，已有摘要不会被重新生成。
+    窗口根据缓存中的会话历史计算，只有真正写入新摘要时才访问数据库。
+    """
+    entry = await get_session_history(session_id)
+    start = select_window_start(entry.messages, _window_budget(budget))
+    if start == 0:
+        return
+    summary, summarized_count = entry.summary, entry.summarized_count
+    folded = entry.messages[:start]
+
+    # 调用大模型生成摘要期间不占用数据库连接
+    new_summary = await _summarize(summary, folded)
+    async with db_pool.connection() as db:
+        await db.execute(
+            """
+            INSERT INTO session_summaries (session_id, content, summarized_count, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                content = excluded.content,
+                summarized_count = excluded.summarized_count,
+                updated_at = excluded.updated_at
+            """,
+            (session_id, new_summary, summarized_count + start, int(time.time()))
+        )
+        await db.commit()
+
+    # 同步更新缓存；如果缓存条目在此期间被重新加载过，则直接丢弃，下次读取时重新加载
+    entry = session_history_cache.peek(session_id)
+    if entry is not None:
+        if entry.summarized_count == summarized_count:
+            entry.fold(new_summary, start)
+            session_history_cache.set(session_id, entry)
+        else:
+            invalidate_cached_session(session_id)
+    print(f"会话 {session_id} 的滚动摘要已更新，新折叠 {start} 条消息。")
+
+def schedule_summary_update(session_id: str):
+    """
+    在后台更新会话的滚动摘要，不阻塞当前请求。
+    """
+    if session_id in _summarizing:
+        return
+    # 缓存中的会话仍在窗口之内时无需创建后台任务
+    entry = session_history_cache.peek(session_id)
+    if entry is not None and select_window_start(entry.messages, _window_budget(HISTORY_TOKEN_BUDGET)) == 0:
+        return
+
+    async def run():
+        try:
+            await update_rolling_summary(session_id)
+        except Exception as e:
+            print(f"更新会话 {session_id} 的滚动摘要时出错: {e}")
+        finally:
+            _summarizing.discard(session_id)
+
+    _summarizing.add(session_id)
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,33 @@
+from config import MODEL_NAME
+from request_scope import Deadline
+from singleflight import StreamFanout
+from llm_pool import llm_pool
+
+def stream_chat_completion(messages: list, model: str = MODEL_NAME, deadline: Deadline = None):
+    """
+    以流式方式调用大模型，返回逐个产出文本增量的异步生成器。
+
+    调用由 `llm_pool` 分配到负载最低的健康端点，首 token 之前出错会换端点重试，
+    配置了对冲时首 token 过慢会向另一个端点发出对冲请求。
+    整个读取过程都使用 `async for`，等待上游 token 时会把控制权交还给事件循环。
+    指定 deadline 时，建立连接和每次读取的超时都不超过剩余的时间预算。
+    """
+    return llm_pool.stream(model, messages, deadline)
+
+# 合并同时进行的相同生成请求，共享同一个上游流
+answer_streams = StreamFanout()
+
+def shared_chat_completion(key, messages: list, model: str = MODEL_NAME):
+    """
+    与 `stream_chat_completion` 相同，但 (model, key) 相同的同时进行的调用共享一个上游流。
+
+    key 由调用方给出，必须能唯一确定 messages 的内容 (例如无状态请求规范化后的问题)。
+    共享的上游流不受单个订阅者的 deadline 限制，订阅者应当各自限制等待时间。
+    """
+    return answer_streams.subscribe((model, key), lambda: stream_chat_completion(messages, model))
+
+async def complete_chat(messages: list, model: str = MODEL_NAME) -> str:
+    """
+    以非流式方式调用大模型，返回完整的回答文本。
+    """
+    return await llm_pool.complete(model, messages)
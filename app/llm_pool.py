@@ -0,0 +1,346 @@
+import asyncio
+import json
+import time
+import openai
+from openai import AsyncOpenAI
+from config import (
+    API_KEY, BASE_URL, LLM_MAX_CONCURRENT_STREAMS, LLM_ENDPOINTS, LLM_EJECT_AFTER_FAILURES, LLM_EJECT_SECONDS,
+    LLM_SLOW_FIRST_TOKEN_MS, LLM_MAX_ATTEMPTS, LLM_HEDGE_AFTER_MS
+)
+from request_scope import Deadline
+
+def is_retryable(error: Exception) -> bool:
+    """
+    判断一次调用失败后是否值得换一个端点重试。
+
+    网络错误、超时、限流、鉴权和服务端错误可能只与当前端点有关；
+    请求本身有问题的错误 (400、404、422) 在其他端点上也会失败，不重试。
+    """
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code not in (400, 404, 422)
+    return isinstance(error, (openai.APIError, OSError, asyncio.TimeoutError))
+
+async def _content_deltas(client: AsyncOpenAI, model: str, messages: list, options: dict):
+    """
+    打开一个流式调用并逐个产出文本增量，结束或被提前关闭时释放上游 HTTP 连接。
+    """
+    response = await client.chat.completions.create(model=model, messages=messages, stream=True, **options)
+    try:
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                yield content
+    finally:
+        await response.close()
+
+class LLMEndpoint:
+    """
+    一个 OpenAI 兼容的大模型端点及其运行状态。
+
+    连续失败 (出错或首 token 过慢) 达到 `eject_after` 次后，端点被暂停使用 `eject_seconds` 秒。
+    """
+
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0,
+                 max_concurrency: int = LLM_MAX_CONCURRENT_STREAMS, models: list = None,
+                 eject_after: int = LLM_EJECT_AFTER_FAILURES, eject_seconds: float = LLM_EJECT_SECONDS,
+                 slow_first_token_ms: int = LLM_SLOW_FIRST_TOKEN_MS):
+        self.name = name
+        # 失败后的重试由端点池换端点完成，客户端自身不再重试
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.models = set(models or ())
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.slow_first_token_ms = slow_first_token_ms
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ttft_ms = None  # 首 token 延迟的指数移动平均
+
+    def serves(self, model: str) -> bool:
+        return not self.models or model in self.models
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def full(self) -> bool:
+        return self.outstanding >= self.max_concurrency
+
+    def record_first_token(self, elapsed_ms: float):
+        self.ttft_ms = elapsed_ms if self.ttft_ms is None else 0.8 * self.ttft_ms + 0.2 * elapsed_ms
+        if elapsed_ms > self.slow_first_token_ms:
+            self.record_failure(f"首 token 耗时 {elapsed_ms:.0f}ms")
+        else:
+            self.consecutive_failures = 0
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self, reason: str):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.eject_after:
+            self.consecutive_failures = 0
+            self.ejected_until = time.monotonic() + self.eject_seconds
+            self.ejections += 1
+            print(f"大模型端点 {self.name} 连续失败 ({reason})，暂停使用 {self.eject_seconds:g} 秒。")
+
+    def stats(self) -> dict:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "ejected": self.ejected,
+            "ttft_ms": round(self.ttft_ms, 1) if self.ttft_ms is not None else None,
+        }
+
+def load_endpoints(value: str = LLM_ENDPOINTS) -> list:
+    """
+    根据 LLM_ENDPOINTS 创建端点列表；未配置时只使用 ZHIPUAI_BASE_URL 一个端点。
+
+    Raises:
+        ValueError: 配置不是合法的端点数组。
+    """
+    if not value.strip():
+        return [LLMEndpoint("default", BASE_URL, API_KEY)]
+    try:
+        specs = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"LLM_ENDPOINTS 不是合法的 JSON: {e}")
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("LLM_ENDPOINTS 必须是非空的 JSON 数组")
+    endpoints = []
+    for index, spec in enumerate(specs, start=1):
+        if not isinstance(spec, dict) or not spec.get("base_url"):
+            raise ValueError(f"LLM_ENDPOINTS 第 {index} 项缺少 base_url")
+        weight = float(spec.get("weight", 1))
+        max_concurrency = int(spec.get("max_concurrency", LLM_MAX_CONCURRENT_STREAMS))
+        if weight <= 0 or max_concurrency <= 0:
+            raise ValueError(f"LLM_ENDPOINTS 第 {index} 项的 weight 和 max_concurrency 必须大于 0")
+        endpoints.append(LLMEndpoint(
+            name=spec.get("name") or f"endpoint-{index}",
+            base_url=spec["base_url"],
+            api_key=spec.get("api_key") or API_KEY,
+            weight=weight,
+            max_concurrency=max_concurrency,
+            models=spec.get("models")
+        ))
+    return endpoints
+
+class LLMEndpointPool:
+    """
+    在多个大模型端点之间分配调用。
+
+    - 选择端点时，在能服务该模型、未被暂停且未达到并发上限的端点中，
+      选择 (进行中的调用数 + 1) / 权重 最小的一个；全部达到上限时排队等待；
+    - 建立连接或首 token 之前出错时，换一个端点重试，最多尝试 `max_attempts` 个端点；
+    - `hedge_after_ms` 大于 0 时，首 token 超过该时间仍未到达，就向另一个空闲端点发出对冲请求，
+      采用先返回首 token 的一个，另一个立即取消。
+    """
+
+    def __init__(self, endpoints: list, max_attempts: int = LLM_MAX_ATTEMPTS, hedge_after_ms: int = LLM_HEDGE_AFTER_MS):
+        self.endpoints = endpoints
+        self.max_attempts = max(max_attempts, 1)
+        self.hedge_after = max(hedge_after_ms, 0) / 1000
+        # 有端点释放并发名额时置位，唤醒排队等待的调用
+        self._released = asyncio.Event()
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _serving(self, model: str) -> list:
+        endpoints = [endpoint for endpoint in self.endpoints if endpoint.serves(model)]
+        if not endpoints:
+            raise ValueError(f"没有可以服务模型 {model} 的大模型端点")
+        return endpoints
+
+    def _pick(self, candidates: list):
+        available = [endpoint for endpoint in candidates if not endpoint.full]
+        if not available:
+            return None
+        endpoint = min(available, key=lambda endpoint: (endpoint.outstanding + 1) / endpoint.weight)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    async def acquire(self, model: str, exclude: list = ()) -> LLMEndpoint:
+        """
+        借出一个端点的并发名额。优先选择未尝试过且未被暂停的端点，没有时退而使用其他端点。
+        """
+        while True:
+            serving = self._serving(model)
+            fresh = [endpoint for endpoint in serving if endpoint not in exclude] or serving
+            candidates = [endpoint for endpoint in fresh if not endpoint.ejected] or fresh
+            endpoint = self._pick(candidates)
+            if endpoint is not None:
+                return endpoint
+            self._released.clear()
+            await self._released.wait()
+
+    def try_acquire(self, model: str, exclude: list = ()):
+        """
+        立即借出一个未尝试过、未被暂停且有空闲名额的端点，没有时返回 None。用于对冲请求。
+        """
+        candidates = [
+            endpoint for endpoint in self._serving(model)
+            if endpoint not in exclude and not endpoint.ejected
+        ]
+        return self._pick(candidates)
+
+    def release(self, endpoint: LLMEndpoint):
+        endpoint.outstanding -= 1
+        self._released.set()
+
+    async def _open(self, endpoint: LLMEndpoint, model: str, messages: list, options: dict):
+        """
+        在一个端点上打开流式调用并等待首个文本增量，返回 (首个增量, 剩余增量的异步生成器)。
+        """
+        started = time.monotonic()
+        deltas = _content_deltas(endpoint.client, model, messages, options)
+        try:
+            first = await deltas.__anext__()
+        except StopAsyncIteration:
+            first = ""
+        except BaseException:
+            await deltas.aclose()
+            raise
+        endpoint.record_first_token((time.monotonic() - started) * 1000)
+        return first, deltas
+
+    async def _race(self, model: str, messages: list, options: dict):
+        """
+        按需换端点重试或发出对冲请求，返回最先拿到首 token 的 (端点, 首个增量, 剩余增量)。
+        """
+        tried = []
+        pending = {}  # 任务 -> (端点, 开始时间)
+        hedged = False
+        hedge_task = None
+        last_error = None
+
+        def launch(endpoint: LLMEndpoint):
+            tried.append(endpoint)
+            task = asyncio.create_task(self._open(endpoint, model, messages, options))
+            pending[task] = (endpoint, time.monotonic())
+            return task
+
+        try:
+            launch(await self.acquire(model))
+            while True:
+                timeout = None
+                if self.hedge_after and not hedged:
+                    oldest = min(started for _, started in pending.values())
+                    timeout = max(oldest + self.hedge_after - time.monotonic(), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 首 token 迟迟未到，向另一个端点发出对冲请求 (每次调用最多一次)
+                    hedged = True
+                    endpoint = self.try_acquire(model, tried)
+                    if endpoint is not None:
+                        self.hedges += 1
+                        print(f"首 token 超过 {self.hedge_after * 1000:.0f}ms 未到达，向端点 {endpoint.name} 发出对冲请求。")
+                        hedge_task = launch(endpoint)
+                    continue
+                winner = None
+                fatal = None
+                for task in done:
+                    endpoint, _ = pending.pop(task)
+                    error = task.exception()
+                    if error is None and winner is None:
+                        winner = (endpoint, *task.result())
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                        continue
+                    self.release(endpoint)
+                    if error is None:
+                        # 两个请求同时拿到了首 token，关闭多余的一个
+                        await task.result()[1].aclose()
+                        continue
+                    if not is_retryable(error):
+                        fatal = error
+                        continue
+                    endpoint.record_failure(repr(error))
+                    last_error = error
+                if winner is not None:
+                    return winner
+                if fatal is not None:
+                    raise fatal
+                if not pending:
+                    if len(tried) >= self.max_attempts:
+                        raise last_error
+                    self.failovers += 1
+                    print(f"大模型端点 {tried[-1].name} 调用失败 ({last_error!r})，换一个端点重试...")
+                    launch(await self.acquire(model, tried))
+        finally:
+            # 取消未胜出的请求并归还它们的名额；等待过久的请求按首 token 过慢计为失败
+            for task in pending:
+                task.cancel()
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            for (endpoint, started), result in zip(pending.values(), results):
+                if isinstance(result, tuple):
+                    await result[1].aclose()
+                elif (time.monotonic() - started) * 1000 > endpoint.slow_first_token_ms:
+                    endpoint.record_failure("首 token 超时")
+                self.release(endpoint)
+
+    async def stream(self, model: str, messages: list, deadline: Deadline = None):
+        """
+        以流式方式调用大模型，逐个产出文本增量。
+        指定 deadline 时，每个端点上建立连接和每次读取的超时都不超过剩余的时间预算。
+        """
+        options = {"timeout": deadline.timeout()} if deadline is not None else {}
+        endpoint, first, deltas = await self._race(model, messages, options)
+        try:
+            if first:
+                yield first
+            async for delta in deltas:
+                yield delta
+            endpoint.record_success()
+        except Exception as e:
+            endpoint.record_failure(repr(e))
+            raise
+        finally:
+            await deltas.aclose()
+            self.release(endpoint)
+
+    async def complete(self, model: str, messages: list) -> str:
+        """
+        以非流式方式调用大模型，返回完整的回答文本。出错时换一个端点重试。
+        """
+        tried = []
+        while True:
+            endpoint = await self.acquire(model, tried)
+            tried.append(endpoint)
+            try:
+                response = await endpoint.client.chat.completions.create(model=model, messages=messages)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                endpoint.record_failure(repr(e))
+                if len(tried) >= self.max_attempts:
+                    raise
+                self.failovers += 1
+                print(f"大模型端点 {endpoint.name} 调用失败 ({e!r})，换一个端点重试...")
+                continue
+            finally:
+                self.release(endpoint)
+            endpoint.record_success()
+            return response.choices[0].message.content or ""
+
+    def stats(self) -> dict:
+        return {
+            "endpoints": {endpoint.name: endpoint.stats() for endpoint in self.endpoints},
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+llm_pool = LLMEndpointPool(load_endpoints())
@@ -1,54 +1,59 @@
 from fastapi import FastAPI, Request, HTTPException, Query, Depends
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from openai import OpenAI
-from openai import AsyncOpenAI
-import os
 import json
 import uuid
-import httpx # 导入 httpx 用于异步 HTTP 请求
 import urllib.parse
-from datetime import datetime
 import asyncio
-import sqlite3
 from contextlib import asynccontextmanager # 导入 asynccontextmanager
 from mcp_api import router as mcp_router # 仅导入 MCP 路由
-from fastmcp import Client
-from fastmcp.client.transports import SSETransport
-from dotenv import load_dotenv
-from database import get_db_connection, close_db_connection, init_db, insert_sample_data, get_db # 导入 get_db
+from config import API_KEY, BASE_URL, MODEL_NAME, LLM_ENDPOINTS, AGENT_MAX_TOOL_CALLS, MCP_TOOL_TIMEOUT, ANSWER_RESERVE_MS, ADMISSION_QUEUE_TIMEOUT # 配置统一由 config.py 加载
+from llm import stream_chat_completion, shared_chat_completion, answer_streams
+from llm_pool import llm_pool
+from admission import admission_controller, AdmissionRejected, AdmittedStreamingResponse, PLAIN, SEARCH, AGENT
+from model_router import model_for, chat_route, record_route, route_counts, PURPOSE_MODELS, PURPOSE_DECISION, PURPOSE_ANSWER
+from search import perform_web_search, search_flights, format_search_context, WebSearchError, init_search_client, close_search_client, load_search_cache, save_search_cache, search_cache
+from sse import SSEWriter, encode_event
+from request_scope import DisconnectWatcher, ClientDisconnected, PARTIAL_RESPONSE_MARKER, Deadline, DeadlineExceeded, DEADLINE_MARKER
+from pipeline import RequestPipeline, stage_stats
+from database import AsyncConnection, db_pool, init_db, insert_sample_data, get_db # 导入 get_db
+from persistence import TurnRecord, persistence_queue
+from tool_registry import tool_registry
+from mcp_pool import mcp_session_pool
+from tool_cache import tool_result_cache, tool_cache_key
+from answer_cache import answer_cache, replay_answer, normalize_prompt
+from agent_decision import StreamedDecision, read_decision, TOOL_CALL, ANSWER
+from history import build_history, schedule_summary_update, start_cached_session, append_cached_message, invalidate_cached_session, session_history_cache
 
 
-# 尝试从 .env 文件加载环境变量。
-# 如果 .env 文件不存在，此函数会静默地跳过，
-# 程序将继续从系统级的环境变量中读取配置。
-# 这使得应用既方便本地开发（使用.env），又能无缝部署。
-load_dotenv()
-
-# 从环境变量中获取配置
-API_KEY = os.getenv("ZHIPUAI_API_KEY")
-BASE_URL= os.getenv("ZHIPUAI_BASE_URL")
-MODEL_NAME = os.getenv("MODEL_NAME")
- 
-BOCHAAI_SEARCH_API_KEY = os.getenv("BOCHAAI_SEARCH_API_KEY")
-
 # 检查关键配置是否存在
-if not all([API_KEY, BASE_URL, MODEL_NAME]):
-    raise ValueError("关键环境变量 (ZHIPUAI_API_KEY, ZHIPUAI_BASE_URL, MODEL_NAME) 未设置。请检查您的 .env 文件或系统环境变量。")
+if not MODEL_NAME or not (LLM_ENDPOINTS or (API_KEY and BASE_URL)):
+    raise ValueError("关键环境变量 (ZHIPUAI_API_KEY, ZHIPUAI_BASE_URL 或 LLM_ENDPOINTS, MODEL_NAME) 未设置。请检查您的 .env 文件或系统环境变量。")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     FastAPI 的 lifespan 事件处理器。
-    在应用启动时初始化数据库并插入示例数据。
+    在应用启动时初始化数据库、插入示例数据并创建共享资源 (持久化队列、搜索 HTTP 客户端、工具注册表、MCP 会话池)，
+    在应用关闭时按顺序释放它们。
     """
     # 应用启动时执行
     print("应用启动...")
-    init_db()
-    insert_sample_data()
+    await db_pool.run(init_db)
+    await db_pool.run(insert_sample_data)
+    persistence_queue.start()
+    init_search_client()
+    load_search_cache()
+    await tool_registry.snapshot()
+    mcp_session_pool.start()
     yield
-    # 应用关闭时执行 (如果需要可以添加关闭逻辑)
+    # 应用关闭时执行：先把尚未落盘的聊天记录写入数据库，再关闭连接池
+    await persistence_queue.stop()
+    await close_search_client()
+    await mcp_session_pool.close()
+    save_search_cache()
+    db_pool.close()
     print("应用关闭。")
 
 # Initialize FastAPI app
@@ -76,105 +81,27 @@ app.add_middleware(
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-@app.middleware("http")
-async def db_session_middleware(request: Request, call_next):
-    """
-    中间件，用于管理每个请求的数据库连接。
-    在请求开始时获取连接，在请求结束时关闭连接。
-    """
-    try:
-        request.state.db = get_db_connection()
-        response = await call_next(request)
-    finally:
-        close_db_connection()
-    return response
-
-# Initialize AI client
-ai_client = OpenAI(
-    api_key = API_KEY,
-    base_url = BASE_URL
-)
-
-async_ai_client = AsyncOpenAI(
-    api_key = API_KEY,
-    base_url = BASE_URL
-)
+# 持有后台任务的引用，防止任务在完成前被垃圾回收
+_background_tasks = set()
 
-# Perform web search (optional, retained for flexibility)
-# https://open.bochaai.com/overview
-async def perform_web_search(query: str):
+async def create_new_chat_session(session_id: str, query: str, response: str):
     """
-    执行网络搜索。
-    使用 httpx 异步请求 BochaAI 的搜索 API。
-    参考文档: https://bocha-ai.feishu.cn/wiki/RXEOw02rFiwzGSkd9mUcqoeAnNK
+    创建新的聊天会话并保存初始消息。
+    内存中的会话历史立即更新，数据库写入交给持久化队列批量完成。
     """
-    if not BOCHAAI_SEARCH_API_KEY:
-        return "BOCHAAI_SEARCH_API_KEY 未配置，无法执行网络搜索"
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {BOCHAAI_SEARCH_API_KEY}'
-    }
-    payload = {
-        "query": query,
-        "freshness": "noLimit",
-        "summary": True,
-        "count": 10
-    }
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post("https://api.bochaai.com/v1/web-search", headers=headers, json=payload, timeout=30.0)
-            response.raise_for_status()  # 如果状态码不是 2xx，则引发异常
-            json_data = response.json()
-            print(f"bochaai search response: {json_data}")
-            return str(json_data)
-        except httpx.HTTPStatusError as e:
-            return f"搜索失败，状态码: {e.response.status_code}, 响应: {e.response.text}"
-        except httpx.RequestError as e:
-            return f"执行网络搜索时出错: {str(e)}"
-        except json.JSONDecodeError as e:
-            return f"搜索结果JSON解析失败: {str(e)}"
-
-async def save_chat_message(db: sqlite3.Connection, session_id: str, role: str, content: str):
-    """
-    将单条聊天消息保存到数据库。
-    """
-    cursor = db.cursor()
-    cursor.execute(
-        "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-        (session_id, role, content, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    db.commit()
-
-async def create_new_chat_session(db: sqlite3.Connection, session_id: str, query: str, response: str):
+    start_cached_session(session_id)
+    append_cached_message(session_id, "user", query)
+    append_cached_message(session_id, "assistant", response)
+    await persistence_queue.submit(TurnRecord(session_id, query, response))
+
+async def add_message_to_session(session_id: str, query: str, response: str):
     """
-    创建新的聊天会话并保存初始消息。
+    向现有会话中添加用户和助手的消息，并更新会话的 updated_at 时间戳。
+    如果会话记录在数据库中不存在 (例如已被删除)，持久化队列会重新创建它。
     """
-    cursor = db.cursor()
-    summary = query[:50] + ("..." if len(query) > 50 else "")
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute(
-        "INSERT INTO chat_sessions (id, summary, created_at, updated_at) VALUES (?, ?, ?, ?)",
-        (session_id, summary, now, now)
-    )
-    await save_chat_message(db, session_id, "user", query)
-    await save_chat_message(db, session_id, "assistant", response)
-    db.commit()
-
-async def add_message_to_session(db: sqlite3.Connection, session_id: str, query: str, response: str):
-    """
-    向现有会话中添加用户和助手的消息。
-    """
-    await save_chat_message(db, session_id, "user", query)
-    await save_chat_message(db, session_id, "assistant", response)
-    # 更新会话的 updated_at 时间戳
-    cursor = db.cursor()
-    cursor.execute(
-        "UPDATE chat_sessions SET updated_at = ? WHERE id = ?",
-        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), session_id)
-    )
-    db.commit()
+    append_cached_message(session_id, "user", query)
+    append_cached_message(session_id, "assistant", response)
+    await persistence_queue.submit(TurnRecord(session_id, query, response))
 
 @app.get("/", include_in_schema=False)
 async def root():
@@ -190,261 +117,478 @@ async def mcp_management():
     """
     return FileResponse("static/mcp.html")
 
-async def process_stream_request(query: str, session_id: str = None, web_search: bool = False, agent_mode: bool = False):
+async def call_mcp_tool(server_id: str, url: str, tool_name: str, parameters: dict, cache_ttl: float = 0, timeout: float = None):
     """
-    处理流式聊天请求的核心逻辑。
-    注意: 此函数为异步生成器，独立管理数据库连接，以兼容 StreamingResponse。
+    通过会话池调用指定 MCP 服务器上的一个工具，返回工具的执行结果。
+    cache_ttl 大于 0 时，相同参数的调用结果会被缓存，缓存期内不再访问 MCP 服务器。
+    timeout 为等待 MCP 服务器响应的超时 (秒)。
     """
-    db = None
+    if cache_ttl > 0:
+        key = tool_cache_key(server_id, tool_name, parameters)
+        cached = tool_result_cache.get(key)
+        if cached is not None:
+            print(f"工具 {tool_name} 命中结果缓存。")
+            return cached
+    result = await mcp_session_pool.call_tool(server_id, url, tool_name, parameters, timeout)
+    if cache_ttl > 0:
+        tool_result_cache.set(key, result, cache_ttl)
+    return result
+
+def parse_tool_calls(decision: str, catalog) -> list:
+    """
+    从大模型的决策中解析出要执行的工具调用列表。
+
+    支持 `{"tool_calls": [...]}`、直接的调用列表，以及旧的单个 `{"tool_name", "parameters"}` 对象，
+    也能处理被 ```json 代码块包裹的输出。不存在的工具会被忽略，最多保留 AGENT_MAX_TOOL_CALLS 个调用。
+
+    Returns:
+        list: (工具字典, 参数字典) 列表；决策不是工具调用时返回空列表。
+    """
+    text = decision.strip()
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.startswith("json"):
+            text = text[4:]
     try:
-        # 为此流式请求独立创建数据库连接
-        db = sqlite3.connect('chat_history.db')
-        db.row_factory = sqlite3.Row
-        
-        # 确定是新会话还是现有会话
-        is_new_session = session_id is None
-        if is_new_session:
-            session_id = str(uuid.uuid4()) # 为新会话生成唯一ID
+        payload = json.loads(text)
+    except json.JSONDecodeError:
+        # 如果LLM的回答不是JSON，说明不需要工具
+        return []
+
+    if isinstance(payload, dict):
+        payload = payload.get("tool_calls", [payload])
+    if not isinstance(payload, list):
+        return []
+
+    calls = []
+    for item in payload[:AGENT_MAX_TOOL_CALLS]:
+        if not isinstance(item, dict):
+            continue
+        tool = catalog.by_name.get(item.get("tool_name"))
+        parameters = item.get("parameters")
+        if tool is not None and isinstance(parameters, dict):
+            calls.append((tool, parameters))
+    return calls
+
+async def run_tool_calls(calls: list, deadline: Deadline = None) -> list:
+    """
+    并发执行多个工具调用，总耗时取决于最慢的一个调用。
 
-        # 准备消息历史
-        history_messages = []
-        if not is_new_session:
-            cursor = db.cursor()
-            cursor.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY created_at ASC", (session_id,))
-            rows = cursor.fetchall()
-            for row in rows:
-                history_messages.append({"role": row["role"], "content": row["content"]})
+    每个调用有独立的超时 (MCP_TOOL_TIMEOUT，且不超过 deadline 的剩余预算)，单个调用失败或超时
+    不会影响其他调用，失败信息会作为该调用的结果返回，交给大模型在最终回答中说明。
 
-        # 根据是否启用网络搜索来构建上下文
-        if web_search:
-            print("正在执行网络搜索...")
-            web_results = await perform_web_search(query)
-            
-            # 检查网络搜索是否返回了已知的错误信息
-            error_prefixes = ["BOCHAAI_SEARCH_API_KEY 未配置", "搜索失败", "执行网络搜索时出错", "搜索结果JSON解析失败"]
-            if any(web_results.startswith(prefix) for prefix in error_prefixes):
-                print(f"网络搜索失败: {web_results}")
-                # 如果是错误，直接将错误信息作为消息返回给前端，并终止处理
-                yield f"data: {json.dumps({'content': f'网络搜索功能异常: {web_results}'})}\n\n"
-                yield f"data: {json.dumps({'event': 'done', 'session_id': session_id})}\n\n"
-                return # 终止生成器
+    Returns:
+        list: 与 calls 一一对应的 (工具名, 结果文本, 是否成功) 列表。
+    """
+    timeout = deadline.timeout(MCP_TOOL_TIMEOUT) if deadline is not None else MCP_TOOL_TIMEOUT
 
-            # 将搜索结果作为上下文，添加到历史消息的最前面
-            history_messages.insert(0, {"role": "system", "content": f"网络搜索结果: {web_results}"})
+    async def run_one(tool: dict, parameters: dict):
+        if timeout <= 0:
+            return tool['name'], "请求的时间预算已用完，未执行", False
+        try:
+            result = await asyncio.wait_for(
+                call_mcp_tool(tool['server_id'], tool['url'], tool['name'], parameters, tool.get('cache_ttl', 0), timeout),
+                timeout
+            )
+            return tool['name'], str(result), True
+        except asyncio.TimeoutError:
+            return tool['name'], f"调用超时 (超过 {timeout:.1f} 秒)", False
+        except Exception as e:
+            return tool['name'], f"调用失败: {e}", False
 
-        # 将当前用户查询添加到消息历史中
-        history_messages.append({"role": "user", "content": query})
+    return await asyncio.gather(*(run_one(tool, parameters) for tool, parameters in calls))
 
-        async def generate_simple_response():
+async def decide_tool_call(query: str, tools_stage, deadline: Deadline = None) -> StreamedDecision:
+    """
+    让大模型判断是否需要调用工具。只依赖工具列表，因此可以与历史加载、网络搜索并行执行。
+
+    决策以流式方式生成：一旦能判断出输出是直接回答，就立即返回，剩余内容由调用方逐个转发给客户端
+    (决策模型与对话模型不同时，调用方会改用对话模型重新回答)；
+    只有看起来是 JSON 工具调用的输出才会被完整读取。
+
+    提示词中只放入检索出的至多 TOOL_RETRIEVAL_TOP_K 个相关工具，其长度与已注册的工具总数无关。
+    没有与问题相关的工具时不调用大模型，返回 None。
+    """
+    catalog = await tools_stage
+    candidates = catalog.select(query)
+    if not candidates:
+        return None
+    print(f"为当前问题检索到 {len(candidates)}/{len(catalog)} 个候选工具: {[tool['name'] for tool in candidates]}")
+
+    # 构建 Prompt, 让 LLM 决定是否使用工具
+    agent_prompt = f"""
+    你是一个智能助手，能够理解用户的问题并决定是否需要调用外部工具来回答。
+    
+    可用工具列表:
+    {catalog.render(candidates)}
+    
+    用户问题: "{query}"
+
+    请判断是否需要以及使用哪些工具。如果需要，请仅返回一个 JSON 对象，格式如下：
+    {{
+      "tool_calls": [
+        {{ "tool_name": "工具名", "parameters": {{ "参数1": "值1", "参数2": "值2" }} }}
+      ]
+    }}
+    问题涉及多个相互独立的子问题时 (例如同时询问多个城市的天气)，可以在 tool_calls 中列出多个调用，
+    它们会被同时执行，最多 {AGENT_MAX_TOOL_CALLS} 个。
+    如果不需要任何工具，请直接回答用户的问题。
+    """
+
+    # 以流式方式调用 LLM，读取到足以判断决策类型为止
+    decision = await read_decision(stream_chat_completion([{"role": "user", "content": agent_prompt}], model_for(PURPOSE_DECISION), deadline))
+    if decision.kind == TOOL_CALL:
+        print(f"LLM决策: {decision.text}")
+    else:
+        print("LLM决策: 直接回答，开始流式输出。")
+    return decision
+
+async def process_stream_request(request: Request, query: str, session_id: str = None, web_search: bool = False, agent_mode: bool = False,
+                                 deadline: Deadline = None, no_cache: bool = False):
+    """
+    处理流式聊天请求的核心逻辑。
+    注意: 此函数为异步生成器，不依赖 get_db，而是在每个需要数据库的阶段
+    临时从连接池借出连接，避免在长时间的流式输出期间占用连接。
+
+    请求被拆分为若干阶段，由 `RequestPipeline` 按依赖关系调度：
+    历史加载、网络搜索和工具列表查询同时开始，Agent 决策在工具列表就绪后立即开始，
+    不必等待历史和搜索；最终回答在它依赖的阶段全部完成后开始流式输出。
+
+    客户端断开连接后，正在进行的大模型流、网络搜索和 MCP 工具调用都会被取消，
+    已生成的部分回答会带上 `PARTIAL_RESPONSE_MARKER` 标记保存。
+
+    整个请求共享一个截止时间 (`deadline`，未指定时使用服务端默认值)。准备阶段为最终回答预留时间，
+    超时后降级而不是失败：网络搜索超时则不使用搜索结果，Agent 决策超时则不使用工具直接回答，
+    工具调用超时则把超时信息交给大模型说明；最终回答超时时截断并带上 `DEADLINE_MARKER` 标记。
+
+    无状态的请求 (新会话、不联网、非 Agent 模式) 先查询回答缓存，命中时直接回放缓存的回答，
+    不调用大模型；未命中时，同时进行的相同问题共享一次大模型生成，各自保存自己的会话。
+    `no_cache` 为 True 时跳过缓存和共享生成。
+    """
+    if deadline is None:
+        deadline = Deadline.from_ms()
+    answer_reserve = ANSWER_RESERVE_MS / 1000
+    # 准备阶段 (网络搜索、Agent 决策) 共用的截止时间，为最终回答预留时间
+    prep_deadline = deadline.sub(reserve=answer_reserve)
+    # 确定是新会话还是现有会话
+    is_new_session = session_id is None
+    if is_new_session:
+        session_id = str(uuid.uuid4()) # 为新会话生成唯一ID
+    # 回答只取决于问题本身时，才能使用回答缓存和共享生成
+    stateless = not no_cache and is_new_session and not web_search and not agent_mode
+    cacheable = stateless and answer_cache.enabled
+    # 普通对话的模型：简单的首轮问题可以交给更快的模型。
+    # 这里只做选择 (回答缓存的键也用到它)，只有真正调用对话模型时才计入路由统计
+    route, model = chat_route(query, is_new_session)
+
+    async def save_turn(answer: str):
+        """
+        保存本轮问答到数据库。
+        """
+        if is_new_session:
+            await create_new_chat_session(session_id, query, answer)
+        else:
+            await add_message_to_session(session_id, query, answer)
+        # 对话变长后，在后台把滑出窗口的早期轮次折叠进滚动摘要
+        schedule_summary_update(session_id)
+
+    async def save_partial_turn(answer: str):
+        """
+        客户端断开后保存部分回答。
+        Starlette 发现断开后会直接取消整个响应任务，因此保存在独立的任务中进行，
+        并通过 asyncio.shield 等待，当前任务的取消不会打断写入。
+        """
+        task = asyncio.create_task(save_turn(answer))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        await asyncio.shield(task)
+
+    async with DisconnectWatcher(request) as watcher, RequestPipeline(watcher) as pipeline:
+        # 互不依赖的准备阶段同时启动
+        # 历史消息：在 token 预算内保留最近的轮次，更早的内容由滚动摘要代替
+        if not is_new_session:
+            pipeline.start("history", build_history(session_id))
+        if web_search:
+            print("正在执行网络搜索...")
+            pipeline.start("search", perform_web_search(query, deadline=prep_deadline), prep_deadline)
+        if agent_mode:
+            # 这里是主应用与 MCP API 模块的间接交互点：工具由 MCP 管理页面注册，
+            # 注册表在 mcp_api.py 变更服务器或工具时失效，平时直接返回缓存的快照
+            tools_stage = pipeline.start("tools", tool_registry.snapshot())
+
+            async def decide():
+                decision = await decide_tool_call(query, tools_stage, deadline)
+                if decision is not None:
+                    # 直接回答的剩余部分如果最终没有被转发 (例如网络搜索失败)，在请求结束时关闭上游流
+                    pipeline.defer(decision.aclose)
+                return decision
+
+            # Agent 决策只依赖工具列表，与历史加载、网络搜索并行
+            pipeline.start("decision", decide(), prep_deadline)
+
+        async def stream_answer(deltas, cache_model: str = None):
+            """
+            流式输出大模型的回答并在结束后保存。deltas 为产出文本增量的异步迭代器。
+            客户端中途断开时 (无论由 DisconnectWatcher 发现，还是 Starlette 取消或关闭了响应)，
+            保存已生成的部分回答并继续向上抛出原来的异常。
+            指定 cache_model 时，完整生成的回答会以该模型写入回答缓存 (被截断的回答不会)。
+            """
+            writer = SSEWriter()
+            try:
+                with pipeline.span("answer"):
+                    async for frame in watcher.iterate(writer.stream(deltas), deadline):
+                        if "first_token" not in pipeline.timings:
+                            pipeline.mark("first_token")
+                        yield frame
+            except (ClientDisconnected, asyncio.CancelledError, GeneratorExit):
+                await save_partial_turn(writer.text + PARTIAL_RESPONSE_MARKER)
+                raise
+            except DeadlineExceeded:
+                print(f"会话 {session_id} 的回答超出时间限制，已截断。")
+                yield encode_event({'content': DEADLINE_MARKER})
+                await save_turn(writer.text + DEADLINE_MARKER)
+                return
+            await save_turn(writer.text)
+            if cache_model:
+                answer_cache.store(cache_model, query, writer.text)
+            print(f"完整响应: {writer.text}")
+
+        async def generate_simple_response(history_messages: list):
             """
             生成简单的文本响应（无工具调用）。
             """
-            response_stream = ai_client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=history_messages,
-                stream=True
-            )
-            
-            full_response = ""
-            for chunk in response_stream:
-                content = chunk.choices[0].delta.content or ""
-                full_response += content
-                yield f"data: {json.dumps({'content': content})}\n\n"
-                await asyncio.sleep(0.01)
-            
-            if is_new_session:
-                await create_new_chat_session(db, session_id, query, full_response)
+            if cacheable:
+                cached = answer_cache.lookup(model, query)
+                if cached is not None:
+                    pipeline.mark("answer_cache_hit")
+                    async for frame in stream_answer(replay_answer(cached)):
+                        yield frame
+                    return
+            record_route(route, model)
+            if stateless:
+                deltas = shared_chat_completion(normalize_prompt(query), history_messages, model)
             else:
-                await add_message_to_session(db, session_id, query, full_response)
-                
-            print(f"完整响应: {full_response}")
+                deltas = stream_chat_completion(history_messages, model, deadline)
+            async for frame in stream_answer(deltas, model if cacheable else None):
+                yield frame
 
-        async def generate_with_tools():
+        async def generate_with_tools(history_messages: list):
             """
-            使用工具生成响应。
+            使用工具生成响应。没有与问题相关的工具时，按普通对话流式回答。
             """
             print("进入 Agent 模式...")
-            # 这里是主应用与 MCP API 模块的间接交互点。
-            # Agent 模式启动后，首先从数据库中查询所有通过 MCP 管理页面注册的工具。
-            # 这些工具数据是由 mcp_api.py 中的接口负责写入和管理的。
-            cursor = db.cursor()
-            cursor.execute("SELECT t.*, s.url FROM mcp_tools t JOIN mcp_servers s ON t.server_id = s.id")
-            tools = [dict(row) for row in cursor.fetchall()]
-            
-            if not tools:
-                yield f"data: {json.dumps({'content': '没有可用的工具。'})}\n\n"
+            catalog = await pipeline.result("tools")
+            if not catalog:
+                yield encode_event({'content': '没有可用的工具。'})
                 return
 
-            tool_descriptions = "\n".join([
-                f"- 工具名: {tool['name']}\n  描述: {tool['description']}\n  输入格式: {tool['input_schema']}"
-                for tool in tools
-            ])
-
-            # 2. 构建 Prompt, 让 LLM 决定是否使用工具
-            agent_prompt = f"""
-            你是一个智能助手，能够理解用户的问题并决定是否需要调用外部工具来回答。
-            
-            可用工具列表:
-            {tool_descriptions}
-            
-            用户问题: "{query}"
-
-            请判断是否需要以及使用哪个工具。如果需要，请仅返回一个 JSON 对象，格式如下：
-            {{
-              "tool_name": "工具名",
-              "parameters": {{ "参数1": "值1", "参数2": "值2" }}
-            }}
-            如果不需要任何工具，请直接回答用户的问题。
-            """
-            
             try:
-                # 3. 调用 LLM (使用异步客户端)
-                response = await async_ai_client.chat.completions.create(
-                    model=MODEL_NAME,
-                    messages=[{"role": "user", "content": agent_prompt}],
-                    # 部分模型支持强制JSON输出，可以提高稳定性
-                    # response_format={"type": "json_object"} 
-                )
-                decision = response.choices[0].message.content.strip()
-                print(f"LLM决策: {decision}")
-
-                # 4. 解析决策并执行工具
                 try:
-                    decision_json = json.loads(decision)
-                    tool_name = decision_json.get("tool_name")
-                    parameters = decision_json.get("parameters")
-                    
-                    # 寻找要调用的工具
-                    target_tool = next((t for t in tools if t['name'] == tool_name), None)
-
-                    if target_tool and parameters is not None:
-                        # 调用工具
-                        async with Client(SSETransport(target_tool['url'])) as client: 
-                            tool_result = await client.call_tool(tool_name, parameters)
-                        
-                        # 5. 将工具结果交给 LLM 进行最终回答
-                        final_prompt = f"工具 {tool_name} 的执行结果是: {tool_result}\n\n请基于这个结果，回答用户最初的问题: '{query}'"
-                        final_stream = ai_client.chat.completions.create(
-                            model=MODEL_NAME,
-                            messages=[{"role": "user", "content": final_prompt}],
-                            stream=True
-                        )
-                        final_answer = ""
-                        for chunk in final_stream:
-                            content = chunk.choices[0].delta.content or ""
-                            final_answer += content
-                            yield f"data: {json.dumps({'content': content})}\n\n"
-                        
-                    else: # 如果LLM返回了JSON但格式不正确
-                        final_answer = decision
-                        yield f"data: {json.dumps({'content': decision})}\n\n"
-
-                except (json.JSONDecodeError, AttributeError):
-                    # 如果LLM的回答不是JSON，直接作为最终答案
-                    final_answer = decision
-                    yield f"data: {json.dumps({'content': decision})}\n\n"
-
-                # 6. 保存最终的问答到数据库
-                if is_new_session:
-                    await create_new_chat_session(db, session_id, query, final_answer)
+                    decision = await pipeline.result("decision")
+                    if decision is None:
+                        print("没有与问题相关的工具，按普通对话回答。")
+                except DeadlineExceeded:
+                    print("Agent 决策超出时间预算，不使用工具，按普通对话回答。")
+                    decision = None
+                if decision is None:
+                    record_route(route, model)
+                    async for frame in stream_answer(stream_chat_completion(history_messages, model, deadline)):
+                        yield frame
+                    return
+
+                if decision.kind == ANSWER:
+                    if PURPOSE_MODELS[PURPOSE_DECISION] == model:
+                        # 大模型选择直接回答：边生成边转发，首字延迟与普通模式相同
+                        deltas = decision.deltas()
+                    else:
+                        # 决策模型与对话模型不同 (例如使用更小的决策模型)：放弃决策的输出，改用对话模型回答
+                        await decision.aclose()
+                        record_route(route, model)
+                        deltas = stream_chat_completion(history_messages, model, deadline)
+                    async for frame in stream_answer(deltas):
+                        yield frame
+                    return
+
+                # 解析决策并并发执行所有工具调用
+                calls = parse_tool_calls(decision.text, catalog)
+                if calls:
+                    results = await pipeline.run("tool_calls", run_tool_calls(calls, deadline.sub(reserve=answer_reserve)))
+                    for tool_name, result, ok in results:
+                        print(f"工具 {tool_name} {'执行成功' if ok else '执行失败'}: {result[:200]}")
+
+                    # 将所有工具结果交给 LLM 进行最终回答，并保存最终的问答到数据库
+                    results_text = "\n\n".join(
+                        f"[{i}] 工具 {tool_name} 的执行结果是: {result}"
+                        for i, (tool_name, result, _) in enumerate(results, start=1)
+                    )
+                    final_prompt = f"{results_text}\n\n请基于这些结果，回答用户最初的问题: '{query}'。如果某个工具调用失败，请说明对应部分无法回答。"
+                    async for frame in stream_answer(stream_chat_completion([{"role": "user", "content": final_prompt}], model_for(PURPOSE_ANSWER), deadline)):
+                        yield frame
                 else:
-                    await add_message_to_session(db, session_id, query, final_answer)
-
+                    # LLM返回的JSON格式不正确或没有可执行的调用，直接将决策内容作为最终答案
+                    print(f"无法从 Agent 决策中解析出可执行的工具调用，直接将决策内容作为回答: {decision.text[:200]}")
+                    pipeline.mark("first_token")
+                    yield encode_event({'content': decision.text})
+                    await save_turn(decision.text)
+
+            except ClientDisconnected:
+                raise
             except Exception as e:
                 error_message = f"Agent模式处理时发生错误: {e}"
                 print(error_message)
-                yield f"data: {json.dumps({'error': error_message})}\n\n"
-
+                yield encode_event({'error': error_message})
 
         try:
+            # 等待构建上下文所需的阶段
+            try:
+                history_messages = await pipeline.result("history") if "history" in pipeline else []
+                web_results = None
+                if web_search:
+                    try:
+                        web_results = await pipeline.result("search")
+                    except DeadlineExceeded:
+                        print("网络搜索超出时间预算，本次回答不使用搜索结果。")
+            except (ClientDisconnected, asyncio.CancelledError):
+                print("准备上下文期间客户端断开连接，已取消进行中的阶段。")
+                await save_partial_turn(PARTIAL_RESPONSE_MARKER.strip())
+                raise
+            except WebSearchError as e:
+                print(f"网络搜索失败: {e}")
+                # 直接将错误信息作为消息返回给前端，并终止处理
+                yield encode_event({'content': f'网络搜索功能异常: {e}'})
+                yield encode_event({'event': 'done', 'session_id': session_id})
+                return # 终止生成器
+
+            # 将精简后的搜索结果作为上下文，添加到历史消息的最前面
+            if web_results:
+                history_messages.insert(0, {
+                    "role": "system",
+                    "content": f"以下是网络搜索结果，回答时请使用 [编号] 标注引用的来源:\n\n{format_search_context(web_results)}"
+                })
+
+            # 将当前用户查询添加到消息历史中
+            history_messages.append({"role": "user", "content": query})
+
             if agent_mode:
-                async for data in generate_with_tools():
+                async for data in generate_with_tools(history_messages):
                      yield data
             else:
-                async for data in generate_simple_response():
+                async for data in generate_simple_response(history_messages):
                     yield data
+        except ClientDisconnected:
+            # 客户端已不在，不再发送任何数据
+            print(f"会话 {session_id} 的客户端已断开，已停止生成。")
+            return
         except Exception as e:
             error_message = f"处理流式请求时发生错误: {str(e)}"
             print(error_message)
-            yield f"data: {json.dumps({'error': error_message})}\n\n"
-        finally:
-            # 响应结束时发送一个特殊事件
-            yield f"data: {json.dumps({'event': 'done', 'session_id': session_id})}\n\n"
+            yield encode_event({'error': error_message})
 
-    finally:
-        if db:
-            db.close()
-            print("流式请求处理完毕，数据库连接已关闭。")
+        # 响应结束时发送一个特殊事件
+        yield encode_event({'event': 'done', 'session_id': session_id})
 
 @app.get("/api/stream")
 async def stream(
+    request: Request,
     query: str,
     session_id: str = Query(None),
     web_search: bool = Query(False),
-    agent_mode: bool = Query(False)
+    agent_mode: bool = Query(False),
+    deadline_ms: int = Query(None, ge=0),
+    no_cache: bool = Query(False)
 ):
     """
     流式聊天 API 端点。
     接收用户查询并以流式响应返回 AI 的回答。
+    可选的 deadline_ms 指定整个请求的时间预算 (毫秒)，不指定时使用服务端默认值。
+    no_cache=true 时不使用回答缓存，总是由大模型重新生成回答。
+    服务繁忙时请求先排队，期间发送 `{"event": "queued", "position": n}` 事件；
+    等待队列已满时返回 429 和 Retry-After 响应头。
     """
-    return StreamingResponse(
-        process_stream_request(query, session_id, web_search, agent_mode),
-        media_type="text/event-stream"
-    )
+    # 排队时间也计入请求的时间预算
+    deadline = Deadline.from_ms(deadline_ms)
+    mode = AGENT if agent_mode else SEARCH if web_search else PLAIN
+    try:
+        # 公平调度按会话分组，新会话按客户端 IP 分组 (经 nginx 代理时取其设置的 X-Real-IP)
+        client_ip = request.headers.get("x-real-ip") or (request.client.host if request.client else "")
+        ticket = admission_controller.enter(mode, session_id or client_ip)
+    except AdmissionRejected as e:
+        print(f"准入队列已满，拒绝 {mode} 请求。")
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "服务繁忙，请稍后重试。"},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+    async def admitted_stream():
+        """
+        排队期间发送 queued 事件告知排队位置，准入后输出正常的流式响应。
+        名额由 AdmittedStreamingResponse 在响应结束时归还。
+        """
+        try:
+            async for position in ticket.wait_turn(deadline.timeout(ADMISSION_QUEUE_TIMEOUT)):
+                yield encode_event({'event': 'queued', 'position': position})
+        except asyncio.TimeoutError:
+            print(f"{mode} 请求排队超时。")
+            yield encode_event({'error': '服务繁忙，排队超时，请稍后重试。'})
+            yield encode_event({'event': 'done', 'session_id': session_id})
+            return
+        async for frame in process_stream_request(request, query, session_id, web_search, agent_mode, deadline, no_cache):
+            yield frame
+
+    return AdmittedStreamingResponse(admitted_stream(), ticket, media_type="text/event-stream")
 
 @app.get("/api/chat/history")
-async def get_chat_history(db: sqlite3.Connection = Depends(get_db)):
+async def get_chat_history(db: AsyncConnection = Depends(get_db)):
     """
     获取所有聊天会话的历史记录。
     """
-    cursor = db.cursor()
-    cursor.execute("SELECT id, summary, created_at, updated_at FROM chat_sessions ORDER BY updated_at DESC")
-    sessions = [dict(row) for row in cursor.fetchall()]
+    # 先写入队列中尚未落盘的记录，保证能读到刚刚结束的对话
+    await persistence_queue.flush()
+    rows = await db.fetchall("SELECT id, summary, created_at, updated_at FROM chat_sessions ORDER BY updated_at DESC")
+    sessions = [dict(row) for row in rows]
     return sessions
 
 @app.get("/api/chat/session/{session_id}")
-async def get_session(session_id: str, db: sqlite3.Connection = Depends(get_db)):
+async def get_session(session_id: str, db: AsyncConnection = Depends(get_db)):
     """
     获取指定会话的详细信息和消息历史。
     """
-    cursor = db.cursor()
-    
+    await persistence_queue.flush()
     # 获取会话信息
-    cursor.execute("SELECT id, summary, created_at, updated_at FROM chat_sessions WHERE id = ?", (session_id,))
-    session_info = cursor.fetchone()
+    session_info = await db.fetchone("SELECT id, summary, created_at, updated_at FROM chat_sessions WHERE id = ?", (session_id,))
     if not session_info:
         raise HTTPException(status_code=404, detail="会话未找到")
         
     # 获取消息历史
-    cursor.execute("SELECT role, content, created_at FROM messages WHERE session_id = ? ORDER BY created_at ASC", (session_id,))
-    messages = [dict(row) for row in cursor.fetchall()]
+    rows = await db.fetchall("SELECT role, content, created_at FROM messages WHERE session_id = ? ORDER BY id ASC", (session_id,))
+    messages = [dict(row) for row in rows]
     
     return {"session": dict(session_info), "messages": messages}
 
 @app.delete("/api/chat/session/{session_id}")
-async def delete_session(session_id: str, db: sqlite3.Connection = Depends(get_db)):
+async def delete_session(session_id: str, db: AsyncConnection = Depends(get_db)):
     """
     删除指定的聊天会话及其所有消息。
     """
-    cursor = db.cursor()
-    # 首先删除关联的消息
-    cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
-    # 然后删除会话本身
-    cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+    # 先写入队列中尚未落盘的记录，避免删除后又被写回
+    await persistence_queue.flush()
+    # 关联的消息和滚动摘要由外键的 ON DELETE CASCADE 自动删除
+    cursor = await db.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+    await db.commit()
+    invalidate_cached_session(session_id)
     if cursor.rowcount == 0:
-        db.commit() # 即使会话未找到，也应提交删除消息的操作
         raise HTTPException(status_code=404, detail="会话未找到")
-    db.commit()
     return {"message": "会话已成功删除"}
 
 @app.get("/api/chat/export/{session_id}")
-async def export_session(session_id: str, db: sqlite3.Connection = Depends(get_db)):
+async def export_session(session_id: str, db: AsyncConnection = Depends(get_db)):
     """
     以 JSON 格式导出指定聊天会话的内容。
     """
-    cursor = db.cursor()
-    cursor.execute("SELECT role, content, created_at FROM messages WHERE session_id = ? ORDER BY created_at ASC", (session_id,))
-    messages = [dict(row) for row in cursor.fetchall()]
+    await persistence_queue.flush()
+    rows = await db.fetchall("SELECT role, content, created_at FROM messages WHERE session_id = ? ORDER BY id ASC", (session_id,))
+    messages = [dict(row) for row in rows]
     
     if not messages:
         raise HTTPException(status_code=404, detail="会话未找到或无消息")
@@ -465,6 +609,24 @@ def health_check():
     """
     return {"status": "ok"}
 
+@app.get("/api/metrics", summary="运行指标", tags=["system"])
+def metrics():
+    """
+    返回进程内各缓存的命中情况等运行指标。
+    """
+    return {
+        "session_history_cache": session_history_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "request_stages": stage_stats.snapshot(),
+        "mcp_sessions": mcp_session_pool.stats(),
+        "tool_result_cache": tool_result_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "llm": llm_pool.stats(),
+        "model_routes": dict(route_counts),
+        "admission": admission_controller.stats(),
+        "single_flight": {"search": search_flights.stats(), "answer": answer_streams.stats()},
+    }
+
 
 if __name__ == "__main__":
     # 应用启动时会自动初始化数据库，此处无需操作
@@ -0,0 +1,229 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import anyio
+import httpx
+from fastmcp import Client
+from fastmcp.client.transports import SSETransport
+from config import (
+    MCP_POOL_MAX_SESSIONS, MCP_SESSION_IDLE_TIMEOUT, MCP_SERVER_MAX_CONCURRENCY,
+    MCP_HEALTH_CHECK_AFTER, MCP_CONNECT_TIMEOUT
+)
+
+# 说明会话本身已经不可用 (而不是工具执行出错) 的异常，遇到时丢弃会话，必要时重新连接并重试一次
+CONNECTION_ERRORS = (httpx.TransportError, anyio.ClosedResourceError, anyio.BrokenResourceError, ConnectionError)
+
+class PooledSession:
+    """
+    一个已完成 MCP initialize 握手、可以被多个请求复用的客户端会话。
+    """
+
+    def __init__(self, server_id: str, url: str, client: Client):
+        self.server_id = server_id
+        self.url = url
+        self.client = client
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        # 已从池中移除，最后一个使用者归还后关闭
+        self.retired = False
+
+class MCPSessionPool:
+    """
+    按服务器 ID 保持长连接的 MCP 客户端会话池。
+
+    每次工具调用不再重新建立 SSE 连接和执行 initialize 握手，而是复用池中的会话：
+    - 空闲超过 `health_check_after` 秒的会话在复用前先 ping，失败则重新连接；
+    - 建立会话时连接失败会重试一次；请求发出后因连接错误失败时丢弃该会话，
+      只有列出工具这类幂等的请求才重新连接并重试，工具调用不自动重试，避免重复执行有副作用的工具；
+    - 每个服务器同时进行的调用数不超过 `max_concurrency`；
+    - 池中最多保留 `max_sessions` 个会话，满时关闭最久未使用的空闲会话，
+      全部忙碌时新会话只用于本次调用；
+    - 后台任务定期关闭空闲超过 `idle_timeout` 秒的会话。
+    """
+
+    def __init__(self, max_sessions: int = MCP_POOL_MAX_SESSIONS, idle_timeout: float = MCP_SESSION_IDLE_TIMEOUT,
+                 max_concurrency: int = MCP_SERVER_MAX_CONCURRENCY, health_check_after: float = MCP_HEALTH_CHECK_AFTER,
+                 connect_timeout: float = MCP_CONNECT_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_concurrency = max_concurrency
+        self.health_check_after = health_check_after
+        self.connect_timeout = connect_timeout
+        self._sessions = OrderedDict()  # server_id -> PooledSession，按最近使用排序
+        self._limits = {}  # server_id -> 并发调用信号量
+        self._locks = {}  # server_id -> 建立连接用的锁，避免并发请求重复握手
+        self._closing = set()
+        self._reaper = None
+        self.connects = 0
+        self.reuses = 0
+
+    def start(self):
+        self._reaper = asyncio.create_task(self._reap())
+
+    async def close(self):
+        """
+        关闭所有会话，在应用关闭时调用。
+        """
+        if self._reaper:
+            self._reaper.cancel()
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for entry in sessions:
+            await self._close(entry)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    async def _open(self, url: str) -> Client:
+        client = Client(SSETransport(url), init_timeout=self.connect_timeout)
+        await client.__aenter__()
+        if not client.is_connected():
+            # 连接或握手失败时 fastmcp 不会直接抛出异常，关闭客户端会重新抛出原始错误
+            await client.close()
+            raise ConnectionError(f"无法连接到 MCP 服务器 {url}")
+        return client
+
+    async def _close(self, entry: PooledSession):
+        try:
+            await entry.client.close()
+        except Exception as e:
+            print(f"关闭 MCP 会话 {entry.url} 时出错: {e}")
+
+    def _retire(self, entry: PooledSession):
+        """
+        把会话移出池子：没有人在使用时立即关闭，否则等最后一个使用者归还后再关闭。
+        """
+        if self._sessions.get(entry.server_id) is entry:
+            del self._sessions[entry.server_id]
+        entry.retired = True
+        if entry.in_use == 0:
+            task = asyncio.create_task(self._close(entry))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    def discard(self, server_id: str):
+        """
+        服务器被修改或删除后调用，后续调用会重新建立会话。
+        同时移除该服务器的并发信号量和连接锁，避免已删除的服务器一直占用；
+        进行中的调用继续使用各自持有的旧对象，后续调用按需重新创建。
+        """
+        self._limits.pop(server_id, None)
+        self._locks.pop(server_id, None)
+        entry = self._sessions.get(server_id)
+        if entry is not None:
+            self._retire(entry)
+
+    async def _healthy(self, entry: PooledSession) -> bool:
+        if not entry.client.is_connected():
+            return False
+        if time.monotonic() - entry.last_used < self.health_check_after:
+            return True
+        try:
+            return await asyncio.wait_for(entry.client.ping(), self.connect_timeout)
+        except Exception:
+            return False
+
+    def _make_room(self) -> bool:
+        """
+        池满时关闭最久未使用的空闲会话。返回 False 表示所有会话都在使用中。
+        """
+        while len(self._sessions) >= self.max_sessions:
+            idle = next((entry for entry in self._sessions.values() if entry.in_use == 0), None)
+            if idle is None:
+                return False
+            self._retire(idle)
+        return True
+
+    async def _checkout(self, server_id: str, url: str) -> PooledSession:
+        async with self._locks.setdefault(server_id, asyncio.Lock()):
+            entry = self._sessions.get(server_id)
+            if entry is not None and (entry.url != url or not await self._healthy(entry)):
+                self._retire(entry)
+                entry = None
+            if entry is None:
+                entry = PooledSession(server_id, url, await self._open(url))
+                self.connects += 1
+                if self._make_room():
+                    self._sessions[server_id] = entry
+                else:
+                    entry.retired = True
+            else:
+                self.reuses += 1
+                self._sessions.move_to_end(server_id)
+            entry.in_use += 1
+            return entry
+
+    def _release(self, entry: PooledSession):
+        entry.in_use -= 1
+        entry.last_used = time.monotonic()
+        if entry.retired and entry.in_use == 0:
+            self._retire(entry)
+
+    @asynccontextmanager
+    async def session(self, server_id: str, url: str):
+        """
+        借出一个服务器的客户端会话，离开上下文时归还。
+        """
+        limit = self._limits.setdefault(server_id, asyncio.Semaphore(self.max_concurrency))
+        async with limit:
+            entry = await self._checkout(server_id, url)
+            try:
+                yield entry
+            finally:
+                self._release(entry)
+
+    async def _with_retry(self, server_id: str, url: str, operation, idempotent: bool):
+        """
+        在借出的会话上执行 operation(client)。
+
+        借出会话 (连接、握手或健康检查) 时的连接错误说明请求尚未发出，总是重试一次；
+        请求发出后的连接错误只在 idempotent 为真时重试，否则丢弃会话后直接抛出，
+        因为服务器可能已经执行了该请求。
+        """
+        for attempt in range(2):
+            sent = False
+            try:
+                async with self.session(server_id, url) as entry:
+                    sent = True
+                    try:
+                        return await operation(entry.client)
+                    except CONNECTION_ERRORS:
+                        self._retire(entry)
+                        raise
+            except CONNECTION_ERRORS as e:
+                if attempt or (sent and not idempotent):
+                    raise
+                print(f"MCP 会话 {url} 连接失败 ({e})，重新连接后重试...")
+
+    async def call_tool(self, server_id: str, url: str, tool_name: str, parameters: dict, timeout: float = None):
+        """
+        使用池中的会话调用一个工具，返回工具的执行结果。timeout 为等待 MCP 服务器响应的超时 (秒)。
+        工具可能有副作用，请求发出后的连接错误不会自动重试。
+        """
+        return await self._with_retry(server_id, url, lambda client: client.call_tool(tool_name, parameters, timeout=timeout), idempotent=False)
+
+    async def list_tools(self, server_id: str, url: str) -> list:
+        """
+        使用池中的会话获取服务器提供的工具列表。
+        """
+        return await self._with_retry(server_id, url, lambda client: client.list_tools(), idempotent=True)
+
+    async def _reap(self):
+        interval = max(min(self.idle_timeout / 2, 30), 1)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for entry in list(self._sessions.values()):
+                if entry.in_use == 0 and now - entry.last_used > self.idle_timeout:
+                    print(f"关闭空闲的 MCP 会话: {entry.url}")
+                    self._retire(entry)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "in_use": sum(entry.in_use for entry in self._sessions.values()),
+            "connects": self.connects,
+            "reuses": self.reuses,
+        }
+
+mcp_session_pool = MCPSessionPool()
@@ -0,0 +1,63 @@
+import re
+from collections import Counter
+from config import DECISION_MODEL, ANSWER_MODEL, CHAT_MODEL, SUMMARY_MODEL, FAST_MODEL, SIMPLE_QUESTION_MAX_CHARS
+
+# 调用用途 -> 模型
+PURPOSE_DECISION = "decision"
+PURPOSE_ANSWER = "answer"
+PURPOSE_CHAT = "chat"
+PURPOSE_SUMMARY = "summary"
+PURPOSE_MODELS = {
+    PURPOSE_DECISION: DECISION_MODEL,
+    PURPOSE_ANSWER: ANSWER_MODEL,
+    PURPOSE_CHAT: CHAT_MODEL,
+    PURPOSE_SUMMARY: SUMMARY_MODEL,
+}
+
+# 提示问题需要推理、长篇输出或处理代码的特征，出现时不视为简单问题
+_COMPLEX_PATTERN = re.compile(
+    r"```|为什么|如何|怎么|分析|比较|对比|区别|解释|证明|推导|计算|步骤|代码|程序|写一|翻译|总结|优缺点|方案|"
+    r"\b(why|how|explain|compare|analy[sz]e|prove|derive|code|write|translate|summari[sz]e)\b",
+    re.IGNORECASE
+)
+
+# 每个模型被选中的次数，供 /api/metrics 查看
+route_counts = Counter()
+
+def record_route(route: str, model: str):
+    """
+    记录一次实际发往某个模型的调用。
+    """
+    route_counts[f"{route}:{model}"] += 1
+
+def model_for(purpose: str) -> str:
+    """
+    返回某个调用用途配置的模型。
+    """
+    model = PURPOSE_MODELS[purpose]
+    record_route(purpose, model)
+    return model
+
+def is_simple_question(query: str, max_chars: int = SIMPLE_QUESTION_MAX_CHARS) -> bool:
+    """
+    粗略判断一个问题是否足够简单，可以交给更快的模型回答：
+    长度不超过 max_chars 个字符、只有一行、至多一个问句，且不含需要推理、长篇输出或处理代码的特征词。
+    """
+    text = query.strip()
+    if not text or len(text) > max_chars or "\n" in text:
+        return False
+    if text.count("?") + text.count("？") > 1:
+        return False
+    return _COMPLEX_PATTERN.search(text) is None
+
+def chat_route(query: str, first_turn: bool) -> tuple:
+    """
+    选择普通对话使用的模型：配置了 FAST_MODEL 时，简单的首轮问题改用快速模型，其余使用 CHAT_MODEL。
+    只做选择而不计数，真正调用对话模型时再通过 record_route 记录。
+
+    Returns:
+        tuple: (路由名称, 模型)。
+    """
+    if FAST_MODEL and SIMPLE_QUESTION_MAX_CHARS > 0 and first_turn and is_simple_question(query):
+        return "fast", FAST_MODEL
+    return PURPOSE_CHAT, PURPOSE_MODELS[PURPOSE_CHAT]
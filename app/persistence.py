@@ -0,0 +1,153 @@
+import asyncio
+import sqlite3
+import time
+from config import PERSISTENCE_BATCH_SIZE, PERSISTENCE_FLUSH_INTERVAL_MS, PERSISTENCE_MODE
+from database import ConnectionPool, db_pool
+
+class TurnRecord:
+    """
+    一轮问答需要持久化的全部内容。
+    """
+
+    def __init__(self, session_id: str, query: str, response: str):
+        self.session_id = session_id
+        self.query = query
+        self.response = response
+        self.created_at = int(time.time())
+
+def _write_turns(conn: sqlite3.Connection, records: list):
+    """
+    在一个事务中写入一批问答记录 (由 ConnectionPool.run 负责提交)。
+    """
+    for record in records:
+        summary = record.query[:50] + ("..." if len(record.query) > 50 else "")
+        # 新会话插入会话记录，已有会话只更新 updated_at
+        conn.execute(
+            """
+            INSERT INTO chat_sessions (id, summary, created_at, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at
+            """,
+            (record.session_id, summary, record.created_at, record.created_at)
+        )
+        conn.executemany(
+            "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+            [
+                (record.session_id, "user", record.query, record.created_at),
+                (record.session_id, "assistant", record.response, record.created_at),
+            ]
+        )
+
+class PersistenceQueue:
+    """
+    聊天记录的批量后写 (write-behind) 队列。
+
+    所有流式请求提交的问答记录汇集到同一个队列中，由后台任务按批次写入：
+    批次攒满 `batch_size` 条或距离批次中第一条记录超过 `interval_ms` 毫秒时，
+    整批在一个事务中提交，原本每轮多次的 commit/fsync 被合并为每批一次。
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = PERSISTENCE_BATCH_SIZE,
+                 interval_ms: int = PERSISTENCE_FLUSH_INTERVAL_MS, mode: str = PERSISTENCE_MODE):
+        if mode not in ("batched", "async"):
+            raise ValueError(f"未知的持久化模式: {mode}")
+        self.pool = pool
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.mode = mode
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """
+        启动后台写入任务，在应用启动时调用。
+        """
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        写入所有尚未持久化的记录并停止后台任务，在应用关闭时调用。
+        """
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        self._task = None
+
+    async def submit(self, record: TurnRecord):
+        """
+        提交一条问答记录。batched 模式下会等待所在批次提交完成。
+        """
+        if self._task is None:
+            # 后台任务未启动 (例如在脚本中直接调用) 时，直接同步写入
+            await self.pool.run(_write_turns, [record])
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((record, future))
+        if self.mode == "batched":
+            await future
+
+    async def flush(self):
+        """
+        立即写入队列中所有已提交的记录，并等待写入完成。
+        """
+        if self._task is None:
+            return
+        # 在队列中放入一个单独的 Future 作为刷盘标记，后台任务处理到它时，
+        # 之前提交的记录一定都已经写入
+        marker = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(marker)
+        await marker
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            marker = None
+            item = await self._queue.get()
+            deadline = loop.time() + self.interval
+            while True:
+                if isinstance(item, asyncio.Future):
+                    marker = item
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if batch:
+                await self._write_batch(batch)
+            if marker is not None and not marker.done():
+                marker.set_result(None)
+
+    async def _write_batch(self, batch: list):
+        try:
+            await self.pool.run(_write_turns, [record for record, _ in batch])
+            print(f"已批量写入 {len(batch)} 轮对话。")
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        except Exception as e:
+            print(f"批量写入对话失败，改为逐条写入: {e}")
+            # 单条记录的问题不应导致整批数据丢失
+            for record, future in batch:
+                try:
+                    await self.pool.run(_write_turns, [record])
+                    if not future.done():
+                        future.set_result(None)
+                except Exception as record_error:
+                    print(f"写入会话 {record.session_id} 的对话失败: {record_error}")
+                    if not future.done():
+                        future.set_exception(record_error)
+                        if self.mode == "async":
+                            # 没有调用方等待结果，标记异常已被处理
+                            future.exception()
+
+# 进程内唯一的持久化队列
+persistence_queue = PersistenceQueue(db_pool)
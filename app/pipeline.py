@@ -0,0 +1,134 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from request_scope import DisconnectWatcher, Deadline
+
+class StageStats:
+    """
+    进程内按阶段名汇总的耗时统计 (毫秒)，供 /api/metrics 查看各阶段的平均和最大耗时。
+    普通阶段统计其持续时间，时间点 (如 first_token) 统计其相对请求开始的时刻。
+    """
+
+    def __init__(self):
+        self._stats = {}  # name -> [count, total_ms, max_ms]
+
+    def record(self, name: str, elapsed_ms: float):
+        entry = self._stats.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed_ms
+        entry[2] = max(entry[2], elapsed_ms)
+
+    def snapshot(self) -> dict:
+        return {
+            name: {"count": count, "avg_ms": round(total / count, 1), "max_ms": round(peak, 1)}
+            for name, (count, total, peak) in self._stats.items()
+        }
+
+stage_stats = StageStats()
+
+class RequestPipeline:
+    """
+    一个流式请求的阶段调度器。
+
+    互不依赖的阶段 (历史加载、网络搜索、工具列表查询) 通过 `start` 同时启动，
+    后续阶段只等待自己真正依赖的结果，因此首个 token 的延迟取决于最慢的依赖，
+    而不是所有阶段耗时之和。所有阶段都经由 `DisconnectWatcher` 运行，客户端断开时一并取消。
+    每个阶段的开始和结束时间 (相对请求开始) 都会被记录，请求结束时打印并计入 `stage_stats`。
+    """
+
+    def __init__(self, watcher: DisconnectWatcher):
+        self.watcher = watcher
+        self.started_at = time.perf_counter()
+        self.timings = {}  # name -> (开始毫秒, 结束毫秒)
+        self._stages = {}
+        self._cleanups = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # 提前结束 (出错、断开或不再需要) 时，取消仍在运行的阶段
+        for task in self._stages.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # 取走未被等待的阶段异常，避免 "Task exception was never retrieved" 警告
+                task.exception()
+        for cleanup in self._cleanups:
+            try:
+                await cleanup()
+            except Exception as e:
+                print(f"释放请求阶段资源时出错: {e}")
+        self.report()
+        return False
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._stages
+
+    def defer(self, cleanup):
+        """
+        登记一个在请求结束时调用的异步清理函数，例如关闭阶段结果中尚未读完的上游流。
+        """
+        self._cleanups.append(cleanup)
+
+    def _elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started_at) * 1000
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        记录一段代码的执行时间，用于无法包装成单个协程的阶段 (例如流式输出)。
+        """
+        start = self._elapsed_ms()
+        try:
+            yield
+        finally:
+            self.timings[name] = (start, self._elapsed_ms())
+
+    def mark(self, name: str):
+        """
+        记录一个时间点，例如首个 token 发出的时刻。
+        """
+        now = self._elapsed_ms()
+        self.timings[name] = (now, now)
+
+    async def _timed(self, name: str, awaitable):
+        with self.span(name):
+            return await awaitable
+
+    def start(self, name: str, awaitable, deadline: Deadline = None) -> asyncio.Task:
+        """
+        立即在后台启动一个阶段，返回对应的任务。结果通过 `result` 获取。
+        指定 deadline 时，阶段超时会在 `result` 处抛出 `DeadlineExceeded`。
+        """
+        task = asyncio.create_task(self.watcher.run(self._timed(name, awaitable), deadline))
+        self._stages[name] = task
+        return task
+
+    async def result(self, name: str):
+        """
+        等待一个已启动的阶段完成并返回其结果；阶段中的异常会在这里重新抛出。
+        同一个阶段可以被多次等待。
+        """
+        return await self._stages[name]
+
+    async def run(self, name: str, awaitable, deadline: Deadline = None):
+        """
+        启动一个阶段并等待它完成。
+        """
+        self.start(name, awaitable, deadline)
+        return await self.result(name)
+
+    def report(self):
+        total = self._elapsed_ms()
+        parts = []
+        for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1]):
+            if start == end:
+                # 时间点记录相对请求开始的时刻，例如 first_token 即首 token 延迟
+                stage_stats.record(name, end)
+                parts.append(f"{name} @{end:.0f}ms")
+            else:
+                stage_stats.record(name, end - start)
+                parts.append(f"{name} {start:.0f}→{end:.0f}ms")
+        stage_stats.record("total", total)
+        print(f"请求阶段耗时: {', '.join(parts) or '无'}; 总计 {total:.0f}ms")
@@ -0,0 +1,165 @@
+import asyncio
+import time
+from fastapi import Request
+from config import DISCONNECT_POLL_INTERVAL_MS, REQUEST_DEADLINE_MS, REQUEST_DEADLINE_MAX_MS
+
+# 客户端中途断开时，追加在已生成的部分回答之后保存到数据库的标记
+PARTIAL_RESPONSE_MARKER = "\n\n[连接已断开，回答未完成]"
+# 请求的时间预算用完时，追加在已生成的部分回答之后的标记
+DEADLINE_MARKER = "\n\n[回答超出时间限制，已截断]"
+
+class ClientDisconnected(Exception):
+    """
+    SSE 客户端已经断开连接，当前请求的剩余工作应当被放弃。
+    """
+
+class DeadlineExceeded(Exception):
+    """
+    当前阶段 (或整个请求) 的时间预算已经用完。
+    """
+
+class Deadline:
+    """
+    请求级的截止时间，贯穿一个请求的所有阶段。
+
+    每个对外调用 (网络搜索、大模型、MCP 工具) 都只能使用剩余的预算，
+    因此整个请求的耗时不会超过创建时给定的时长。使用单调时钟，不受系统时间调整影响。
+    """
+
+    def __init__(self, timeout: float = None, expires_at: float = None):
+        self.expires_at = expires_at if expires_at is not None else time.monotonic() + timeout
+
+    @classmethod
+    def from_ms(cls, deadline_ms: int = None) -> "Deadline":
+        """
+        根据请求参数创建截止时间，未指定时使用服务端默认值，并限制在允许的范围内。
+        """
+        if deadline_ms is None:
+            deadline_ms = REQUEST_DEADLINE_MS
+        return cls(min(max(deadline_ms, 0), REQUEST_DEADLINE_MAX_MS) / 1000)
+
+    def remaining(self) -> float:
+        """
+        剩余的时间 (秒)，不会小于 0。
+        """
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float = None) -> float:
+        """
+        某个调用可以使用的超时时间 (秒)：剩余预算，且不超过该调用自身的上限 cap。
+        """
+        remaining = self.remaining()
+        return remaining if cap is None else min(remaining, cap)
+
+    def sub(self, cap: float = None, reserve: float = 0) -> "Deadline":
+        """
+        为某个阶段派生一个更早的截止时间。
+
+        Args:
+            cap (float): 该阶段最多可以使用的时长 (秒)。
+            reserve (float): 为后续阶段预留的时长 (秒)，最多预留剩余预算的一半。
+        """
+        now = time.monotonic()
+        remaining = max(self.expires_at - now, 0.0)
+        expires_at = self.expires_at - min(reserve, remaining / 2)
+        if cap is not None:
+            expires_at = min(expires_at, now + cap)
+        return Deadline(expires_at=expires_at)
+
+async def _wait_finished(task: asyncio.Task):
+    """
+    等待一个已被取消的任务真正结束。等待期间当前任务再次被取消时 (anyio 的取消范围会反复取消) 继续等待，
+    由调用方在之后重新抛出取消。
+    """
+    while not task.done():
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            pass
+
+class DisconnectWatcher:
+    """
+    监视一个流式请求的客户端连接状态。
+
+    进入上下文后会启动一个后台任务，定期通过 Starlette 的 `request.is_disconnected()`
+    检查连接。一旦发现断开，所有通过 `run` / `iterate` 登记的上游工作
+    (大模型流、网络搜索、MCP 工具调用) 都会被立即取消，并在调用处抛出 `ClientDisconnected`。
+    """
+
+    def __init__(self, request: Request, interval_ms: int = DISCONNECT_POLL_INTERVAL_MS):
+        self.request = request
+        self.interval = interval_ms / 1000
+        self.disconnected = False
+        self._tasks = set()
+        # 由轮询任务在发现断开时取消的上游任务
+        self._cancelled = set()
+        self._poller = None
+
+    async def __aenter__(self):
+        self._poller = asyncio.create_task(self._poll())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._poller.cancel()
+        return False
+
+    async def _poll(self):
+        while not self.disconnected:
+            await asyncio.sleep(self.interval)
+            if await self.request.is_disconnected():
+                self.disconnected = True
+                print("检测到客户端已断开连接，正在取消上游任务...")
+                for task in list(self._tasks):
+                    self._cancelled.add(task)
+                    task.cancel()
+
+    async def run(self, coro, deadline: Deadline = None):
+        """
+        运行一个协程；如果期间客户端断开，则取消它并抛出 `ClientDisconnected`。
+        指定 deadline 时，超过截止时间也会取消它，并抛出 `DeadlineExceeded`。
+        """
+        if self.disconnected or (deadline is not None and deadline.expired):
+            coro.close()
+            raise ClientDisconnected() if self.disconnected else DeadlineExceeded()
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        try:
+            if deadline is None:
+                return await task
+            return await asyncio.wait_for(task, deadline.remaining())
+        except asyncio.CancelledError:
+            # 只有被轮询任务取消的上游工作才转换为 ClientDisconnected；
+            # 当前任务自身被取消时 (例如 Starlette 发现断开后取消整个响应)，原样传递取消
+            if task in self._cancelled:
+                raise ClientDisconnected() from None
+            # 上游任务会随当前任务一起被取消，等它执行完清理再传递取消，
+            # 否则 iterate 随后关闭生成器时，生成器的 __anext__ 可能仍在运行
+            await _wait_finished(task)
+            raise
+        except asyncio.TimeoutError:
+            # 只有截止时间到达时才转换；协程自身抛出的超时异常原样向上传递
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded() from None
+            raise
+        finally:
+            self._tasks.discard(task)
+            self._cancelled.discard(task)
+
+    async def iterate(self, agen, deadline: Deadline = None):
+        """
+        迭代一个异步生成器；客户端断开或超过 deadline 时取消正在等待的 `__anext__`，
+        取消会传递进生成器内部，从而关闭底层的上游连接。
+        """
+        try:
+            while True:
+                try:
+                    item = await self.run(agen.__anext__(), deadline)
+                except StopAsyncIteration:
+                    break
+                yield item
+        finally:
+            await agen.aclose()
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import os
+import random
+import re
+import unicodedata
+from urllib.parse import urlparse
+import httpx
+from cache import TTLCache
+from config import (
+    BOCHAAI_SEARCH_API_KEY, SEARCH_HTTP2, SEARCH_MAX_CONNECTIONS, SEARCH_MAX_KEEPALIVE_CONNECTIONS,
+    SEARCH_KEEPALIVE_EXPIRY, SEARCH_CONNECT_TIMEOUT, SEARCH_READ_TIMEOUT, SEARCH_MAX_RETRIES,
+    SEARCH_RETRY_BACKOFF_MS, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL, SEARCH_CACHE_MAX_ENTRIES,
+    SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_PATH, SEARCH_CONTEXT_TOKEN_BUDGET, SEARCH_CONTEXT_MAX_RESULTS
+)
+from tokens import estimate_tokens, truncate_to_tokens
+from request_scope import Deadline, DeadlineExceeded
+from singleflight import SingleFlight
+
+BOCHAAI_SEARCH_URL = "https://api.bochaai.com/v1/web-search"
+
+# 这些状态码通常是暂时性的，值得重试
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 进程内共享的搜索 HTTP 客户端，由应用的 lifespan 创建和关闭
+_client = None
+
+class WebSearchError(Exception):
+    """
+    网络搜索失败。异常信息可以直接展示给用户。
+    """
+
+class SearchResult:
+    """
+    一条精简后的网页搜索结果，只保留生成回答需要的字段。
+    """
+
+    def __init__(self, title: str, url: str, snippet: str = "", summary: str = "", site_name: str = ""):
+        self.title = title
+        self.url = url
+        self.snippet = snippet
+        self.summary = summary
+        self.site_name = site_name
+
+    @property
+    def domain(self) -> str:
+        domain = urlparse(self.url).netloc.lower()
+        return domain[4:] if domain.startswith("www.") else domain
+
+    @property
+    def text(self) -> str:
+        # BochaAI 的 summary 是对网页正文的长摘要，比 snippet 信息量更大，优先使用
+        return (self.summary or self.snippet or "").strip()
+
+# 搜索结果缓存，键为 (规范化后的查询, freshness, count)，值为 BochaAI 返回的原始 JSON
+search_cache = TTLCache(
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE_TTL,
+    max_bytes=SEARCH_CACHE_MAX_BYTES,
+    sizeof=lambda value: len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+)
+
+# 合并同时进行的相同搜索请求，上游请求数取决于不同查询的数量而不是用户数
+search_flights = SingleFlight()
+
+# 正在后台刷新的缓存键，避免同一个查询被重复刷新
+_refreshing = set()
+# 持有后台刷新任务的引用，防止任务在完成前被垃圾回收
+_background_tasks = set()
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "?？!！.。~～ "
+
+def normalize_query(query: str) -> str:
+    """
+    规范化搜索查询，让只在大小写、全半角、空白或结尾标点上不同的查询共享同一个缓存条目。
+    """
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = _WHITESPACE_PATTERN.sub(" ", query).strip()
+    return query.rstrip(_TRAILING_PUNCTUATION)
+
+def _http2_enabled() -> bool:
+    # httpx 的 HTTP/2 支持依赖可选的 h2 包，未安装时退回 HTTP/1.1
+    if not SEARCH_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("未安装 h2，网络搜索将使用 HTTP/1.1。")
+        return False
+
+def init_search_client() -> httpx.AsyncClient:
+    """
+    创建共享的搜索 HTTP 客户端。
+
+    客户端在整个应用生命周期内复用，DNS 解析、TCP 和 TLS 握手只在建立连接时发生一次，
+    之后的搜索请求都通过长连接 (keep-alive) 或 HTTP/2 多路复用发送。
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=_http2_enabled(),
+            limits=httpx.Limits(
+                max_connections=SEARCH_MAX_CONNECTIONS,
+                max_keepalive_connections=SEARCH_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=SEARCH_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(
+                SEARCH_READ_TIMEOUT,
+                connect=SEARCH_CONNECT_TIMEOUT
+            ),
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {BOCHAAI_SEARCH_API_KEY}'
+            }
+        )
+    return _client
+
+async def close_search_client():
+    """
+    关闭共享的搜索 HTTP 客户端，在应用关闭时调用。
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _backoff(attempt: int):
+    # 指数退避 + 全抖动 (full jitter)，避免大量请求在同一时刻集中重试
+    delay = SEARCH_RETRY_BACKOFF_MS / 1000 * (2 ** attempt)
+    await asyncio.sleep(random.uniform(0, delay))
+
+async def _request_search(query: str, freshness: str, count: int) -> dict:
+    """
+    请求 BochaAI 的搜索 API 并返回解析后的 JSON。
+    使用共享的 httpx 异步客户端，对网络错误和暂时性的错误状态码按退避策略重试。
+    失败时抛出 `WebSearchError`。
+    """
+    payload = {
+        "query": query,
+        "freshness": freshness,
+        "summary": True,
+        "count": count
+    }
+    
+    client = init_search_client()
+    for attempt in range(SEARCH_MAX_RETRIES + 1):
+        can_retry = attempt < SEARCH_MAX_RETRIES
+        try:
+            response = await client.post(BOCHAAI_SEARCH_URL, json=payload)
+            if response.status_code in RETRYABLE_STATUS_CODES and can_retry:
+                print(f"网络搜索返回状态码 {response.status_code}，准备第 {attempt + 1} 次重试...")
+                await _backoff(attempt)
+                continue
+            response.raise_for_status()  # 如果状态码不是 2xx，则引发异常
+            json_data = response.json()
+            if json_data.get("code") not in (None, 200):
+                raise WebSearchError(f"搜索失败，错误码: {json_data.get('code')}, 信息: {json_data.get('msg')}")
+            return json_data
+        except httpx.HTTPStatusError as e:
+            raise WebSearchError(f"搜索失败，状态码: {e.response.status_code}, 响应: {e.response.text}")
+        except httpx.TransportError as e:
+            # 连接失败、超时等网络层错误
+            if can_retry:
+                print(f"网络搜索出错 ({e!r})，准备第 {attempt + 1} 次重试...")
+                await _backoff(attempt)
+                continue
+            raise WebSearchError(f"执行网络搜索时出错: {str(e)}")
+        except httpx.RequestError as e:
+            raise WebSearchError(f"执行网络搜索时出错: {str(e)}")
+        except json.JSONDecodeError as e:
+            raise WebSearchError(f"搜索结果JSON解析失败: {str(e)}")
+
+def _schedule_refresh(key: tuple, query: str, freshness: str, count: int):
+    """
+    在后台重新请求一个已过期的缓存条目 (stale-while-revalidate)。
+    """
+    if key in _refreshing:
+        return
+
+    async def refresh():
+        try:
+            search_cache.set(key, await _request_search(query, freshness, count))
+        except WebSearchError as e:
+            print(f"后台刷新搜索缓存失败: {e}")
+        finally:
+            _refreshing.discard(key)
+
+    _refreshing.add(key)
+    task = asyncio.create_task(refresh())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def parse_search_response(json_data: dict) -> list:
+    """
+    从 BochaAI 的响应中提取网页结果，丢弃 id、图标、图片、视频等与回答无关的字段。
+    """
+    data = json_data.get("data") or {}
+    pages = (data.get("webPages") or {}).get("value") or []
+    results = []
+    for page in pages:
+        url = page.get("url")
+        if not url:
+            continue
+        results.append(SearchResult(
+            title=(page.get("name") or "").strip(),
+            url=url,
+            snippet=page.get("snippet") or "",
+            summary=page.get("summary") or "",
+            site_name=page.get("siteName") or ""
+        ))
+    return results
+
+def rank_results(results: list) -> list:
+    """
+    对搜索结果去重并排序。
+
+    每个域名只保留排名最靠前的一条，避免同一站点的多个页面挤占上下文；
+    排序以搜索引擎给出的相关性顺序为基础，带有长摘要的结果适当提前。
+    """
+    seen_domains = set()
+    unique = []
+    for position, result in enumerate(results):
+        if result.domain in seen_domains or not result.text:
+            continue
+        seen_domains.add(result.domain)
+        score = 1 / (position + 1) + (0.2 if result.summary else 0)
+        unique.append((score, position, result))
+    unique.sort(key=lambda item: (-item[0], item[1]))
+    return [result for _, _, result in unique]
+
+def format_search_context(results: list, budget: int = SEARCH_CONTEXT_TOKEN_BUDGET,
+                          max_results: int = SEARCH_CONTEXT_MAX_RESULTS) -> str:
+    """
+    将排序后的搜索结果格式化为带编号引用的紧凑文本，总长度不超过 token 预算。
+    剩余预算在剩余条目间平均分配，较短的条目用不完的份额留给后面的条目，
+    避免排名靠前的长摘要独占全部预算；分到的份额过少时不再追加新条目。
+    """
+    selected = results[:max_results]
+    entries = []
+    used = 0
+    for index, result in enumerate(selected, start=1):
+        header = f"[{index}] {result.title}\n来源: {result.url}\n"
+        share = (budget - used) // (len(selected) - index + 1) - estimate_tokens(header)
+        if share < 50:
+            break
+        body = truncate_to_tokens(result.text, share)
+        entry = header + body
+        entries.append(entry)
+        used += estimate_tokens(entry)
+    return "\n\n".join(entries)
+
+# Perform web search (optional, retained for flexibility)
+# https://open.bochaai.com/overview
+async def perform_web_search(query: str, freshness: str = "noLimit", count: int = 10, deadline: Deadline = None) -> list:
+    """
+    执行网络搜索，返回去重、排序后的 `SearchResult` 列表。失败时抛出 `WebSearchError`，
+    超过 deadline 时抛出 `DeadlineExceeded`。
+
+    原始响应按 (规范化查询, freshness, count) 缓存：新鲜的条目直接返回；
+    过期但仍在宽限期内的条目先返回旧结果，再在后台刷新。
+    缓存未命中时，同时进行的相同查询合并为一次上游请求 (`search_flights`)；
+    上游请求不受单个调用者的 deadline 限制，每个调用者只在自己的 deadline 内等待。
+    参考文档: https://bocha-ai.feishu.cn/wiki/RXEOw02rFiwzGSkd9mUcqoeAnNK
+    """
+    if not BOCHAAI_SEARCH_API_KEY:
+        raise WebSearchError("BOCHAAI_SEARCH_API_KEY 未配置，无法执行网络搜索")
+
+    key = (normalize_query(query), freshness, count)
+    cached = search_cache.lookup(key)
+    if cached is not None:
+        json_data, stale = cached
+        if stale:
+            _schedule_refresh(key, query, freshness, count)
+    else:
+        async def fetch():
+            json_data = await _request_search(query, freshness, count)
+            search_cache.set(key, json_data)
+            return json_data
+
+        flight = search_flights.do(key, fetch)
+        if deadline is None:
+            json_data = await flight
+        else:
+            try:
+                json_data = await asyncio.wait_for(flight, deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded() from None
+    results = rank_results(parse_search_response(json_data))
+    print(f"网络搜索 '{query}' 返回 {len(results)} 条有效结果。")
+    return results
+
+def load_search_cache(path: str = SEARCH_CACHE_PATH):
+    """
+    从磁盘加载搜索缓存，在应用启动时调用。未配置路径或文件不存在时跳过。
+    """
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        for key, value, stored_at in entries:
+            search_cache.set(tuple(key), value, stored_at)
+        print(f"已从 {path} 加载 {len(search_cache)} 条搜索缓存。")
+    except (OSError, ValueError) as e:
+        print(f"加载搜索缓存失败: {e}")
+
+def save_search_cache(path: str = SEARCH_CACHE_PATH):
+    """
+    将搜索缓存写入磁盘，在应用关闭时调用。先写临时文件再替换，避免写到一半的文件覆盖旧缓存。
+    """
+    if not path:
+        return
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([list(entry) for entry in search_cache.items()], f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        print(f"已将 {len(search_cache)} 条搜索缓存写入 {path}。")
+    except OSError as e:
+        print(f"保存搜索缓存失败: {e}")
@@ -0,0 +1,125 @@
+import asyncio
+
+# 标记上游流已经正常结束
+_END = object()
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    合并同时进行的相同调用：同一个键同一时刻只有一个上游调用，其余调用者等待并共享它的结果。
+
+    上游调用在独立的任务中运行，某个调用者被取消 (客户端断开或超时) 不会影响其他调用者；
+    只有全部调用者都离开后，上游调用才会被取消。调用结束后键即被释放，之后的调用重新发起请求。
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _forget(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, factory):
+        """
+        执行 factory() 返回的协程并返回其结果；相同键的调用正在进行时，直接等待该调用的结果。
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "coalesced": self.coalesced}
+
+class _Broadcast:
+    def __init__(self):
+        self.deltas = []  # 已经产出的全部增量，供中途加入的订阅者补齐
+        self.queues = set()
+        self.task = None
+
+class StreamFanout:
+    """
+    合并同时进行的相同流式调用：同一个键只打开一个上游流，增量通过每个订阅者自己的
+    asyncio.Queue 分发给所有订阅者。
+
+    中途加入的订阅者先收到已经产出的增量，再继续接收后续增量，因此每个订阅者都能得到完整的输出。
+    订阅者各自以自己的节奏读取，离开时只取消自己的订阅；全部订阅者离开后上游流被关闭。
+    上游出错时，异常会抛给所有订阅者。
+    """
+
+    def __init__(self):
+        self._streams = {}  # key -> _Broadcast
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _forget(self, key, broadcast: _Broadcast):
+        if self._streams.get(key) is broadcast:
+            del self._streams[key]
+
+    async def _pump(self, key, broadcast: _Broadcast, deltas):
+        end = _END
+        try:
+            async for delta in deltas:
+                broadcast.deltas.append(delta)
+                for queue in broadcast.queues:
+                    queue.put_nowait(delta)
+        except Exception as e:
+            end = e
+        finally:
+            # 先释放键，之后到达的相同请求不会再加入一个已经结束的流
+            self._forget(key, broadcast)
+            await deltas.aclose()
+        for queue in broadcast.queues:
+            queue.put_nowait(end)
+
+    async def subscribe(self, key, factory):
+        """
+        订阅 factory() 返回的异步生成器的输出，逐个产出文本增量；
+        相同键的流正在进行时，加入该流而不是打开新的上游流。
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.create_task(self._pump(key, broadcast, factory()))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        queue = asyncio.Queue()
+        for delta in broadcast.deltas:
+            queue.put_nowait(delta)
+        broadcast.queues.add(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            broadcast.queues.discard(queue)
+            if not broadcast.queues and not broadcast.task.done():
+                self._forget(key, broadcast)
+                broadcast.task.cancel()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._streams), "leaders": self.leaders, "coalesced": self.coalesced}
@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+import json
+from config import SSE_COALESCE_WINDOW_MS, SSE_COALESCE_MAX_BYTES, SSE_QUEUE_MAX_SIZE
+
+# 复用同一个 JSON 编码器实例，避免每帧重复构造编码器。
+# ensure_ascii=False 让中文按 UTF-8 原样输出，比 \uXXXX 转义节省一半以上的字节。
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+# 标记上游增量已经全部读取完毕
+_END = object()
+
+def encode_event(payload: dict) -> str:
+    """
+    将一个事件对象编码为一条完整的 SSE 帧。
+    """
+    return f"data: {_encoder.encode(payload)}\n\n"
+
+class SSEWriter:
+    """
+    SSE 输出阶段：把上游的文本增量合并成尽量少的 SSE 帧。
+
+    - 第一个增量立即发送，保证首字延迟 (TTFT) 不受影响；
+    - 之后的增量在 `window_ms` 时间窗口内累积，窗口到期或累计字节数超过
+      `max_bytes` 时合并成一帧输出；
+    - 完整回答通过列表收集，结束后一次性拼接，避免字符串反复 `+=`；
+    - 上游增量经过长度为 `queue_size` 的有界队列，客户端读取变慢时暂停读取上游，内存占用有上限。
+    """
+
+    def __init__(self, window_ms: int = SSE_COALESCE_WINDOW_MS, max_bytes: int = SSE_COALESCE_MAX_BYTES,
+                 queue_size: int = SSE_QUEUE_MAX_SIZE):
+        self.window = max(window_ms, 0) / 1000
+        self.max_bytes = max_bytes
+        self.queue_size = max(queue_size, 1)
+        self.parts = []
+        self.frame_count = 0
+
+    @property
+    def text(self) -> str:
+        """
+        到目前为止输出的完整文本。
+        """
+        return "".join(self.parts)
+
+    def _frame(self, batch: list) -> str:
+        self.frame_count += 1
+        return encode_event({"content": "".join(batch)})
+
+    async def stream(self, deltas):
+        """
+        消费一个产出文本增量的异步迭代器，产出合并后的 SSE 帧。
+
+        上游由一个独立的任务读取并写入队列，这样等待时间窗口到期时不会取消上游的读取。
+        """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def pump():
+            try:
+                async for delta in deltas:
+                    await queue.put(delta)
+                await queue.put(_END)
+            except Exception as e:
+                await queue.put(e)
+
+        loop = asyncio.get_running_loop()
+        pump_task = asyncio.create_task(pump())
+        batch = []
+        batch_bytes = 0
+        flush_at = None
+        first = True
+        try:
+            while True:
+                if batch and not queue.empty():
+                    item = queue.get_nowait()
+                elif batch:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), max(flush_at - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        yield self._frame(batch)
+                        batch, batch_bytes = [], 0
+                        continue
+                else:
+                    item = await queue.get()
+
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                self.parts.append(item)
+                batch.append(item)
+                batch_bytes += len(item.encode("utf-8"))
+                if first or not self.window or batch_bytes >= self.max_bytes:
+                    first = False
+                    yield self._frame(batch)
+                    batch, batch_bytes = [], 0
+                elif len(batch) == 1:
+                    flush_at = loop.time() + self.window
+
+            if batch:
+                yield self._frame(batch)
+        finally:
+            # 提前结束 (例如出错或客户端断开) 时停止读取上游，并等待读取任务真正退出
+            pump_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await pump_task
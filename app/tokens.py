@@ -0,0 +1,43 @@
+import re
+
+# 中日韩文字 (含全角标点) 通常一个字符对应约一个 token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+# 每条消息在对话格式中额外占用的 token (角色标记、分隔符等)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    在本地粗略估算一段文本的 token 数，无需加载真正的分词器。
+
+    中文等 CJK 字符按每字 1 个 token 计算，其余字符按每 4 个字符约 1 个 token 计算。
+    估算结果略偏保守，适合用来做预算控制。
+    """
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count - text.count(" ")
+    return cjk_count + (other_count + 3) // 4
+
+def estimate_message_tokens(message: dict) -> int:
+    """
+    估算单条对话消息的 token 数。
+    """
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+def truncate_to_tokens(text: str, budget: int, suffix: str = "…") -> str:
+    """
+    将文本截断到估算 token 数不超过 budget 的最长前缀，被截断时追加 suffix。
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    budget -= estimate_tokens(suffix)
+    # 估算值随前缀长度单调不减，二分查找满足预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low].rstrip() + suffix if low else ""
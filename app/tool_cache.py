@@ -0,0 +1,52 @@
+import json
+from cache import ExpiringCache
+from config import TOOL_CACHE_MAX_ENTRIES, TOOL_CACHE_MAX_BYTES
+
+# MCP 工具调用结果缓存，键为 (服务器ID, 工具名, 规范化后的参数)。
+# 只缓存调用成功的结果，缓存时间由服务器注册时配置的 tool_cache_ttls 决定，默认不缓存。
+tool_result_cache = ExpiringCache(
+    max_entries=TOOL_CACHE_MAX_ENTRIES,
+    max_bytes=TOOL_CACHE_MAX_BYTES,
+    sizeof=lambda result: len(str(result).encode("utf-8"))
+)
+
+def tool_cache_key(server_id: str, tool_name: str, parameters: dict) -> tuple:
+    """
+    生成工具调用的缓存键。参数按键排序后序列化，键顺序或空白不同的相同参数会命中同一条目。
+    """
+    canonical = json.dumps(parameters, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return server_id, tool_name, canonical
+
+def parse_tool_cache_ttls(value) -> dict:
+    """
+    校验并规范化服务器的工具缓存配置 {工具名: 秒数}，"*" 为其余工具的默认值。
+
+    Raises:
+        ValueError: 配置不是对象，或缓存时间不是非负数。
+    """
+    if value is None:
+        return {}
+    if isinstance(value, str):
+        value = json.loads(value or "{}")
+    if not isinstance(value, dict):
+        raise ValueError("tool_cache_ttls 必须是 {工具名: 缓存秒数} 形式的对象")
+    ttls = {}
+    for tool_name, ttl in value.items():
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl < 0:
+            raise ValueError(f"工具 {tool_name} 的缓存时间必须是非负数")
+        ttls[str(tool_name)] = ttl
+    return ttls
+
+def tool_cache_ttl(ttls: dict, tool_name: str) -> float:
+    """
+    返回一个工具的缓存时间 (秒)，0 表示不缓存。
+    """
+    return ttls.get(tool_name, ttls.get("*", 0))
+
+def purge_tool_cache(server_id: str = None, tool_name: str = None) -> int:
+    """
+    清除工具结果缓存，可以按服务器和工具名过滤，返回清除的条目数。
+    """
+    return tool_result_cache.purge(lambda key: (
+        (server_id is None or key[0] == server_id) and (tool_name is None or key[1] == tool_name)
+    ))
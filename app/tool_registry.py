@@ -0,0 +1,102 @@
+import asyncio
+from config import TOOL_RETRIEVAL_TOP_K, TOOL_RETRIEVAL_MIN_SCORE
+from database import db_pool
+from tool_retrieval import BM25Index
+from tool_cache import parse_tool_cache_ttls, tool_cache_ttl
+
+class ToolCatalog:
+    """
+    某一时刻全部已注册 MCP 工具的只读快照。
+
+    Attributes:
+        tools (list): 工具字典列表，每个字典包含 mcp_tools 表的字段、所属服务器的 url，
+            以及按服务器配置计算出的结果缓存时间 cache_ttl (秒，0 表示不缓存)。
+        by_name (dict): 工具名 -> 工具字典的索引。多个服务器提供同名工具时只保留第一个。
+        index (BM25Index): 用于按查询挑选相关工具的检索索引。
+    """
+
+    def __init__(self, tools: list, previous: "ToolCatalog" = None):
+        self.by_name = {}
+        for tool in tools:
+            try:
+                ttls = parse_tool_cache_ttls(tool.pop("tool_cache_ttls", None))
+            except ValueError:
+                ttls = {}
+            tool["cache_ttl"] = tool_cache_ttl(ttls, tool["name"])
+            first = self.by_name.setdefault(tool["name"], tool)
+            if first is not tool:
+                print(f"工具名冲突: {tool['url']} 的工具 {tool['name']} 与 {first['url']} 的同名工具重复，已忽略。")
+        # 被同名工具覆盖的条目不参与检索和提示词，避免大模型选中一个无法调用的工具
+        self.tools = [tool for tool in tools if self.by_name[tool["name"]] is tool]
+        self.index = BM25Index(self.tools, previous.index if previous is not None else None)
+        # 预先渲染好每个工具的说明，拼入 Agent 提示词时只需 join
+        self._prompt_lines = {
+            tool["name"]: f"- 工具名: {tool['name']}\n  描述: {tool['description']}\n  输入格式: {tool['input_schema']}"
+            for tool in self.tools
+        }
+
+    def __len__(self) -> int:
+        return len(self.tools)
+
+    def select(self, query: str, k: int = TOOL_RETRIEVAL_TOP_K, min_score: float = TOOL_RETRIEVAL_MIN_SCORE) -> list:
+        """
+        挑选与查询相关的至多 k 个工具。工具总数不超过 k 时直接返回全部工具。
+        """
+        if len(self.tools) <= k:
+            return self.tools
+        return self.index.search(query, k, min_score)
+
+    def render(self, tools: list) -> str:
+        """
+        拼接所选工具的说明，作为 Agent 提示词中的工具列表。
+        """
+        return "\n".join(self._prompt_lines[tool["name"]] for tool in tools)
+
+class ToolRegistry:
+    """
+    进程内的 MCP 工具注册表。
+
+    工具列表只在启动时或失效后的第一次读取时从数据库加载一次，之后每个 Agent 请求
+    直接使用缓存的 `ToolCatalog`，无需再执行联表查询和拼接提示词。
+    mcp_api.py 在创建、更新、删除服务器或刷新工具后调用 `invalidate` 使其失效。
+    """
+
+    def __init__(self):
+        self._catalog = None
+        self._previous = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def _load(self) -> ToolCatalog:
+        async with db_pool.connection() as db:
+            rows = await db.fetchall("SELECT t.*, s.url, s.tool_cache_ttls FROM mcp_tools t JOIN mcp_servers s ON t.server_id = s.id")
+        # 以上一个快照为基础构建检索索引，未变化的工具无需重新切词
+        return ToolCatalog([dict(row) for row in rows], self._previous)
+
+    async def snapshot(self) -> ToolCatalog:
+        """
+        返回当前的工具快照，需要时从数据库重新加载。
+        """
+        catalog = self._catalog
+        if catalog is not None:
+            return catalog
+        async with self._lock:
+            if self._catalog is not None:
+                return self._catalog
+            generation = self._generation
+            catalog = await self._load()
+            # 加载期间如果又发生了变更，本次结果可能已经过时：照常返回，但不缓存
+            self._previous = catalog
+            if generation == self._generation:
+                self._catalog = catalog
+                print(f"工具注册表已加载，共 {len(catalog)} 个工具。")
+            return catalog
+
+    def invalidate(self):
+        """
+        工具或服务器发生变更后调用，下次读取时重新加载。
+        """
+        self._generation += 1
+        self._catalog = None
+
+tool_registry = ToolRegistry()
@@ -0,0 +1,97 @@
+import json
+import math
+import re
+from collections import Counter
+from config import TOOL_RETRIEVAL_TOP_K, TOOL_RETRIEVAL_MIN_SCORE
+
+# 连续的中日韩文字，以及拉丁字母/数字组成的单词
+_TERM_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[A-Za-z0-9]+")
+# 拆分驼峰命名，例如 getCurrentWeather -> get Current Weather
+_CAMEL_PATTERN = re.compile(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])")
+
+def lexical_terms(text: str) -> list:
+    """
+    把文本切分为用于检索的词项，不依赖外部分词器。
+
+    中文按相邻两字的字符 bigram 切分 (单字片段保留单字)，英文按单词切分，
+    下划线和驼峰命名会被拆开，全部转为小写。
+    """
+    terms = []
+    for run in _TERM_PATTERN.findall(text or ""):
+        if run[0].isascii():
+            terms.extend(word.lower() for word in _CAMEL_PATTERN.findall(run))
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def tool_document(tool: dict) -> str:
+    """
+    拼接一个工具可被检索的文本：名称 (重复一次以提高权重)、描述以及参数名和参数描述。
+    """
+    parts = [tool["name"], tool["name"], tool.get("description") or ""]
+    try:
+        properties = json.loads(tool.get("input_schema") or "{}").get("properties") or {}
+    except (json.JSONDecodeError, AttributeError):
+        properties = {}
+    for name, spec in properties.items():
+        parts.append(name)
+        if isinstance(spec, dict):
+            parts.append(spec.get("description") or spec.get("title") or "")
+    return " ".join(parts)
+
+class BM25Index:
+    """
+    基于字符 n-gram 的 BM25 工具检索索引，创建后只读。
+
+    每个工具的词频按工具ID缓存，传入上一个索引 `previous` 时，只为新增或检索文本发生变化的工具
+    重新切词，文档频率和平均长度由缓存的词频重新汇总，因此注册表变更后重建索引的开销很小。
+    """
+
+    def __init__(self, tools: list, previous: "BM25Index" = None, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.tools = tools
+        previous_cache = previous._cache if previous is not None else {}
+        self._cache = {}  # 工具ID -> (检索文本, Counter)
+        self._term_freqs = []  # 与 tools 一一对应的 Counter
+        for tool in tools:
+            document = tool_document(tool)
+            key = tool.get("id") or tool["name"]
+            cached = previous_cache.get(key)
+            if cached is None or cached[0] != document:
+                cached = (document, Counter(lexical_terms(document)))
+            self._cache[key] = cached
+            self._term_freqs.append(cached[1])
+
+        document_freqs = Counter()
+        for freqs in self._term_freqs:
+            document_freqs.update(freqs.keys())
+        count = len(tools)
+        self._lengths = [sum(freqs.values()) for freqs in self._term_freqs]
+        self._avg_length = sum(self._lengths) / count if count else 0.0
+        self._idf = {
+            term: math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for term, df in document_freqs.items()
+        }
+
+    def search(self, query: str, k: int = TOOL_RETRIEVAL_TOP_K, min_score: float = TOOL_RETRIEVAL_MIN_SCORE) -> list:
+        """
+        返回与查询最相关的至多 k 个工具，按得分从高到低排列，只保留得分高于 min_score 的工具。
+        """
+        query_terms = [term for term in set(lexical_terms(query)) if term in self._idf]
+        if not query_terms:
+            return []
+        scored = []
+        for index, freqs in enumerate(self._term_freqs):
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[index] / (self._avg_length or 1))
+            score = 0.0
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            if score > min_score:
+                scored.append((score, index))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [self.tools[index] for _, index in scored[:k]]
@@ -0,0 +1,129 @@
+"""
+pytest 公共配置：把 app/ 加入导入路径，并在导入任何应用模块之前设置测试用的环境变量
+(临时数据库、假的大模型配置)，保证测试不会改动仓库中的 chat_history.db。
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app"))
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(prefix="knowflow-test-"), "chat_history.db")
+
+os.environ.update({
+    "ZHIPUAI_API_KEY": "test-key",
+    "ZHIPUAI_BASE_URL": "http://127.0.0.1:1",
+    "MODEL_NAME": "test-model",
+    "DB_PATH": TEST_DB_PATH,
+    # 断开由 Starlette 发现，而不是由 DisconnectWatcher 的轮询发现
+    "DISCONNECT_POLL_INTERVAL_MS": "60000",
+    "ANSWER_CACHE_TTL": "0",
+})
+sys.path.insert(0, APP_DIR)
+
+class _Delta:
+    def __init__(self, content):
+        self.content = content
+
+class _Choice:
+    def __init__(self, content):
+        self.delta = _Delta(content)
+        self.message = _Delta(content)
+
+class FakeChunk:
+    """
+    模拟 openai 返回的一个 chunk (流式) 或一次完整响应 (非流式)。
+    """
+
+    def __init__(self, content):
+        self.choices = [_Choice(content)]
+
+class FakeStream:
+    """
+    模拟大模型的流式输出：每隔 interval 秒产出一个字。
+    """
+
+    def __init__(self, text, interval=0.02):
+        self.text = text
+        self.interval = interval
+
+    def __aiter__(self):
+        return self._generate()
+
+    async def _generate(self):
+        for char in self.text:
+            await asyncio.sleep(self.interval)
+            yield FakeChunk(char)
+
+    async def close(self):
+        pass
+
+class _FakeCompletions:
+    async def create(self, model, messages, stream=False, **kwargs):
+        answer = "这是一个很长的回答，" * 20
+        return FakeStream(answer) if stream else FakeChunk(answer)
+
+@pytest.fixture(scope="session")
+def db_path():
+    return TEST_DB_PATH
+
+@pytest.fixture(scope="session")
+def main():
+    """
+    导入应用，并把所有大模型端点替换为假的客户端。
+    """
+    cwd = os.getcwd()
+    os.chdir(APP_DIR)  # 静态文件目录使用相对路径
+    try:
+        import main as app_main
+        from llm_pool import llm_pool
+        fake_client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=_FakeCompletions()))
+        for endpoint in llm_pool.endpoints:
+            endpoint.client = fake_client
+        yield app_main
+    finally:
+        os.chdir(cwd)
+
+@pytest.fixture(scope="session")
+def run(main):
+    """
+    在整个测试会话共用的事件循环中启动应用 (执行 lifespan)，返回在该循环中运行协程的函数。
+    应用的连接池和后台任务绑定在启动时的事件循环上，因此所有经过应用的测试都使用同一个循环。
+    """
+    loop = asyncio.new_event_loop()
+    lifespan = main.app.router.lifespan_context(main.app)
+    loop.run_until_complete(lifespan.__aenter__())
+    try:
+        yield loop.run_until_complete
+    finally:
+        import history
+
+        async def drain():
+            await asyncio.gather(*list(history._background_tasks), return_exceptions=True)
+
+        # 等待后台的摘要更新结束，再关闭连接池
+        loop.run_until_complete(drain())
+        loop.run_until_complete(lifespan.__aexit__(None, None, None))
+        loop.close()
+
+def stream_scope(query_string: str) -> dict:
+    """
+    以 ASGI 2.3 (uvicorn 使用的版本) 请求 /api/stream 的 scope。
+    """
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/api/stream",
+        "raw_path": b"/api/stream",
+        "query_string": query_string.encode("utf-8"),
+        "root_path": "",
+        "headers": [(b"host", b"testserver")],
+        "client": ("127.0.0.1", 12345),
+        "server": ("testserver", 80),
+    }
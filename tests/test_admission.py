@@ -0,0 +1,216 @@
+"""
+/api/stream 准入控制的测试。
+
+运行方式 (在 tests/ 目录下): pytest test_admission.py
+"""
+import asyncio
+import json
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, PLAIN, SEARCH, AGENT
+from conftest import stream_scope
+
+def _controller(max_active=1, plain=10, search=10, agent=10, queue_size=10):
+    return AdmissionController(max_active, {PLAIN: plain, SEARCH: search, AGENT: agent}, queue_size, retry_after=7)
+
+def test_admits_immediately_while_there_is_room():
+    controller = _controller(max_active=2)
+    first = controller.enter(PLAIN, "a")
+    second = controller.enter(PLAIN, "b")
+    third = controller.enter(PLAIN, "c")
+    assert first.admitted and second.admitted and not third.admitted
+    assert controller.stats()["active"] == 2
+    assert controller.stats()["queued"] == 1
+
+def test_fifo_within_key_and_round_robin_across_keys():
+    controller = _controller()
+    running = controller.enter(PLAIN, "x")
+    a1, a2, a3 = (controller.enter(PLAIN, "a") for _ in range(3))
+    b1 = controller.enter(PLAIN, "b")
+    order = []
+    current = running
+    for _ in range(4):
+        current.release()
+        current = next(t for t in (a1, a2, a3, b1) if t.admitted and t not in order)
+        order.append(current)
+    # 组内先进先出，组与组之间轮流：a 的大量请求不会让 b 一直排在后面
+    assert order == [a1, b1, a2, a3]
+    assert controller.stats()["admitted_after_wait"] == 4
+
+def test_mode_limit_queues_only_that_mode():
+    controller = _controller(max_active=5, agent=1)
+    controller.enter(AGENT, "a")
+    queued_agent = controller.enter(AGENT, "b")
+    plain = controller.enter(PLAIN, "c")
+    assert not queued_agent.admitted
+    assert plain.admitted
+
+def test_rejects_when_queue_is_full():
+    controller = _controller(queue_size=2)
+    controller.enter(PLAIN, "a")
+    controller.enter(PLAIN, "a")
+    controller.enter(PLAIN, "b")
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.enter(PLAIN, "c")
+    assert excinfo.value.retry_after == 7
+    assert controller.stats()["rejected"] == 1
+
+def test_position_accounts_for_round_robin():
+    controller = _controller()
+    controller.enter(PLAIN, "x")
+    a1, a2 = controller.enter(PLAIN, "a"), controller.enter(PLAIN, "a")
+    b1 = controller.enter(PLAIN, "b")
+    assert controller.position(a1) == 1
+    assert controller.position(b1) == 2
+    # a2 排在 a1 之后，并与 b1 轮流，因此在 b1 之后
+    assert controller.position(a2) == 3
+
+def test_wait_turn_yields_positions_until_admitted():
+    async def scenario():
+        controller = _controller()
+        running = controller.enter(PLAIN, "x")
+        first = controller.enter(PLAIN, "a")
+        second = controller.enter(PLAIN, "b")
+        positions = []
+
+        async def wait():
+            async for position in second.wait_turn(timeout=5):
+                positions.append(position)
+
+        waiter = asyncio.create_task(wait())
+        await asyncio.sleep(0.01)
+        running.release()
+        await asyncio.sleep(0.01)
+        first.release()
+        await asyncio.wait_for(waiter, 1)
+        return positions, second.admitted
+
+    positions, admitted = asyncio.run(scenario())
+    assert positions == [2, 1]
+    assert admitted
+
+def test_wait_turn_times_out():
+    async def scenario():
+        controller = _controller()
+        controller.enter(PLAIN, "x")
+        ticket = controller.enter(PLAIN, "a")
+        with pytest.raises(asyncio.TimeoutError):
+            async for _ in ticket.wait_turn(timeout=0.05):
+                pass
+        ticket.release()
+        return controller.stats()
+
+    assert asyncio.run(scenario())["queued"] == 0
+
+def test_cancelled_waiter_leaves_queue_and_frees_slot_for_others():
+    async def scenario():
+        controller = _controller()
+        running = controller.enter(PLAIN, "x")
+        cancelled = controller.enter(PLAIN, "a")
+        later = controller.enter(PLAIN, "b")
+
+        async def wait(ticket):
+            try:
+                async for _ in ticket.wait_turn(timeout=5):
+                    pass
+            finally:
+                ticket.release()
+
+        task = asyncio.create_task(wait(cancelled))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert controller.stats()["queued"] == 1
+        running.release()
+        return later.admitted, controller.stats()
+
+    admitted, stats = asyncio.run(scenario())
+    assert admitted
+    assert stats["active"] == 1 and stats["queued"] == 0
+
+async def _request(app, query_string):
+    """
+    完整地请求一次 /api/stream，返回 (状态码, 响应头, SSE 事件列表)。
+    """
+    requested = False
+    status = None
+    headers = {}
+    body = []
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers.update((k.decode(), v.decode()) for k, v in message["headers"])
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await asyncio.wait_for(app(stream_scope(query_string), receive, send), timeout=10)
+    text = b"".join(body).decode("utf-8")
+    events = [json.loads(line[len("data: "):]) for line in text.splitlines() if line.startswith("data: ")]
+    return status, headers, events
+
+@pytest.fixture
+def saturated(main, monkeypatch):
+    """
+    让应用的准入控制器没有空闲名额，只剩一个排队位置。
+    """
+    controller = main.admission_controller
+    monkeypatch.setattr(controller, "max_active", 0)
+    monkeypatch.setattr(controller, "queue_size", 1)
+    return controller
+
+def test_endpoint_reports_queue_position_then_times_out(main, run, saturated):
+    status, _, events = run(_request(main.app, "query=queued&deadline_ms=200"))
+    assert status == 200
+    assert events[0] == {"event": "queued", "position": 1}
+    assert "error" in events[1]
+    assert events[-1]["event"] == "done"
+    assert saturated.queued == 0 and saturated.active == 0
+
+def test_endpoint_rejects_with_429_when_queue_is_full(main, run, saturated):
+    async def scenario():
+        waiting = asyncio.create_task(_request(main.app, "query=first&deadline_ms=500"))
+        await asyncio.sleep(0.05)
+        rejected = await _request(main.app, "query=second")
+        await waiting
+        return rejected
+
+    status, headers, _ = run(scenario())
+    assert status == 429
+    assert headers["retry-after"] == str(saturated.retry_after)
+    assert saturated.queued == 0
+
+async def _disconnect_immediately(app, query):
+    """
+    请求 /api/stream，在响应体的第一帧发出之前就断开连接。
+    """
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # 与真实服务器一样，发送响应头时让出事件循环，断开因此在响应体开始之前被发现
+        await asyncio.sleep(0)
+
+    await asyncio.wait_for(app(stream_scope(f"query={query}"), receive, send), timeout=10)
+
+def test_ticket_released_when_client_disconnects_before_first_chunk(main, run):
+    controller = main.admission_controller
+    for i in range(3):
+        run(_disconnect_immediately(main.app, f"early-disconnect-{i}"))
+        assert controller.active == 0
+    assert controller.queued == 0
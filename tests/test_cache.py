@@ -0,0 +1,128 @@
+"""
+app/cache.py 中 LRUCache / TTLCache / ExpiringCache 的淘汰与过期行为测试。
+时间通过替换 cache.time.time 控制，不依赖真实的等待。
+
+运行方式 (在 tests/ 目录下): pytest test_cache.py
+"""
+import pytest
+
+import cache
+from cache import LRUCache, TTLCache, ExpiringCache
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+def test_lru_evicts_least_recently_used_entry():
+    lru = LRUCache(max_entries=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1  # a 变为最近使用
+    lru.set("c", 3)
+    assert "b" not in lru
+    assert "a" in lru and "c" in lru
+
+def test_peek_does_not_change_order_or_stats():
+    lru = LRUCache(max_entries=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.peek("a") == 1
+    lru.set("c", 3)
+    assert "a" not in lru
+    assert lru.stats()["hits"] == 0 and lru.stats()["misses"] == 0
+
+def test_lru_evicts_by_total_bytes():
+    lru = LRUCache(max_entries=10, max_bytes=10, sizeof=len)
+    lru.set("a", "xxxx")
+    lru.set("b", "xxxx")
+    lru.set("c", "xxxx")
+    assert "a" not in lru
+    assert lru.total_bytes == 8
+
+def test_lru_keeps_newest_entry_even_if_oversized():
+    lru = LRUCache(max_entries=10, max_bytes=4, sizeof=len)
+    lru.set("a", "xx")
+    lru.set("b", "x" * 10)
+    assert len(lru) == 1 and "b" in lru
+    assert lru.total_bytes == 10
+
+def test_lru_set_recomputes_size_of_updated_entry():
+    lru = LRUCache(max_entries=10, max_bytes=100, sizeof=len)
+    value = ["x"]
+    lru.set("a", value)
+    value.extend(["y", "z"])
+    lru.set("a", value)
+    assert lru.total_bytes == 3
+    assert lru.pop("a") is value
+    assert lru.total_bytes == 0
+
+def test_lru_stats_track_hit_ratio():
+    lru = LRUCache(max_entries=2)
+    lru.set("a", 1)
+    lru.get("a")
+    lru.get("missing")
+    stats = lru.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 0.5)
+
+def test_ttl_cache_fresh_stale_and_expired(clock):
+    ttl_cache = TTLCache(max_entries=10, ttl=60, stale_ttl=30)
+    ttl_cache.set("q", "结果")
+    assert ttl_cache.lookup("q") == ("结果", False)
+
+    clock.now += 61
+    assert ttl_cache.lookup("q") == ("结果", True)
+
+    clock.now += 30
+    assert ttl_cache.lookup("q") is None
+    assert "q" not in ttl_cache
+    stats = ttl_cache.stats()
+    assert (stats["hits"], stats["stale_hits"], stats["misses"]) == (2, 1, 1)
+
+def test_ttl_cache_without_stale_window_expires_at_ttl(clock):
+    ttl_cache = TTLCache(max_entries=10, ttl=60)
+    ttl_cache.set("q", "结果")
+    clock.now += 60
+    assert ttl_cache.lookup("q") is None
+
+def test_ttl_cache_respects_stored_at_of_restored_entries(clock):
+    ttl_cache = TTLCache(max_entries=10, ttl=60, stale_ttl=30)
+    ttl_cache.set("old", "旧结果", stored_at=clock.now - 70)
+    ttl_cache.set("new", "新结果")
+    assert ttl_cache.lookup("old") == ("旧结果", True)
+    assert [key for key, _, _ in ttl_cache.items()] == ["new", "old"]
+
+def test_ttl_cache_sizeof_applies_to_value_only():
+    ttl_cache = TTLCache(max_entries=10, ttl=60, max_bytes=6, sizeof=len)
+    ttl_cache.set("a", "xxx")
+    ttl_cache.set("b", "xxx")
+    ttl_cache.set("c", "xxx")
+    assert "a" not in ttl_cache
+    assert ttl_cache.total_bytes == 6
+
+def test_expiring_cache_uses_per_entry_ttl(clock):
+    expiring = ExpiringCache(max_entries=10)
+    expiring.set("short", 1, ttl=10)
+    expiring.set("long", 2, ttl=100)
+    clock.now += 10
+    assert expiring.get("short") is None
+    assert "short" not in expiring
+    assert expiring.get("long") == 2
+
+def test_expiring_cache_purge_by_predicate():
+    expiring = ExpiringCache(max_entries=10)
+    expiring.set(("search", 1), "a", ttl=60)
+    expiring.set(("search", 2), "b", ttl=60)
+    expiring.set(("time", 1), "c", ttl=60)
+    assert expiring.purge(lambda key: key[0] == "search") == 2
+    assert len(expiring) == 1
+    assert expiring.purge() == 1
+    assert len(expiring) == 0
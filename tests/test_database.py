@@ -0,0 +1,105 @@
+"""
+SQLite 连接池 (app/database.py 中的 ConnectionPool / AsyncConnection) 的测试。
+使用 conftest.py 设置的临时数据库。
+
+运行方式 (在 tests/ 目录下): pytest test_database.py
+"""
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from database import ConnectionPool
+
+def _with_pool(scenario, size=2):
+    async def run():
+        pool = ConnectionPool(size)
+        try:
+            await pool.run(lambda conn: conn.execute("CREATE TABLE IF NOT EXISTS pool_test (value TEXT)"))
+            await pool.run(lambda conn: conn.execute("DELETE FROM pool_test"))
+            return await scenario(pool)
+        finally:
+            pool.close()
+    return asyncio.run(run())
+
+async def _values(pool) -> list:
+    async with pool.connection() as conn:
+        return [row["value"] for row in await conn.fetchall("SELECT value FROM pool_test ORDER BY rowid")]
+
+def test_connections_are_reused():
+    async def scenario(pool):
+        first = await pool.acquire()
+        await pool.release(first)
+        second = await pool.acquire()
+        await pool.release(second)
+        return first is second
+
+    assert _with_pool(scenario)
+
+def test_acquire_waits_when_pool_is_exhausted():
+    async def scenario(pool):
+        held = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0.05)
+        blocked = not waiter.done()
+        await pool.release(held)
+        conn = await asyncio.wait_for(waiter, 1)
+        await pool.release(conn)
+        return blocked
+
+    assert _with_pool(scenario, size=1)
+
+def test_sql_runs_off_the_event_loop_thread():
+    async def scenario(pool):
+        async with pool.connection() as conn:
+            return await conn.run(threading.current_thread)
+
+    assert _with_pool(scenario) is not threading.current_thread()
+
+def test_release_rolls_back_uncommitted_transaction():
+    async def scenario(pool):
+        async with pool.connection() as conn:
+            await conn.execute("INSERT INTO pool_test (value) VALUES ('未提交')")
+        return await _values(pool)
+
+    assert _with_pool(scenario, size=1) == []
+
+def test_run_commits_on_success_and_rolls_back_on_error():
+    async def scenario(pool):
+        await pool.run(lambda conn: conn.execute("INSERT INTO pool_test (value) VALUES ('已提交')"))
+
+        def failing(conn):
+            conn.execute("INSERT INTO pool_test (value) VALUES ('应被回滚')")
+            raise sqlite3.IntegrityError("失败")
+
+        with pytest.raises(sqlite3.IntegrityError):
+            await pool.run(failing)
+        return await _values(pool)
+
+    assert _with_pool(scenario) == ["已提交"]
+
+def test_cancelled_caller_waits_for_running_sql_before_release():
+    async def scenario(pool):
+        started = threading.Event()
+        finished = threading.Event()
+
+        def slow(conn):
+            started.set()
+            finished.wait(1)
+            return "done"
+
+        conn = await pool.acquire()
+        task = asyncio.create_task(conn.run(slow, conn._conn))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 1)
+        task.cancel()
+        await asyncio.sleep(0.02)
+        # SQL 仍在线程中执行，取消不能让调用提前返回，否则连接会被并发使用
+        still_running = not task.done()
+        finished.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await pool.release(conn)
+        return still_running
+
+    assert _with_pool(scenario)
@@ -0,0 +1,103 @@
+"""
+客户端中途断开 SSE 连接时，已生成的部分回答应当连同断开标记一起保存。
+
+测试直接通过 ASGI 接口驱动应用：receive 在收到第一段回答后返回 http.disconnect，
+与 uvicorn 在浏览器关闭连接时的行为相同。断开由 Starlette 的 StreamingResponse 发现并取消响应，
+而不是由 DisconnectWatcher 的轮询发现 (轮询间隔被设置得足够长)。
+
+运行方式 (在 tests/ 目录下): pytest test_disconnect.py
+"""
+import asyncio
+import sqlite3
+
+from conftest import stream_scope
+
+async def _stream_until_first_answer(app, query):
+    """
+    以 ASGI 2.3 (uvicorn 使用的版本) 请求 /api/stream，收到第一段回答后断开连接。
+    返回断开前收到的响应体。
+    """
+    first_answer = asyncio.Event()
+    requested = False
+    body = []
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await first_answer.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            body.append(message["body"])
+            if b'"content"' in message["body"]:
+                first_answer.set()
+
+    await asyncio.wait_for(app(stream_scope(f"query={query}"), receive, send), timeout=10)
+    return b"".join(body).decode("utf-8")
+
+def test_partial_answer_saved_when_client_disconnects(main, run, db_path):
+    async def scenario():
+        text = await _stream_until_first_answer(main.app, "disconnect-test")
+        # 断开后的保存在独立任务中完成，等待它们结束后再把队列写入数据库
+        await asyncio.gather(*list(main._background_tasks))
+        await main.persistence_queue.flush()
+        return text
+
+    text = run(scenario())
+    assert '"event": "done"' not in text
+
+    conn = sqlite3.connect(db_path)
+    try:
+        session_id, = conn.execute("SELECT session_id FROM messages WHERE role = 'user' AND content = ?", ("disconnect-test",)).fetchone()
+        assert conn.execute("SELECT 1 FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+        rows = conn.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY id", (session_id,)).fetchall()
+    finally:
+        conn.close()
+    assert [role for role, _ in rows] == ["user", "assistant"]
+    answer = rows[1][1]
+    assert answer.endswith(main.PARTIAL_RESPONSE_MARKER)
+    assert answer != main.PARTIAL_RESPONSE_MARKER
+
+class _FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+def test_watcher_converts_its_own_cancellation_to_client_disconnected():
+    from request_scope import DisconnectWatcher, ClientDisconnected
+
+    async def scenario():
+        request = _FakeRequest()
+        async with DisconnectWatcher(request, interval_ms=10) as watcher:
+            asyncio.get_running_loop().call_later(0.05, setattr, request, "disconnected", True)
+            try:
+                await watcher.run(asyncio.sleep(10))
+            except ClientDisconnected:
+                return True
+        return False
+
+    assert asyncio.run(scenario())
+
+def test_watcher_passes_outer_cancellation_through():
+    from request_scope import DisconnectWatcher
+
+    async def scenario():
+        request = _FakeRequest()
+        async with DisconnectWatcher(request, interval_ms=10) as watcher:
+            task = asyncio.create_task(watcher.run(asyncio.sleep(10)))
+            await asyncio.sleep(0.02)
+            # 即使已经记录为断开，外层任务自身被取消时仍应原样传递取消
+            watcher.disconnected = True
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                return True
+        return False
+
+    assert asyncio.run(scenario())
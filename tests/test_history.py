@@ -0,0 +1,82 @@
+"""
+滚动摘要 (app/history.py) 的测试：窗口根据缓存中的会话历史计算，
+只有真正折叠出新摘要时才写入数据库。
+
+运行方式 (在 tests/ 目录下): pytest test_history.py
+"""
+import asyncio
+import contextlib
+
+import pytest
+
+import history
+from history import SessionHistory, session_history_cache, update_rolling_summary, schedule_summary_update
+
+class _RecordingPool:
+    """
+    记录 SQL 的假连接池，用来确认哪些路径访问了数据库。
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        yield self
+
+    async def execute(self, sql, params=()):
+        self.statements.append((" ".join(sql.split()), params))
+
+    async def commit(self):
+        pass
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = _RecordingPool()
+    monkeypatch.setattr(history, "db_pool", pool)
+    return pool
+
+@pytest.fixture
+def cached_session():
+    session_id = "history-test"
+    entry = SessionHistory()
+    for i in range(6):
+        entry.append("user", f"问题 {i} " + "内容" * 50)
+        entry.append("assistant", f"回答 {i} " + "内容" * 50)
+    session_history_cache.set(session_id, entry)
+    yield session_id, entry
+    session_history_cache.pop(session_id)
+
+def test_session_within_window_does_not_touch_database(pool, cached_session):
+    session_id, entry = cached_session
+
+    async def scenario():
+        schedule_summary_update(session_id)
+        scheduled = set(history._background_tasks)
+        await update_rolling_summary(session_id)
+        return scheduled
+
+    assert asyncio.run(scenario()) == set()
+    assert pool.statements == []
+    assert entry.summarized_count == 0
+
+def test_fold_writes_summary_once_and_updates_cache(pool, cached_session, monkeypatch):
+    session_id, entry = cached_session
+    folded = []
+
+    async def fake_summarize(previous_summary, messages):
+        folded.extend(messages)
+        return "摘要"
+
+    monkeypatch.setattr(history, "_summarize", fake_summarize)
+    asyncio.run(update_rolling_summary(session_id, budget=history.HISTORY_SUMMARY_TOKENS + 800))
+
+    assert len(pool.statements) == 1
+    sql, params = pool.statements[0]
+    assert sql.startswith("INSERT INTO session_summaries")
+    assert params[:3] == (session_id, "摘要", len(folded))
+    assert 0 < len(folded) < 12
+    assert folded[0]["content"].startswith("问题 0")
+    assert entry.summary == "摘要"
+    assert entry.summarized_count == len(folded)
+    assert entry.messages[0]["role"] == "user"
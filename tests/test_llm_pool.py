@@ -0,0 +1,173 @@
+"""
+大模型端点池 (app/llm_pool.py) 的测试：负载分配、换端点重试、摘除和对冲请求。
+
+运行方式 (在 tests/ 目录下): pytest test_llm_pool.py
+"""
+import asyncio
+import types
+
+import httpx
+import openai
+import pytest
+
+from conftest import FakeChunk, FakeStream
+from llm_pool import LLMEndpoint, LLMEndpointPool
+
+class _FakeClient:
+    """
+    可配置延迟和错误的假 openai 客户端。delay 为首 token 之前的等待秒数。
+    """
+
+    def __init__(self, text="回答", error=None, delay=0):
+        self.text = text
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return FakeStream(self.text, interval=0) if stream else FakeChunk(self.text)
+
+def _endpoint(name, client, **kwargs):
+    endpoint = LLMEndpoint(name, "http://127.0.0.1:1", "test-key", **kwargs)
+    endpoint.client = client
+    return endpoint
+
+async def _collect(pool, model="m"):
+    return "".join([delta async for delta in pool.stream(model, [{"role": "user", "content": "你好"}])])
+
+def _bad_request():
+    request = httpx.Request("POST", "http://127.0.0.1:1/chat/completions")
+    return openai.BadRequestError("bad request", response=httpx.Response(400, request=request), body=None)
+
+def test_picks_least_loaded_endpoint_by_weight():
+    async def scenario():
+        light = _endpoint("light", _FakeClient(), weight=1)
+        heavy = _endpoint("heavy", _FakeClient(), weight=3)
+        pool = LLMEndpointPool([light, heavy])
+        picked = [await pool.acquire("m") for _ in range(4)]
+        return [endpoint.name for endpoint in picked]
+
+    assert sorted(asyncio.run(scenario())) == ["heavy", "heavy", "heavy", "light"]
+
+def test_waits_for_a_slot_when_all_endpoints_are_full():
+    async def scenario():
+        endpoint = _endpoint("only", _FakeClient(), max_concurrency=1)
+        pool = LLMEndpointPool([endpoint])
+        first = await pool.acquire("m")
+        waiter = asyncio.create_task(pool.acquire("m"))
+        await asyncio.sleep(0.02)
+        blocked = not waiter.done()
+        pool.release(first)
+        second = await asyncio.wait_for(waiter, 1)
+        pool.release(second)
+        return blocked, endpoint.outstanding
+
+    blocked, outstanding = asyncio.run(scenario())
+    assert blocked
+    assert outstanding == 0
+
+def test_only_endpoints_serving_the_model_are_used():
+    async def scenario():
+        other = _endpoint("other", _FakeClient("错误"), models=["other-model"])
+        serving = _endpoint("serving", _FakeClient("正确"), models=["m"])
+        pool = LLMEndpointPool([other, serving])
+        text = await _collect(pool)
+        with pytest.raises(ValueError):
+            await pool.acquire("unknown-model")
+        return text, other.client.calls
+
+    assert asyncio.run(scenario()) == ("正确", 0)
+
+def test_stream_fails_over_to_another_endpoint():
+    async def scenario():
+        broken = _endpoint("broken", _FakeClient(error=OSError("connection refused")))
+        healthy = _endpoint("healthy", _FakeClient("正常回答"))
+        pool = LLMEndpointPool([broken, healthy], max_attempts=2)
+        # 让失败的端点先被选中
+        healthy.outstanding = 1
+        text = await _collect(pool)
+        healthy.outstanding -= 1
+        return text, pool, broken, healthy
+
+    text, pool, broken, healthy = asyncio.run(scenario())
+    assert text == "正常回答"
+    assert pool.failovers == 1
+    assert broken.failures == 1
+    assert broken.outstanding == 0 and healthy.outstanding == 0
+
+def test_stream_gives_up_after_max_attempts():
+    async def scenario():
+        endpoints = [_endpoint(f"broken-{i}", _FakeClient(error=OSError("down"))) for i in range(3)]
+        pool = LLMEndpointPool(endpoints, max_attempts=2)
+        with pytest.raises(OSError):
+            await _collect(pool)
+        return [endpoint.client.calls for endpoint in endpoints], [endpoint.outstanding for endpoint in endpoints]
+
+    calls, outstanding = asyncio.run(scenario())
+    assert sum(calls) == 2
+    assert outstanding == [0, 0, 0]
+
+def test_request_errors_are_not_retried():
+    async def scenario():
+        first = _endpoint("first", _FakeClient(error=_bad_request()))
+        second = _endpoint("second", _FakeClient())
+        second.outstanding = 1
+        pool = LLMEndpointPool([first, second], max_attempts=2)
+        with pytest.raises(openai.BadRequestError):
+            await _collect(pool)
+        return second.client.calls, pool.failovers
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+def test_endpoint_is_ejected_after_consecutive_failures():
+    async def scenario():
+        flaky = _endpoint("flaky", _FakeClient(error=OSError("down")), eject_after=2, eject_seconds=60)
+        backup = _endpoint("backup", _FakeClient(), weight=0.1)
+        pool = LLMEndpointPool([flaky, backup], max_attempts=2)
+        for _ in range(2):
+            await _collect(pool)
+        ejected = flaky.ejected
+        calls_before = flaky.client.calls
+        # 被摘除后，即使它的负载更低也不再被选中
+        await _collect(pool)
+        return ejected, flaky.client.calls - calls_before, flaky.ejections
+
+    assert asyncio.run(scenario()) == (True, 0, 1)
+
+def test_hedges_slow_first_token_to_another_endpoint():
+    async def scenario():
+        slow = _endpoint("slow", _FakeClient("慢", delay=1))
+        fast = _endpoint("fast", _FakeClient("快"))
+        fast.outstanding = 1  # 让慢端点先被选中
+        pool = LLMEndpointPool([slow, fast], hedge_after_ms=50)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        text = await _collect(pool)
+        elapsed = loop.time() - started
+        fast.outstanding -= 1
+        return text, elapsed, pool, slow, fast
+
+    text, elapsed, pool, slow, fast = asyncio.run(scenario())
+    assert text == "快"
+    assert elapsed < 0.5
+    assert pool.hedges == 1 and pool.hedge_wins == 1
+    # 未胜出的请求被取消，名额已归还
+    assert slow.outstanding == 0 and fast.outstanding == 0
+
+def test_complete_fails_over_to_another_endpoint():
+    async def scenario():
+        broken = _endpoint("broken", _FakeClient(error=OSError("down")))
+        healthy = _endpoint("healthy", _FakeClient("完整回答"))
+        healthy.outstanding = 1
+        pool = LLMEndpointPool([broken, healthy], max_attempts=2)
+        answer = await pool.complete("m", [{"role": "user", "content": "你好"}])
+        healthy.outstanding -= 1
+        return answer, pool.failovers, broken.outstanding, healthy.outstanding
+
+    assert asyncio.run(scenario()) == ("完整回答", 1, 0, 0)
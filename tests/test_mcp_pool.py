@@ -0,0 +1,77 @@
+"""
+MCP 会话池 (app/mcp_pool.py) 的测试，用假的客户端代替真实的 SSE 连接。
+
+运行方式 (在 tests/ 目录下): pytest test_mcp_pool.py
+"""
+import asyncio
+
+from mcp_pool import MCPSessionPool
+
+class _FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    def is_connected(self):
+        return not self.closed
+
+    async def close(self):
+        self.closed = True
+
+def _pool():
+    pool = MCPSessionPool(max_sessions=4, max_concurrency=2)
+    clients = []
+
+    async def fake_open(url):
+        clients.append(_FakeClient())
+        return clients[-1]
+
+    pool._open = fake_open
+    return pool, clients
+
+def test_session_is_reused_between_calls():
+    async def scenario():
+        pool, clients = _pool()
+        async with pool.session("s1", "http://mcp/sse"):
+            pass
+        async with pool.session("s1", "http://mcp/sse"):
+            pass
+        return pool, clients
+
+    pool, clients = asyncio.run(scenario())
+    assert len(clients) == 1
+    assert (pool.connects, pool.reuses) == (1, 1)
+
+def test_discard_prunes_limits_and_locks():
+    async def scenario():
+        pool, clients = _pool()
+        async with pool.session("s1", "http://mcp/sse"):
+            pass
+        async with pool.session("s2", "http://mcp2/sse"):
+            pass
+        pool.discard("s1")
+        await asyncio.sleep(0)
+        return pool, clients
+
+    pool, clients = asyncio.run(scenario())
+    assert set(pool._limits) == {"s2"}
+    assert set(pool._locks) == {"s2"}
+    assert clients[0].closed and not clients[1].closed
+
+def test_discard_during_call_closes_session_after_release():
+    async def scenario():
+        pool, clients = _pool()
+        async with pool.session("s1", "http://mcp/sse"):
+            pool.discard("s1")
+            await asyncio.sleep(0)
+            closed_during_call = clients[0].closed
+        await asyncio.sleep(0)
+        # 后续调用重新建立会话和信号量
+        async with pool.session("s1", "http://mcp/sse"):
+            pass
+        return pool, clients, closed_during_call
+
+    pool, clients, closed_during_call = asyncio.run(scenario())
+    assert not closed_during_call
+    assert clients[0].closed
+    assert len(clients) == 2 and not clients[1].closed
+    assert set(pool._limits) == {"s1"}
@@ -0,0 +1,166 @@
+"""
+数据库迁移 (app/database.py 中的 run_migrations) 的测试。
+
+运行方式 (在 tests/ 目录下): pytest test_migrations.py
+"""
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import database
+from conftest import APP_DIR
+
+LATEST_VERSION = database.MIGRATIONS[-1][0]
+
+# 引入迁移机制之前 init_db 创建的表结构 (文本时间戳、没有级联删除)
+_BASELINE_SCHEMA = """
+CREATE TABLE chat_sessions (
+    id TEXT PRIMARY KEY,
+    summary TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT,
+    role TEXT,
+    content TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+);
+CREATE TABLE mcp_servers (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    description TEXT,
+    auth_type TEXT,
+    auth_value TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE mcp_tools (
+    id TEXT PRIMARY KEY,
+    server_id TEXT,
+    name TEXT NOT NULL,
+    description TEXT,
+    input_schema TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (server_id) REFERENCES mcp_servers(id)
+);
+CREATE TABLE orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_name TEXT NOT NULL,
+    price REAL NOT NULL,
+    customer_name TEXT NOT NULL,
+    sales_name TEXT NOT NULL,
+    create_time INTEGER
+);
+"""
+
+def _connect(path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+def _version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _columns(conn, table) -> dict:
+    return {row["name"]: row["type"] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """
+    一个带有数据的旧版数据库 (user_version 为 0)。
+    """
+    conn = _connect(str(tmp_path / "baseline.db"))
+    conn.executescript(_BASELINE_SCHEMA)
+    conn.execute("INSERT INTO chat_sessions (id, summary, created_at, updated_at) VALUES ('s1', '你好', '2024-01-02 03:04:05', '2024-01-02 03:05:00')")
+    conn.executemany("INSERT INTO messages (session_id, role, content, created_at) VALUES ('s1', ?, ?, '2024-01-02 03:04:05')",
+                     [("user", "你好"), ("assistant", "你好！")])
+    conn.execute("INSERT INTO mcp_servers (id, name, url) VALUES ('srv', '天气', 'http://127.0.0.1:8002/sse')")
+    conn.execute("INSERT INTO mcp_tools (id, server_id, name, description, input_schema) VALUES ('t1', 'srv', 'get_weather', '查询天气', '{}')")
+    conn.commit()
+    yield conn
+    conn.close()
+
+def test_fresh_database_is_migrated_to_latest_version(tmp_path):
+    conn = _connect(str(tmp_path / "fresh.db"))
+    database.run_migrations(conn)
+    assert _version(conn) == LATEST_VERSION
+    tables = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"chat_sessions", "messages", "session_summaries", "mcp_servers", "mcp_tools", "orders"} <= tables
+    indexes = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_messages_session_id", "idx_chat_sessions_updated_at", "idx_mcp_tools_server_id"} <= indexes
+    assert "tool_cache_ttls" in _columns(conn, "mcp_servers")
+    conn.close()
+
+def test_baseline_database_keeps_its_data(baseline_db):
+    database.run_migrations(baseline_db)
+    assert _version(baseline_db) == LATEST_VERSION
+
+    session = baseline_db.execute("SELECT * FROM chat_sessions WHERE id = 's1'").fetchone()
+    assert session["summary"] == "你好"
+    assert isinstance(session["created_at"], int) and isinstance(session["updated_at"], int)
+    assert session["updated_at"] - session["created_at"] == 55
+    rows = baseline_db.execute("SELECT role, content, created_at FROM messages WHERE session_id = 's1' ORDER BY id").fetchall()
+    assert [(row["role"], row["content"]) for row in rows] == [("user", "你好"), ("assistant", "你好！")]
+    assert all(isinstance(row["created_at"], int) for row in rows)
+    server = baseline_db.execute("SELECT tool_cache_ttls FROM mcp_servers WHERE id = 'srv'").fetchone()
+    assert server["tool_cache_ttls"] == "{}"
+
+def test_migrated_foreign_keys_cascade(baseline_db):
+    database.run_migrations(baseline_db)
+    baseline_db.execute("INSERT INTO session_summaries (session_id, content) VALUES ('s1', '摘要')")
+    baseline_db.execute("DELETE FROM chat_sessions WHERE id = 's1'")
+    baseline_db.execute("DELETE FROM mcp_servers WHERE id = 'srv'")
+    for table in ("messages", "session_summaries", "mcp_tools"):
+        assert baseline_db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0
+
+def test_only_pending_migrations_run(baseline_db, monkeypatch, capsys):
+    monkeypatch.setattr(database, "MIGRATIONS", database.MIGRATIONS[:2])
+    database.run_migrations(baseline_db)
+    assert _version(baseline_db) == 2
+    monkeypatch.undo()
+    capsys.readouterr()
+
+    database.run_migrations(baseline_db)
+    applied = [line for line in capsys.readouterr().out.splitlines() if line.startswith("已应用数据库迁移")]
+    assert [int(line.split()[1].rstrip(":")) for line in applied] == list(range(3, LATEST_VERSION + 1))
+    assert _version(baseline_db) == LATEST_VERSION
+
+    # 已是最新版本时不再执行任何迁移
+    database.run_migrations(baseline_db)
+    assert "已应用数据库迁移" not in capsys.readouterr().out
+
+def test_failed_migration_is_rolled_back(baseline_db, monkeypatch):
+    database.run_migrations(baseline_db)
+
+    def broken(cursor):
+        cursor.execute("ALTER TABLE chat_sessions ADD COLUMN pinned INTEGER")
+        raise RuntimeError("迁移失败")
+
+    monkeypatch.setattr(database, "MIGRATIONS", database.MIGRATIONS + [(LATEST_VERSION + 1, "失败的迁移", broken)])
+    with pytest.raises(RuntimeError):
+        database.run_migrations(baseline_db)
+    assert _version(baseline_db) == LATEST_VERSION
+    assert "pinned" not in _columns(baseline_db, "chat_sessions")
+    assert baseline_db.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+def test_repository_database_migrates_cleanly(tmp_path):
+    # 使用仓库中附带的示例数据库的副本，原文件不会被修改
+    path = str(tmp_path / "chat_history.db")
+    shutil.copy(os.path.join(APP_DIR, "chat_history.db"), path)
+    conn = _connect(path)
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ("chat_sessions", "messages", "mcp_servers", "mcp_tools", "orders")}
+    database.run_migrations(conn)
+    assert _version(conn) == LATEST_VERSION
+    for table, count in counts.items():
+        assert conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == count
+    assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    conn.close()
@@ -0,0 +1,45 @@
+"""
+模型路由 (app/model_router.py) 的测试：选择模型不计数，只有真正调用模型时才计入路由统计。
+
+运行方式 (在 tests/ 目录下): pytest test_model_router.py
+"""
+import asyncio
+
+from conftest import stream_scope
+
+def test_chat_route_does_not_count():
+    import model_router
+
+    before = dict(model_router.route_counts)
+    route, model = model_router.chat_route("你好", True)
+    assert (route, model) == (model_router.PURPOSE_CHAT, model_router.PURPOSE_MODELS[model_router.PURPOSE_CHAT])
+    assert dict(model_router.route_counts) == before
+
+    model_router.record_route(route, model)
+    assert model_router.route_counts[f"{route}:{model}"] == before.get(f"{route}:{model}", 0) + 1
+
+def test_agent_request_without_tools_does_not_count_chat_route(main, run):
+    import model_router
+
+    async def request():
+        requested = False
+        body = []
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+
+        await asyncio.wait_for(main.app(stream_scope("query=route-test&agent_mode=true"), receive, send), timeout=10)
+        return b"".join(body).decode("utf-8")
+
+    before = dict(model_router.route_counts)
+    text = run(request())
+    assert "没有可用的工具" in text
+    assert dict(model_router.route_counts) == before
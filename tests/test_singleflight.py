@@ -0,0 +1,179 @@
+"""
+合并相同调用 (app/singleflight.py) 的测试。
+
+运行方式 (在 tests/ 目录下): pytest test_singleflight.py
+"""
+import asyncio
+
+from singleflight import SingleFlight, StreamFanout
+
+def test_concurrent_calls_share_one_upstream_call():
+    async def scenario():
+        group = SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "结果"
+
+        results = await asyncio.gather(*(group.do("k", fetch) for _ in range(5)))
+        # 调用结束后键被释放，之后的调用重新发起请求
+        again = await group.do("k", fetch)
+        return results, again, calls, group.stats()
+
+    results, again, calls, stats = asyncio.run(scenario())
+    assert results == ["结果"] * 5
+    assert again == "结果"
+    assert calls == 2
+    assert stats == {"in_flight": 0, "leaders": 2, "coalesced": 4}
+
+def test_errors_are_shared_by_all_waiters():
+    async def scenario():
+        group = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("上游出错")
+
+        return await asyncio.gather(group.do("k", fail), group.do("k", fail), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    async def scenario():
+        group = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "结果"
+
+        leaving = asyncio.create_task(group.do("k", fetch))
+        staying = asyncio.create_task(group.do("k", fetch))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        return await staying, leaving.cancelled()
+
+    assert asyncio.run(scenario()) == ("结果", True)
+
+def test_upstream_is_cancelled_when_every_waiter_leaves():
+    async def scenario():
+        group = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(group.do("k", fetch)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return group.stats()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+
+async def _deltas(parts, interval=0.01, closed=None):
+    try:
+        for part in parts:
+            await asyncio.sleep(interval)
+            yield part
+    finally:
+        if closed is not None:
+            closed.set()
+
+async def _read(fanout, key, factory, limit=None):
+    received = []
+    async for delta in fanout.subscribe(key, factory):
+        received.append(delta)
+        if limit is not None and len(received) >= limit:
+            break
+    return received
+
+def test_subscribers_share_one_stream():
+    async def scenario():
+        fanout = StreamFanout()
+        opened = 0
+
+        def factory():
+            nonlocal opened
+            opened += 1
+            return _deltas(["你", "好", "！"])
+
+        results = await asyncio.gather(*(_read(fanout, "k", factory) for _ in range(3)))
+        return results, opened, fanout.stats()
+
+    results, opened, stats = asyncio.run(scenario())
+    assert results == [["你", "好", "！"]] * 3
+    assert opened == 1
+    assert stats == {"in_flight": 0, "leaders": 1, "coalesced": 2}
+
+def test_late_subscriber_receives_earlier_deltas():
+    async def scenario():
+        fanout = StreamFanout()
+        factory = lambda: _deltas(["一", "二", "三", "四"], interval=0.02)
+        first = asyncio.create_task(_read(fanout, "k", factory))
+        await asyncio.sleep(0.05)
+        late = await _read(fanout, "k", factory)
+        return await first, late
+
+    first, late = asyncio.run(scenario())
+    assert first == late == ["一", "二", "三", "四"]
+
+def test_leaving_subscriber_does_not_stop_the_others():
+    async def scenario():
+        fanout = StreamFanout()
+        factory = lambda: _deltas(["a", "b", "c", "d"])
+        leaving, staying = await asyncio.gather(
+            _read(fanout, "k", factory, limit=1),
+            _read(fanout, "k", factory),
+        )
+        return leaving, staying
+
+    leaving, staying = asyncio.run(scenario())
+    assert leaving == ["a"]
+    assert staying == ["a", "b", "c", "d"]
+
+def test_upstream_is_closed_when_every_subscriber_leaves():
+    async def scenario():
+        fanout = StreamFanout()
+        closed = asyncio.Event()
+        factory = lambda: _deltas(["a"] * 100, closed=closed)
+        await asyncio.gather(_read(fanout, "k", factory, limit=1), _read(fanout, "k", factory, limit=2))
+        await asyncio.wait_for(closed.wait(), 1)
+        return fanout.stats()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+
+def test_upstream_error_reaches_every_subscriber():
+    async def scenario():
+        fanout = StreamFanout()
+
+        async def broken():
+            yield "部分"
+            await asyncio.sleep(0.01)
+            raise RuntimeError("上游出错")
+
+        return await asyncio.gather(*(_read(fanout, "k", broken) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_concurrent_calls_with_different_keys_are_independent():
+    async def scenario():
+        group = SingleFlight()
+
+        async def fetch(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(group.do("a", lambda: fetch(1)), group.do("b", lambda: fetch(2)))
+
+    assert asyncio.run(scenario()) == [1, 2]
@@ -0,0 +1,80 @@
+"""
+SSEWriter (app/sse.py) 的测试：帧合并、有界队列的背压，以及提前结束时读取任务被等待退出。
+
+运行方式 (在 tests/ 目录下): pytest test_sse_writer.py
+"""
+import asyncio
+import json
+
+from sse import SSEWriter
+
+async def _deltas(items, state, interval=0):
+    try:
+        for item in items:
+            state["read"] += 1
+            yield item
+            if interval:
+                await asyncio.sleep(interval)
+    finally:
+        state["closed"] = True
+
+def _contents(frames):
+    return [json.loads(frame[len("data: "):])["content"] for frame in frames]
+
+def test_first_delta_is_sent_alone_and_rest_coalesced():
+    async def scenario():
+        writer = SSEWriter(window_ms=50, max_bytes=1024)
+        state = {"read": 0}
+        frames = [frame async for frame in writer.stream(_deltas(["你", "好", "世", "界"], state))]
+        return writer, frames
+
+    writer, frames = asyncio.run(scenario())
+    assert _contents(frames) == ["你", "好世界"]
+    assert writer.text == "你好世界"
+    assert writer.frame_count == 2
+
+def test_upstream_read_ahead_is_bounded_by_queue_size():
+    async def scenario():
+        writer = SSEWriter(window_ms=0, queue_size=4)
+        state = {"read": 0}
+        stream = writer.stream(_deltas([str(i) for i in range(100)], state))
+        await stream.__anext__()
+        # 消费者暂停读取时，上游最多多读出队列长度加上正在写入的一个增量
+        await asyncio.sleep(0.05)
+        read_ahead = state["read"]
+        await stream.aclose()
+        return read_ahead, state
+
+    read_ahead, state = asyncio.run(scenario())
+    assert read_ahead <= 1 + 4 + 1
+    assert state["closed"]
+
+def test_early_close_waits_for_upstream_to_stop():
+    async def scenario():
+        writer = SSEWriter(window_ms=0)
+        state = {"read": 0}
+        stream = writer.stream(_deltas(["a"] * 100, state, interval=0.01))
+        await stream.__anext__()
+        await stream.aclose()
+        # aclose 返回时上游的读取任务已经退出，而不是仍在后台运行
+        return state.get("closed", False), [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    closed, pending = asyncio.run(scenario())
+    assert closed
+    assert pending == []
+
+def test_upstream_error_is_raised_to_consumer():
+    async def failing():
+        yield "a"
+        raise RuntimeError("上游出错")
+
+    async def scenario():
+        writer = SSEWriter(window_ms=0)
+        frames = []
+        try:
+            async for frame in writer.stream(failing()):
+                frames.append(frame)
+        except RuntimeError as e:
+            return _contents(frames), str(e)
+
+    assert asyncio.run(scenario()) == (["a"], "上游出错")